@@ -95,6 +95,10 @@ def create_app(config_name=None, yaml_config_override=None):
 
     from . import utils as app_utils
     app_utils.init_app(app)
+    from . import commands as app_commands
+    app_commands.init_app(app)
+    from . import search_utils # noqa: F401 (registers the search index hooks)
+    from . import typeahead_utils # noqa: F401 (registers the typeahead index hooks)
     from .utils import markdown_to_html_and_sanitize_util, linkify_mentions as linkify_mentions_util
 
     @login_manager.user_loader
@@ -122,6 +126,9 @@ def create_app(config_name=None, yaml_config_override=None):
 
     @app.template_filter('markdown')
     def actual_markdown_filter(text):
+        # Posts, captions and comments carry HTML rendered (mentions included) at write time.
+        if isinstance(text, models.RenderedContentMixin):
+            return Markup(text.get_rendered()[0] or '')
         text_with_mention_links = linkify_mentions_util(text)
         return markdown_to_html_and_sanitize_util(text_with_mention_links)
 
@@ -129,7 +136,8 @@ def create_app(config_name=None, yaml_config_override=None):
     def inject_global_template_variables():
         unread_notifications_count = 0
         if current_user.is_authenticated:
-            unread_notifications_count = models.Notification.query.filter_by(user_id=current_user.id, is_read=False).count()
+            # Maintained counter on the already-loaded user row; no COUNT per render.
+            unread_notifications_count = models.count_unread_notifications(current_user)
         return {
             'current_user': current_user,
             'default_avatar_url': url_for('static', filename='img/default_avatar.png'),
@@ -218,5 +226,3 @@ def create_app(config_name=None, yaml_config_override=None):
 
     app.logger.info("Flask application instance created and configured.")
     return app
-
-app = create_app()
@@ -1,6 +1,54 @@
+import base64
+import json
+from datetime import datetime
 from flask import url_for, current_app
+from markupsafe import escape
 from .models import Post, UserPhoto, Comment
 
+def encode_cursor(*values):
+    """
+    Encodes keyset pagination values (e.g. timestamp, type, id) into an opaque,
+    URL-safe cursor string. Datetimes are stored in ISO 8601 form.
+    """
+    payload = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    raw = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor, *converters):
+    """
+    Decodes a cursor produced by `encode_cursor`.
+
+    Args:
+        cursor (str): The opaque cursor string from the client.
+        *converters (callable): One converter per value, e.g. `datetime.fromisoformat`, `str`, `int`.
+
+    Returns:
+        list: The decoded values, each passed through its converter.
+
+    Raises:
+        ValueError: If the cursor is malformed or doesn't hold the expected number of values.
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"Malformed cursor: {e}") from e
+    if not isinstance(values, list) or len(values) != len(converters):
+        raise ValueError("Malformed cursor: unexpected number of values.")
+    try:
+        return [convert(value) for convert, value in zip(converters, values)]
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"Malformed cursor: {e}") from e
+
+def keyset_before(sort_col, id_col, cursor_sort_value, cursor_id):
+    """
+    Returns a WHERE clause selecting rows that come after a cursor position when
+    ordering by (sort_col DESC, id_col DESC). Written as an explicit OR rather than a
+    row-value comparison so it works on every supported backend.
+    """
+    from sqlalchemy import or_, and_
+    return or_(sort_col < cursor_sort_value, and_(sort_col == cursor_sort_value, id_col < cursor_id))
+
 def serialize_actor(user_model_instance):
     if not user_model_instance:
         return None
@@ -20,14 +68,8 @@ def serialize_actor(user_model_instance):
 
 def serialize_post_item(post):
     actor = serialize_actor(post.author)
-
-    from .utils import markdown_to_html_and_sanitize_util # For preview
-    # Generate a text-only preview first, then a safe HTML preview
-    # For simplicity, using a basic truncate here. A real app might strip HTML then truncate.
-    content_text_preview = ' '.join((post.content or "").split()[:30]) + ('...' if len((post.content or "").split()) > 30 else '')
-    # For HTML preview, it's safer to render markdown for a small portion or a summary field
-    # This is a placeholder for a more robust HTML preview generation:
-    content_html_preview = markdown_to_html_and_sanitize_util(content_text_preview)
+    # HTML and excerpt are rendered at write time; see RenderedContentMixin.
+    content_html, excerpt = post.get_rendered()
 
 
     return {
@@ -38,9 +80,11 @@ def serialize_post_item(post):
         "data": {
             "post_id": post.id,
             "title": None, # Assuming posts don't have titles, use content preview
-            "content_html_preview": content_html_preview,
-            "comment_count": post.comments.count(),
-                "like_count": post.like_count, # Use the existing property
+            "content_html_preview": f"<p>{escape(excerpt)}</p>" if excerpt else "",
+            "excerpt": excerpt,
+            "content_html": content_html,
+            "comment_count": post.comment_count,
+            "like_count": post.like_count,
             "url": url_for('post.view_post', post_id=post.id, _external=True),
             "categories": [{"slug": c.slug, "name": c.name} for c in post.categories],
             "tags": [{"slug": t.slug, "name": t.name} for t in post.tags],
@@ -50,9 +94,7 @@ def serialize_post_item(post):
 
 def serialize_photo_item(photo):
     actor = serialize_actor(photo.user)
-
-    from .utils import markdown_to_html_and_sanitize_util # For caption
-    caption_html = markdown_to_html_and_sanitize_util(photo.caption) if photo.caption else None
+    caption_html, _ = photo.get_rendered()
 
     return {
         "id": f"photo_{photo.id}",
@@ -65,17 +107,86 @@ def serialize_photo_item(photo):
             "caption_html": caption_html,
             "image_url_large": url_for('static', filename=photo.image_filename, _external=True) if photo.image_filename else None,
             # "image_url_thumbnail": ..., # Placeholder
-            "comment_count": photo.comments.count(),
-            "gallery_url": url_for('profile.view_gallery', user_id=photo.user.id, _anchor=f'photo-{photo.id}', _external=True)
+            "comment_count": photo.comment_count,
+            "like_count": photo.like_count,
+            "gallery_url": url_for('api.get_user_photos', user_id=photo.user.id, _anchor=f'photo-{photo.id}', _external=True)
         }
     }
 
+def serialize_feed_items(rows, viewer=None):
+    """
+    Hydrates and serializes a page of feed rows in a fixed number of queries.
+
+    Each row only needs `item_id` and `item_type` ('post' or 'photo'), as selected from
+    `FeedItem`. Posts and photos are loaded with one IN query each (authors, tags and
+    categories via selectinload), counts come from the denormalized counter columns,
+    and the viewer's like state from one more query, so the cost doesn't grow with the
+    page size.
+
+    Args:
+        rows (iterable): Feed rows with `item_id` and `item_type` attributes, in display order.
+        viewer (User, optional): The user whose like state should be reported.
+
+    Returns:
+        list[dict]: Serialized feed items in the same order as `rows`. Rows whose
+                    underlying item no longer exists are skipped.
+    """
+    from sqlalchemy import or_, and_
+    from sqlalchemy.orm import selectinload
+    from . import db
+    from .models import Like
+
+    post_ids = [row.item_id for row in rows if row.item_type == 'post']
+    photo_ids = [row.item_id for row in rows if row.item_type == 'photo']
+
+    posts_by_id, photos_by_id = {}, {}
+    if post_ids:
+        posts = Post.query.filter(Post.id.in_(post_ids))\
+                          .options(selectinload(Post.author), selectinload(Post.tags), selectinload(Post.categories))\
+                          .all()
+        posts_by_id = {post.id: post for post in posts}
+    if photo_ids:
+        photos = UserPhoto.query.filter(UserPhoto.id.in_(photo_ids))\
+                                .options(selectinload(UserPhoto.user))\
+                                .all()
+        photos_by_id = {photo.id: photo for photo in photos}
+
+    # Likes are written with the same type names the feed exposes ('post', 'photo').
+    liked = set()
+    if viewer is not None and viewer.is_authenticated and (post_ids or photo_ids):
+        like_targets = []
+        if post_ids:
+            like_targets.append(and_(Like.target_type == 'post', Like.target_id.in_(post_ids)))
+        if photo_ids:
+            like_targets.append(and_(Like.target_type == 'photo', Like.target_id.in_(photo_ids)))
+        liked = set(
+            db.session.query(Like.target_type, Like.target_id)
+                      .filter(Like.user_id == viewer.id, or_(*like_targets))
+        )
+
+    serialized_items = []
+    for row in rows:
+        if row.item_type == 'post':
+            post = posts_by_id.get(row.item_id)
+            if post is None:
+                continue
+            serialized_item = serialize_post_item(post)
+            serialized_item["data"]["is_liked_by_current_user"] = ('post', post.id) in liked
+        elif row.item_type == 'photo':
+            photo = photos_by_id.get(row.item_id)
+            if photo is None:
+                continue
+            serialized_item = serialize_photo_item(photo)
+            serialized_item["data"]["is_liked_by_current_user"] = ('photo', photo.id) in liked
+        else:
+            continue
+        serialized_items.append(serialized_item)
+    return serialized_items
+
 def serialize_comment_item(comment):
     from flask_login import current_user
     actor = serialize_actor(comment.author)
-
-    from .utils import markdown_to_html_and_sanitize_util # For caption
-    text_html = markdown_to_html_and_sanitize_util(comment.text) if comment.text else None
+    text_html, _ = comment.get_rendered()
 
     is_liked_by_current_user = False
     if current_user.is_authenticated:
@@ -114,12 +225,46 @@ def serialize_user_profile(user):
         "profile_info": user.profile_info,
         "website_url": user.website_url,
         "is_profile_public": user.is_profile_public,
-        "follower_count": user.followers.count(),
-        "following_count": user.followed.count(),
-        "post_count": user.posts.filter_by(is_published=True).count(),
-        "photo_count": user.gallery_photos.count()
+        "follower_count": user.follower_count,
+        "following_count": user.following_count,
+        "post_count": user.post_count,
+        "photo_count": user.photo_count
     }
 
+def serialize_user_profiles(users, viewer=None):
+    """
+    Serializes a page of user profiles without per-user queries.
+
+    The stats come from the denormalized User counters. If `viewer` is given, the
+    viewer's follow relationship with each user is resolved with one grouped query.
+
+    Args:
+        users (list[User]): The users to serialize, in display order.
+        viewer (User, optional): The user whose follow relationships should be reported.
+
+    Returns:
+        list[dict]: One `serialize_user_profile` dict per user, plus
+                    `is_followed_by_current_user` and `follows_current_user` when a
+                    viewer is given.
+    """
+    serialized_users = [serialize_user_profile(user) for user in users]
+    if viewer is None or not viewer.is_authenticated or not users:
+        return serialized_users
+
+    from sqlalchemy import or_, and_
+    from . import db
+    from .models import FollowerLink
+
+    user_ids = [user.id for user in users]
+    links = set(db.session.query(FollowerLink.follower_id, FollowerLink.followed_id).filter(or_(
+        and_(FollowerLink.follower_id == viewer.id, FollowerLink.followed_id.in_(user_ids)),
+        and_(FollowerLink.followed_id == viewer.id, FollowerLink.follower_id.in_(user_ids))
+    )))
+    for serialized_user in serialized_users:
+        serialized_user["is_followed_by_current_user"] = (viewer.id, serialized_user["id"]) in links
+        serialized_user["follows_current_user"] = (serialized_user["id"], viewer.id) in links
+    return serialized_users
+
 def serialize_comment_flag(flag):
     """
     Serializes a comment flag.
@@ -134,16 +279,126 @@ def serialize_comment_flag(flag):
         "is_resolved": flag.is_resolved
     }
 
-def serialize_notification(notification):
+def serialize_target_summary(target):
+    """
+    Serializes a compact, link-sized summary of an activity or notification target.
+    Only the target's own columns are read, so summarizing a page of targets doesn't
+    trigger relationship loads.
+    """
+    from .models import User
+    if target is None:
+        return None
+    if isinstance(target, Post):
+        return {
+            "type": "post",
+            "id": target.id,
+            "title": target.title,
+            "url": url_for('post.view_post', post_id=target.id, _external=True)
+        }
+    if isinstance(target, UserPhoto):
+        return {
+            "type": "photo",
+            "id": target.id,
+            "uploader_id": target.user_id,
+            "image_url": url_for('static', filename=target.image_filename, _external=True) if target.image_filename else None
+        }
+    if isinstance(target, Comment):
+        return {
+            "type": "comment",
+            "id": target.id,
+            "text_preview": target.excerpt,
+            "target_type": target.target_type,
+            "target_id": target.target_id
+        }
+    if isinstance(target, User):
+        summary = serialize_actor(target)
+        summary["type"] = "user"
+        return summary
+    return None
+
+def serialize_activities(activities):
     """
-    Serializes a notification.
+    Serializes a page of `Activity` rows, resolving their polymorphic targets in bulk.
+
+    Actors should already be loaded with the activities (e.g. via `contains_eager` or
+    `joinedload`). Targets are loaded with `resolve_targets`, one query per target model
+    present on the page, rather than one `get_target_object()` call per row.
+
+    Args:
+        activities (list[Activity]): The activities to serialize, in display order.
+
+    Returns:
+        list[dict]: One dict per activity. `target` is None if the target no longer exists.
     """
+    from .models import resolve_targets
+    targets = resolve_targets((activity.target_type, activity.target_id) for activity in activities)
+    return [{
+        "id": activity.id,
+        "type": activity.type,
+        "timestamp": activity.timestamp.isoformat(),
+        "actor": serialize_actor(activity.actor),
+        "target_type": activity.target_type,
+        "target_id": activity.target_id,
+        "target": serialize_target_summary(targets.get((activity.target_type, activity.target_id)))
+    } for activity in activities]
+
+def serialize_notification(notification, targets=None, is_read=None, actors=None):
+    """
+    Serializes a notification, including a compact summary of its target. A coalesced
+    notification ("Ana and 41 others liked your post") also has its `actor_count` and
+    its most recent `actors`, newest first; `actor` is the newest of them.
+
+    Args:
+        notification (Notification | BroadcastNotification): The notification to serialize.
+        targets (dict, optional): Pre-resolved targets from `resolve_targets`. When
+                                  omitted, the target is loaded on its own.
+        is_read (bool, optional): Read state from the viewer's read watermarks. A
+                                  notification is read if this or its is_read flag is set.
+        actors (dict, optional): Pre-loaded users by id for the recent actors. When
+                                 omitted, only `actor` is listed.
+    """
+    from .models import BroadcastNotification
+    if targets is None:
+        target = notification.get_target_object()
+    else:
+        target = targets.get((notification.target_type, notification.target_id))
+    is_broadcast = isinstance(notification, BroadcastNotification)
+    if is_broadcast or actors is None:
+        recent_actors = [notification.actor] if notification.actor is not None else []
+    else:
+        recent_actors = [actors[actor_id] for actor_id in notification.recent_actor_id_list if actor_id in actors]
     return {
         "id": notification.id,
         "actor": serialize_actor(notification.actor),
+        "actors": [serialize_actor(actor) for actor in recent_actors],
+        "actor_count": 1 if is_broadcast else notification.actor_count,
         "type": notification.type,
         "target_type": notification.target_type,
         "target_id": notification.target_id,
+        "target": serialize_target_summary(target),
         "timestamp": notification.timestamp.isoformat(),
-        "is_read": notification.is_read
+        "is_read": bool(is_read) if is_broadcast else bool(is_read or notification.is_read),
+        "is_broadcast": is_broadcast
     }
+
+def serialize_notifications(notifications, broadcast_read_id=0, notifications_read_id=0):
+    """
+    Serializes a page of notifications, resolving all of their targets with one query
+    per target model and the recent actors of coalesced ones with one more. Actors
+    should already be loaded (e.g. via `joinedload`). Broadcasts in the page are read
+    if their id is at most `broadcast_read_id`, and personal notifications if it's at
+    most `notifications_read_id`.
+    """
+    from .models import resolve_targets, BroadcastNotification, User
+    targets = resolve_targets((n.target_type, n.target_id) for n in notifications)
+    personal = [n for n in notifications if not isinstance(n, BroadcastNotification)]
+    actors = {n.actor.id: n.actor for n in personal if n.actor is not None}
+    missing_ids = {actor_id for n in personal for actor_id in n.recent_actor_id_list} - actors.keys()
+    if missing_ids:
+        actors.update((user.id, user) for user in User.query.filter(User.id.in_(missing_ids)))
+    return [
+        serialize_notification(n, targets=targets, actors=actors, is_read=n.id <= (
+            broadcast_read_id if isinstance(n, BroadcastNotification) else notifications_read_id
+        ))
+        for n in notifications
+    ]
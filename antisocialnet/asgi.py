@@ -0,0 +1,296 @@
+"""
+ASGI entry point, for serving the app with an async server:
+
+    uvicorn --factory antisocialnet.asgi:create_asgi_app --workers 4
+
+Most requests go to the regular Flask app through asgiref's WSGI bridge and behave
+exactly as under a WSGI server. Each runs on a thread of its own, at most
+ASGI_WSGI_THREADS at a time per process. The event loop reads request bodies first, so
+a slow upload holds no thread until it has fully arrived, and a body over
+MAX_CONTENT_LENGTH is refused with 413 before it is buffered.
+
+The long-lived notification endpoints run natively as coroutines (see `ASYNC_ROUTES`):
+the SSE stream, the long poll and the unread count. An idle stream is a suspended
+coroutine waiting on the `NotificationBroker`, so one process holds thousands of them.
+These endpoints authenticate from Flask's signed session cookie and query through an
+async session (`async_db`). Loading notification payloads shares the serializers of the
+sync API, so it runs on a worker thread for the few milliseconds it takes. A request
+they can't authenticate, e.g. one relying on a remember-me cookie, goes to the Flask
+view instead.
+
+Email and photo processing already run as background tasks (`tasks`), off the request
+path under either server.
+"""
+import asyncio
+import io
+import json
+import time
+from tempfile import SpooledTemporaryFile
+from urllib.parse import parse_qs
+
+from asgiref.sync import ThreadSensitiveContext, sync_to_async
+from asgiref.wsgi import WsgiToAsgi
+from flask.sessions import SecureCookieSessionInterface
+from itsdangerous import BadSignature
+from werkzeug.http import parse_cookie
+
+from . import create_app
+from .async_db import async_session, dispose_async_engine
+from .models import User, unread_notification_counts_async
+from .notification_stream import NotificationFeed, notification_broker, retry_frame, feed_frames, poll_result
+
+# (method, path) -> name of the AsgiApp coroutine handling it natively.
+ASYNC_ROUTES = {
+    ('GET', '/api/v1/notifications/stream'): 'notification_stream',
+    ('GET', '/api/v1/notifications/poll'): 'notification_poll',
+    ('GET', '/api/v1/notifications/unread-count'): 'notification_unread_count',
+}
+
+class AsgiApp:
+    """ASGI application serving `ASYNC_ROUTES` as coroutines and everything else through Flask."""
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.wsgi = WsgiToAsgi(flask_app)
+        self.wsgi_slots = asyncio.Semaphore(flask_app.config.get('ASGI_WSGI_THREADS', 32))
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            await send({'type': 'websocket.close'}) # No websocket endpoints
+            return
+        handler_name = ASYNC_ROUTES.get((scope['method'], _path_info(scope)))
+        if handler_name is not None:
+            user = await self._authenticate(scope)
+            if user is not None:
+                await getattr(self, handler_name)(scope, receive, send, user)
+                return
+        await self._call_flask(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await dispose_async_engine(self.flask_app)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _call_flask(self, scope, receive, send):
+        max_length = self.flask_app.config.get('MAX_CONTENT_LENGTH')
+        declared_length = _header(scope, b'content-length')
+        if max_length is not None and declared_length.isdigit() and int(declared_length) > max_length:
+            await _send_response(send, 413, b'Request Entity Too Large', b'text/plain')
+            return
+        with SpooledTemporaryFile(max_size=1024 * 1024) as body:
+            received = 0
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    return
+                chunk = message.get('body', b'')
+                received += len(chunk)
+                if max_length is not None and received > max_length:
+                    await _send_response(send, 413, b'Request Entity Too Large', b'text/plain')
+                    return
+                body.write(chunk)
+                if not message.get('more_body'):
+                    break
+            body.seek(0)
+
+            unread_bytes = received
+
+            async def replay_body():
+                nonlocal unread_bytes
+                if unread_bytes is None:
+                    return await receive() # Only a disconnect can follow
+                chunk = body.read(64 * 1024)
+                unread_bytes -= len(chunk)
+                more_body = unread_bytes > 0
+                if not more_body:
+                    unread_bytes = None
+                return {'type': 'http.request', 'body': chunk, 'more_body': more_body}
+
+            async with self.wsgi_slots:
+                # A context of its own gives the request its own thread; by default asgiref
+                # runs every bridged request on one shared thread.
+                async with ThreadSensitiveContext():
+                    await self.wsgi(scope, replay_body, send)
+
+    async def _authenticate(self, scope):
+        """Returns the user logged in by the request's Flask session cookie, or None."""
+        session_interface = self.flask_app.session_interface
+        if not isinstance(session_interface, SecureCookieSessionInterface):
+            return None
+        serializer = session_interface.get_signing_serializer(self.flask_app)
+        cookie = parse_cookie(_header(scope, b'cookie')).get(session_interface.get_cookie_name(self.flask_app))
+        if serializer is None or not cookie:
+            return None
+        try:
+            session_data = serializer.loads(
+                cookie, max_age=int(self.flask_app.permanent_session_lifetime.total_seconds())
+            )
+            user_id = int(session_data.get('_user_id'))
+        except (BadSignature, TypeError, ValueError):
+            return None
+        async with async_session(self.flask_app) as session:
+            return await session.get(User, user_id)
+
+    async def _load_feed(self, scope, feed):
+        # Payloads are built by the same serializers (and url_for) as the sync views.
+        def load():
+            with self.flask_app.request_context(_wsgi_environ(scope)):
+                return feed.load()
+        return await sync_to_async(load, thread_sensitive=False)()
+
+    async def notification_stream(self, scope, receive, send, user):
+        """Coroutine version of `notification_event_stream`: the SSE stream of one user."""
+        config = self.flask_app.config
+        heartbeat_seconds = config.get('NOTIFICATION_STREAM_HEARTBEAT_SECONDS', 15)
+        deadline = time.monotonic() + config.get('NOTIFICATION_STREAM_MAX_SECONDS', 300)
+        last_event_id = _header(scope, b'last-event-id') or _query_arg(scope, 'last_event_id')
+        feed = NotificationFeed(user.id, last_event_id)
+        with self.flask_app.app_context():
+            first_frame = retry_frame()
+
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream; charset=utf-8'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),
+        ]})
+        disconnected = asyncio.ensure_future(_wait_for_disconnect(receive))
+        notification_broker.subscribe(user.id, app=self.flask_app)
+        try:
+            await _send_chunk(send, first_frame)
+            version = notification_broker.version(user.id)
+            changed = True
+            last_frame_at = time.monotonic()
+            while True:
+                if changed:
+                    frames = feed_frames(feed, *await self._load_feed(scope, feed))
+                    if frames:
+                        await _send_chunk(send, ''.join(frames))
+                        last_frame_at = time.monotonic()
+                now = time.monotonic()
+                if now >= deadline:
+                    break
+                if now - last_frame_at >= heartbeat_seconds:
+                    await _send_chunk(send, ': heartbeat\n\n')
+                    last_frame_at = now
+                timeout = min(deadline, last_frame_at + heartbeat_seconds) - now
+                new_version = await _wait_unless_disconnected(
+                    notification_broker.wait_async(user.id, version, timeout), disconnected
+                )
+                if new_version is None:
+                    return # The client went away
+                changed, version = new_version != version, new_version
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            disconnected.cancel()
+            notification_broker.unsubscribe(user.id)
+
+    async def notification_poll(self, scope, receive, send, user):
+        """Coroutine version of `long_poll_notifications`."""
+        max_timeout = self.flask_app.config.get('NOTIFICATION_LONG_POLL_SECONDS', 25)
+        try:
+            timeout = max(0, min(float(_query_arg(scope, 'timeout')), max_timeout))
+        except (TypeError, ValueError):
+            timeout = max_timeout
+        deadline = time.monotonic() + timeout
+        feed = NotificationFeed(user.id, _query_arg(scope, 'cursor'))
+        disconnected = asyncio.ensure_future(_wait_for_disconnect(receive))
+        notification_broker.subscribe(user.id, app=self.flask_app)
+        try:
+            version = notification_broker.version(user.id)
+            notifications, unread = await self._load_feed(scope, feed)
+            while feed.resumed and not notifications and time.monotonic() < deadline:
+                new_version = await _wait_unless_disconnected(
+                    notification_broker.wait_async(user.id, version, deadline - time.monotonic()), disconnected
+                )
+                if new_version is None:
+                    return
+                if new_version == version:
+                    continue
+                version = new_version
+                notifications, changed_unread = await self._load_feed(scope, feed)
+                if changed_unread is not None:
+                    unread = changed_unread
+                    break
+        finally:
+            disconnected.cancel()
+            notification_broker.unsubscribe(user.id)
+        await _send_json(send, poll_result(feed, notifications, unread))
+
+    async def notification_unread_count(self, scope, receive, send, user):
+        """Coroutine version of the unread-count view, queried through the async session."""
+        async with async_session(self.flask_app) as session:
+            counts_by_type = await unread_notification_counts_async(session, user)
+        await _send_json(send, {'unread_count': sum(counts_by_type.values()), 'unread_by_type': counts_by_type})
+
+def create_asgi_app(config_name=None):
+    """Creates the Flask app and wraps it for ASGI servers (`uvicorn --factory`)."""
+    return AsgiApp(create_app(config_name))
+
+def _header(scope, name):
+    for header_name, value in scope.get('headers', ()):
+        if header_name == name:
+            return value.decode('latin-1')
+    return ''
+
+def _path_info(scope):
+    # ASGI paths include the root path; WSGI's PATH_INFO doesn't.
+    root_path = scope.get('root_path', '')
+    return scope['path'][len(root_path):] if root_path and scope['path'].startswith(root_path) else scope['path']
+
+def _query_arg(scope, name):
+    values = parse_qs(scope.get('query_string', b'').decode('latin-1')).get(name)
+    return values[0] if values else None
+
+def _wsgi_environ(scope):
+    """A body-less WSGI environ for `scope`, enough for a Flask request context."""
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': _path_info(scope),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(),
+    }
+    for name, value in scope.get('headers', ()):
+        key = name.decode('latin-1').upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = f'HTTP_{key}'
+        environ[key] = f"{environ[key]},{value.decode('latin-1')}" if key in environ else value.decode('latin-1')
+    return environ
+
+async def _wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+async def _wait_unless_disconnected(awaitable, disconnected):
+    """Returns the awaitable's result, or None (cancelling it) if the client disconnects first."""
+    waiting = asyncio.ensure_future(awaitable)
+    await asyncio.wait({waiting, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+    if not waiting.done():
+        waiting.cancel()
+        return None
+    return waiting.result()
+
+async def _send_chunk(send, text):
+    await send({'type': 'http.response.body', 'body': text.encode('utf-8'), 'more_body': True})
+
+async def _send_response(send, status, body, content_type):
+    await send({'type': 'http.response.start', 'status': status, 'headers': [
+        (b'content-type', content_type), (b'content-length', str(len(body)).encode('ascii')),
+    ]})
+    await send({'type': 'http.response.body', 'body': body})
+
+async def _send_json(send, data):
+    await _send_response(send, 200, json.dumps(data).encode('utf-8'), b'application/json')
@@ -0,0 +1,45 @@
+"""
+Async database access for coroutine request handlers (see `asgi`).
+
+`async_session(app)` opens an `AsyncSession` on a per-process async engine for the same
+database as Flask-SQLAlchemy's engine, through an asyncio driver: aiosqlite for SQLite,
+asyncpg for PostgreSQL, or whatever ASYNC_DATABASE_URI names. The models are the
+same; only code that awaits its queries should use it. Sync views keep using
+`db.session`.
+"""
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+# Async drivers for the sync drivers SQLALCHEMY_DATABASE_URI may name.
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'postgresql': 'postgresql+asyncpg',
+}
+
+def async_database_uri(app):
+    """Returns ASYNC_DATABASE_URI, or SQLALCHEMY_DATABASE_URI with its driver swapped for an async one."""
+    if app.config.get('ASYNC_DATABASE_URI'):
+        return app.config['ASYNC_DATABASE_URI']
+    url = make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver known for '{backend}' databases; set ASYNC_DATABASE_URI.")
+    return url.set(drivername=ASYNC_DRIVERS[backend]).render_as_string(hide_password=False)
+
+def _session_factory(app):
+    factory = app.extensions.get('async_db_sessions')
+    if factory is None:
+        engine = create_async_engine(async_database_uri(app), pool_pre_ping=True)
+        factory = async_sessionmaker(engine, expire_on_commit=False)
+        app.extensions['async_db_sessions'] = factory
+    return factory
+
+def async_session(app):
+    """Returns a new `AsyncSession` for `app`'s database; use it as `async with async_session(app) as session:`."""
+    return _session_factory(app)()
+
+async def dispose_async_engine(app):
+    """Closes the pooled async connections, e.g. on server shutdown."""
+    factory = app.extensions.pop('async_db_sessions', None)
+    if factory is not None:
+        await factory.kw['bind'].dispose()
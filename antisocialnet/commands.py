@@ -0,0 +1,116 @@
+import click
+from flask import current_app
+from flask.cli import AppGroup, with_appcontext
+
+feed_cli = AppGroup('feed', help='Maintain the materialized feed tables.')
+
+@feed_cli.command('backfill')
+def backfill_feed_command():
+    """Create feed_item rows for posts and photos that don't have one yet."""
+    from .models import backfill_feed_items
+    posts_inserted, photos_inserted = backfill_feed_items()
+    click.echo(f"Backfilled {posts_inserted} post(s) and {photos_inserted} photo(s) into feed_item.")
+
+@feed_cli.command('backfill-home')
+def backfill_home_command():
+    """Populate home timelines from existing follows."""
+    from .feed_utils import backfill_all_home_timelines
+    inserted = backfill_all_home_timelines()
+    click.echo(f"Inserted {inserted} home timeline row(s).")
+
+counters_cli = AppGroup('counters', help='Maintain denormalized counters.')
+
+@counters_cli.command('reconcile')
+@click.option('--dry-run', is_flag=True, help='Report drift without fixing it.')
+def reconcile_counters_command(dry_run):
+    """Recompute denormalized counters from their source tables and report drift."""
+    from .models import reconcile_counters
+    drift = reconcile_counters(fix=not dry_run)
+    for counter, drifted in drift.items():
+        click.echo(f"{counter}: {drifted} row(s) {'drifted' if dry_run else 'corrected'}.")
+    if not any(drift.values()):
+        click.echo("All counters are in sync.")
+
+content_cli = AppGroup('content', help='Maintain stored, rendered content.')
+
+@content_cli.command('rerender')
+@click.option('--all', 'force', is_flag=True, help='Re-render every row, not only outdated ones.')
+@click.option('--batch-size', default=500, show_default=True, help='Rows per committed batch.')
+def rerender_content_command(force, batch_size):
+    """Re-render stored HTML and excerpts after a renderer or sanitizer change."""
+    from .models import rerender_stored_content
+    rerendered = rerender_stored_content(force=force, batch_size=batch_size)
+    for table_name, count in rerendered.items():
+        click.echo(f"{table_name}: re-rendered {count} row(s).")
+
+search_cli = AppGroup('search', help='Maintain the full-text search index.')
+
+@search_cli.command('reindex')
+@click.option('--batch-size', default=1000, show_default=True, help='Rows per committed batch.')
+def reindex_search_command(batch_size):
+    """Rebuild the search index from all published posts and users."""
+    from .search_utils import rebuild_search_index
+    posts_indexed, users_indexed = rebuild_search_index(batch_size=batch_size)
+    click.echo(f"Indexed {posts_indexed} post(s) and {users_indexed} user(s).")
+
+notifications_cli = AppGroup('notifications', help='Maintain notifications.')
+
+@notifications_cli.command('resume-fan-out')
+def resume_fan_out_command():
+    """Finish follower notification fan-out jobs that were interrupted."""
+    from .notification_utils import resume_notification_fan_outs
+    resumed = resume_notification_fan_outs()
+    click.echo(f"Resumed {resumed} fan-out job(s).")
+
+@notifications_cli.command('prune')
+@click.option('--days', type=int, default=None, help='Retention in days (default: NOTIFICATION_RETENTION_DAYS).')
+def prune_notifications_command(days):
+    """Archive read notifications past the retention period to gzipped NDJSON files."""
+    from .notification_utils import prune_notifications
+    archived, dropped = prune_notifications(retention_days=days)
+    click.echo(f"Archived {archived} notification(s).")
+    for name in dropped:
+        click.echo(f"Dropped empty partition {name}.")
+
+jobs_cli = AppGroup('jobs', help='Inspect the database task queue.')
+
+@jobs_cli.command('status')
+def jobs_status_command():
+    """Show queued, running and dead-lettered job counts."""
+    from .worker import queue_stats
+    stats = queue_stats()
+    for status in ('queued', 'running', 'dead'):
+        click.echo(f"{status}: {stats['by_status'].get(status, 0)}")
+    for name, count in sorted(stats['dead_by_name'].items()):
+        click.echo(f"  dead {name}: {count}")
+
+@jobs_cli.command('requeue')
+@click.argument('job_ids', nargs=-1, type=int)
+def jobs_requeue_command(job_ids):
+    """Requeue dead-lettered jobs (all of them, or the given ids)."""
+    from .worker import requeue_dead_jobs
+    click.echo(f"Requeued {requeue_dead_jobs(job_ids)} job(s).")
+
+@click.command('worker')
+@click.option('--processes', type=int, default=None, help='Worker processes (default: TASK_WORKER_PROCESSES).')
+@click.option('--threads', type=int, default=None, help='Threads per process (default: TASK_WORKER_THREADS).')
+@click.option('--burst', is_flag=True, help='Exit once the queue is empty instead of waiting for jobs.')
+@with_appcontext
+def worker_command(processes, threads, burst):
+    """Run jobs queued in the database (TASK_BACKEND=database)."""
+    from .worker import run_workers
+    app = current_app._get_current_object()
+    processes = processes or app.config.get('TASK_WORKER_PROCESSES', 1)
+    threads = threads or app.config.get('TASK_WORKER_THREADS', 4)
+    click.echo(f"Starting {processes} worker process(es) with {threads} thread(s) each.")
+    run_workers(app, processes=processes, threads=threads, burst=burst)
+
+def init_app(app):
+    """Register the application's CLI command groups (`flask feed ...`, `flask counters ...`, `flask content ...`, `flask search ...`, `flask notifications ...`, `flask jobs ...`) and `flask worker`."""
+    app.cli.add_command(feed_cli)
+    app.cli.add_command(counters_cli)
+    app.cli.add_command(content_cli)
+    app.cli.add_command(search_cli)
+    app.cli.add_command(notifications_cli)
+    app.cli.add_command(jobs_cli)
+    app.cli.add_command(worker_command)
@@ -16,7 +16,56 @@ class Config:
     MAX_GALLERY_PHOTO_SIZE_BYTES = 5 * 1024 * 1024  # 5MB
     MAX_CONTENT_LENGTH = 10 * 1024 * 1024  # Max overall request size 10MB (increased for gallery)
     POSTS_PER_PAGE = 10 # Default, can be overridden by SiteSetting
+    FEED_MAX_PER_PAGE = 100 # Upper bound for the per_page query parameter on /api/v1/feed
     ACTIVITIES_PER_PAGE = 20 # For the new activity feed
+    # Home timeline fan-out: authors with more followers than this are merged in at read time instead of pushed
+    FANOUT_FOLLOWER_THRESHOLD = int(os.environ.get('FANOUT_FOLLOWER_THRESHOLD', 10000))
+    FANOUT_BATCH_SIZE = 1000 # Followers written per INSERT during fan-out
+    FANOUT_THRESHOLD_CACHE_SECONDS = 300 # How long the set of high-follower authors is cached per process
+    HOME_TIMELINE_BACKFILL_SIZE = 200 # Recent items copied into a timeline when following someone
+    MENTION_INDEX_TTL_SECONDS = 300 # Max age of the per-process mention index (other processes' renames show up after this)
+    TYPEAHEAD_INDEX_TTL_SECONDS = 600 # Background rebuild interval of the per-process typeahead index
+    TYPEAHEAD_MAX_SCAN = 5000 # Keys examined per typeahead lookup (bounds one- and two-letter prefixes)
+    LATEST_BROADCAST_TTL_SECONDS = 60 # How long a process trusts its cached newest broadcast id (for unread badges)
+    NOTIFICATION_COALESCE_WINDOW_SECONDS = 86400 # Likes/comments/follows within this of an unread group join it (0 disables)
+    NOTIFICATION_RECENT_ACTORS = 3 # Actors kept (and shown) per coalesced notification
+    # Read notifications older than this are moved to gzipped NDJSON files by `flask notifications prune`
+    NOTIFICATION_RETENTION_DAYS = int(os.environ.get('NOTIFICATION_RETENTION_DAYS', 90))
+    NOTIFICATION_ARCHIVE_DIR = os.environ.get('NOTIFICATION_ARCHIVE_DIR') # Defaults to <instance folder>/notification_archive
+    NOTIFICATION_PRUNE_BATCH_SIZE = 1000 # Notifications archived and deleted per transaction
+    NOTIFICATION_PARTITION_MONTHS_AHEAD = 2 # Monthly partitions created in advance (PostgreSQL)
+    # Live notifications (/api/v1/notifications/stream and /poll)
+    NOTIFICATION_STREAM_POLL_SECONDS = 1.0 # How often a process checks for changes made by other processes
+    NOTIFICATION_STREAM_HEARTBEAT_SECONDS = 15 # Idle streams get a comment frame this often
+    NOTIFICATION_STREAM_MAX_SECONDS = 300 # Streams end after this; the browser reconnects with Last-Event-ID
+    NOTIFICATION_STREAM_REPLAY_LIMIT = 100 # Page size when catching up on a resume or wake-up (every page is sent)
+    NOTIFICATION_LONG_POLL_SECONDS = 25 # Longest a /poll request waits for news
+    # ASGI entry point (antisocialnet.asgi): async driver URL, defaulting to SQLALCHEMY_DATABASE_URI with aiosqlite/asyncpg
+    ASYNC_DATABASE_URI = os.environ.get('ASYNC_DATABASE_URI')
+    ASGI_WSGI_THREADS = int(os.environ.get('ASGI_WSGI_THREADS', 32)) # Flask views run at once per ASGI process
+    # Production WSGI server (antisocialnet/gunicorn.conf.py)
+    WEB_BIND = os.environ.get('WEB_BIND', '127.0.0.1:8000')
+    WEB_WORKERS = int(os.environ.get('WEB_WORKERS', 2 * (os.cpu_count() or 1) + 1)) # Forked from one preloaded app
+    WEB_THREADS = int(os.environ.get('WEB_THREADS', 8)) # Request threads per worker (open notification streams hold one each)
+    # Write-behind like buffer: likes are acknowledged from memory and written in batches by a flusher thread
+    LIKE_BUFFER_ENABLED = os.environ.get('LIKE_BUFFER_ENABLED', 'false').lower() in ('true', '1', 'yes')
+    LIKE_BUFFER_FLUSH_INTERVAL_MS = 200 # Flush period, i.e. the normal bound on how long a like is only in memory
+    LIKE_BUFFER_MAX_PENDING = 10000 # Queued intents that force a synchronous flush (backpressure)
+    LIKE_BUFFER_COUNT_CACHE_SIZE = 10000 # Items whose stored like count is kept for optimistic answers
+    # Per-user Bloom filters that answer most "has the viewer liked this?" checks without a query
+    LIKE_FILTER_MEMORY_BYTES = 8 * 1024 * 1024 # Budget for all filters in a process; least recently used users are evicted
+    LIKE_FILTER_FALSE_POSITIVE_RATE = 0.01 # Target rate each filter is sized for
+    LIKE_FILTER_TTL_SECONDS = 3600 # Filters are rebuilt after this long
+    LIKE_FILTER_RESCAN_IDS = 1000 # Like ids below a filter's watermark re-checked per sync (ids can commit out of order)
+    TASK_WORKER_THREADS = int(os.environ.get('TASK_WORKER_THREADS', 4)) # Background task threads per process
+    # Background tasks: 'thread' runs them in-process; 'database' queues them in task_job for `flask worker`
+    TASK_BACKEND = os.environ.get('TASK_BACKEND', 'thread')
+    TASK_WORKER_PROCESSES = int(os.environ.get('TASK_WORKER_PROCESSES', 1)) # Default for `flask worker --processes`
+    TASK_WORKER_POLL_SECONDS = 1.0 # How often an idle worker thread looks for runnable jobs
+    TASK_LEASE_SECONDS = 300 # A claimed job is run again elsewhere if its worker hasn't finished by then
+    TASK_MAX_ATTEMPTS = 5 # Runs before a failing job is dead-lettered (tasks can override)
+    TASK_RETRY_BACKOFF_SECONDS = 10 # Delay before the first retry; doubles per attempt
+    TASK_RETRY_BACKOFF_MAX_SECONDS = 3600
     ALLOWED_THEMES = {'light', 'dark', 'system'}
 
     SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'antisocialnet.db')
@@ -83,6 +132,7 @@ class TestConfig(Config):
     SECRET_KEY = 'test-secret-key' # Explicit test secret key
     SERVER_NAME = 'localhost.test' # Added for url_for in tests
     MAIL_SUPPRESS_SEND = True # Do not send emails during tests
+    TASKS_RUN_INLINE = True # Run background tasks synchronously so tests can assert on their effects
     # Ensure UPLOAD_FOLDER and GALLERY_UPLOAD_FOLDER are set if needed by tests,
     # or rely on defaults from Config class if they are suitable.
     # They are defined in Config, so they will be inherited.
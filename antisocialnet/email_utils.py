@@ -1,13 +1,34 @@
-from flask import render_template, current_app, url_for
+from urllib.parse import urlsplit
+from flask import render_template, current_app, url_for, request, has_request_context
 from flask_mail import Message
-from . import mail # Assuming 'mail' will be the Flask-Mail instance from __init__.py
+from . import db, mail # Assuming 'mail' will be the Flask-Mail instance from __init__.py
+from .models import User
+from .tasks import task, enqueue
 
 def send_password_reset_email(user):
     """
-    Sends a password reset email to the user.
+    Queues a password reset email to the user. Only the user's id and the site's URL
+    are queued; the 'email.password_reset' task makes the token and link, so no live
+    reset link is stored in the job queue.
     """
+    enqueue('email.password_reset', user_id=user.id, base_url=request.host_url if has_request_context() else None)
+
+def _external_url(base_url, endpoint, **values):
+    """url_for(..., _external=True) outside a request: relative to `base_url`, or to SERVER_NAME if it's None."""
+    if base_url is None:
+        return url_for(endpoint, _external=True, **values)
+    parts = urlsplit(base_url)
+    adapter = current_app.url_map.bind(parts.netloc, script_name=parts.path or '/', url_scheme=parts.scheme)
+    return adapter.build(endpoint, values, force_external=True)
+
+@task('email.password_reset', priority=10, max_attempts=8)
+def send_password_reset(user_id, base_url=None):
+    """Makes a reset token for the user and emails them the link to use it."""
+    user = db.session.get(User, user_id)
+    if user is None:
+        return
     token = user.get_reset_password_token()
-    reset_url = url_for('auth.reset_password_with_token', token=token, _external=True)
+    reset_url = _external_url(base_url, 'auth.reset_password_with_token', token=token)
 
     # For now, email content will be basic. Could use templates later.
     subject = "Password Reset Request for Your App"
@@ -29,22 +50,23 @@ The Your App Team
     # HTML body example (optional)
     # html_body = render_template('email/reset_password.html', user=user, reset_url=reset_url)
 
+    send_email(subject, sender, recipients, text_body)
+
+@task('email.send', priority=10, max_attempts=8) # Users wait for these; SMTP hiccups are retried
+def send_email(subject, sender, recipients, text_body, html_body=None):
+    """
+    Sends an email. Runs as a background task, so a failure raises and is retried
+    rather than failing the request that asked for the email.
+    """
     msg = Message(subject=subject, sender=sender, recipients=recipients)
     msg.body = text_body
-    # msg.html = html_body # Uncomment if using HTML emails
-
-    try:
-        if current_app.config.get('MAIL_SUPPRESS_SEND', False):
-            current_app.logger.info(f"Email sending suppressed. Would send to: {user.username}") # Changed to username
-            current_app.logger.info(f"Email subject: {subject}")
-            current_app.logger.info(f"Email body:\n{text_body}")
-            current_app.logger.info(f"Reset URL would be: {reset_url}") # Log the URL for testing
-        else:
-            mail.send(msg)
-            current_app.logger.info(f"Password reset email sent to {user.username}") # Changed to username
-    except Exception as e:
-        current_app.logger.error(f"Failed to send password reset email to {user.username}: {e}", exc_info=True) # Changed to username
-        # Depending on app's needs, you might re-raise or handle silently
-        # For now, log and continue. The user won't get the email if this fails.
-        # Consider a fallback or user notification if email system is critical and fails.
-        pass # Or raise e to make the failure more visible in logs if not suppressed
+    if html_body:
+        msg.html = html_body
+
+    if current_app.config.get('MAIL_SUPPRESS_SEND', False):
+        current_app.logger.info(f"Email sending suppressed. Would send to: {', '.join(recipients)}")
+        current_app.logger.info(f"Email subject: {subject}")
+        current_app.logger.info(f"Email body:\n{text_body}")
+        return
+    mail.send(msg)
+    current_app.logger.info(f"Email '{subject}' sent to {', '.join(recipients)}")
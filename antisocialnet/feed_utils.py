@@ -0,0 +1,204 @@
+"""
+Home ("following") timeline maintenance and reads.
+
+The timeline uses hybrid fan-out. When an author publishes, a background task pushes
+the item into each follower's `home_timeline`. Authors with more than
+FANOUT_FOLLOWER_THRESHOLD followers are skipped; their items are merged in from
+`feed_item` when a follower reads the timeline. One post by a very popular account
+therefore doesn't turn into millions of writes, and a read stays O(page size) no
+matter how many accounts the reader follows.
+"""
+import threading
+import time
+from flask import current_app
+from sqlalchemy import select, delete, func
+
+from . import db
+from .models import FeedItem, HomeTimeline, FollowerLink, User
+from .tasks import task
+
+_high_follower_cache = {'expires_at': 0.0, 'threshold': None, 'ids': frozenset()}
+_high_follower_lock = threading.Lock()
+
+def high_follower_author_ids():
+    """
+    Returns the ids of users with more than FANOUT_FOLLOWER_THRESHOLD followers.
+
+    Both the fan-out (to skip pushing) and the timeline read (to pull instead) use this
+    set, so it's cached per process for FANOUT_THRESHOLD_CACHE_SECONDS to keep both
+    sides in agreement between reads of the indexed `User.follower_count` counter.
+    """
+    threshold = current_app.config.get('FANOUT_FOLLOWER_THRESHOLD', 10000)
+    now = time.monotonic()
+    with _high_follower_lock:
+        if _high_follower_cache['threshold'] == threshold and _high_follower_cache['expires_at'] > now:
+            return _high_follower_cache['ids']
+
+    ids = frozenset(db.session.scalars(select(User.id).where(User.follower_count > threshold)))
+    with _high_follower_lock:
+        _high_follower_cache.update(
+            ids=ids,
+            threshold=threshold,
+            expires_at=now + current_app.config.get('FANOUT_THRESHOLD_CACHE_SECONDS', 300)
+        )
+    return ids
+
+@task('feed.fan_out_item')
+def fan_out_feed_item(item_type, item_id):
+    """
+    Pushes a newly published post or photo into its author's followers' home timelines.
+
+    Followers are streamed in id order, FANOUT_BATCH_SIZE at a time, and each batch is
+    written with a single INSERT ... SELECT and committed on its own. Rows that already
+    exist are skipped, so re-running the task after an interruption is safe.
+
+    Returns:
+        int: The number of timeline rows inserted.
+    """
+    feed_item = FeedItem.query.filter_by(item_type=item_type, item_id=item_id).first()
+    if feed_item is None or feed_item.visibility != FeedItem.VISIBILITY_PUBLIC:
+        return 0
+    if feed_item.author_id in high_follower_author_ids():
+        return 0 # Merged into followers' timelines at read time instead.
+
+    batch_size = current_app.config.get('FANOUT_BATCH_SIZE', 1000)
+    timeline_columns = ['user_id', 'feed_item_id', 'author_id', 'ts']
+    last_follower_id = 0
+    inserted = 0
+    while True:
+        follower_ids = db.session.scalars(
+            select(FollowerLink.follower_id)
+            .where(FollowerLink.followed_id == feed_item.author_id, FollowerLink.follower_id > last_follower_id)
+            .order_by(FollowerLink.follower_id)
+            .limit(batch_size)
+        ).all()
+        if not follower_ids:
+            break
+
+        batch_rows = select(
+            FollowerLink.follower_id, db.literal(feed_item.id), db.literal(feed_item.author_id), db.literal(feed_item.ts)
+        ).where(
+            FollowerLink.followed_id == feed_item.author_id,
+            FollowerLink.follower_id > last_follower_id,
+            FollowerLink.follower_id <= follower_ids[-1],
+            ~select(HomeTimeline.id).where(
+                HomeTimeline.user_id == FollowerLink.follower_id,
+                HomeTimeline.feed_item_id == feed_item.id
+            ).exists()
+        )
+        inserted += db.session.execute(
+            HomeTimeline.__table__.insert().from_select(timeline_columns, batch_rows)
+        ).rowcount
+        db.session.commit()
+        last_follower_id = follower_ids[-1]
+
+    current_app.logger.info(f"Fan-out of {item_type} {item_id} pushed {inserted} home timeline row(s).")
+    return inserted
+
+@task('feed.backfill_home_timeline', priority=5) # The user just followed and is waiting to see posts
+def backfill_home_timeline(user_id, followed_id):
+    """
+    Copies the most recent HOME_TIMELINE_BACKFILL_SIZE public items by `followed_id` into
+    `user_id`'s home timeline, so a new follow shows up immediately rather than only for
+    future posts. High-follower authors are skipped since they're merged at read time.
+
+    Returns:
+        int: The number of timeline rows inserted.
+    """
+    if followed_id in high_follower_author_ids():
+        return 0
+    still_following = db.session.scalar(
+        select(func.count()).select_from(FollowerLink)
+        .where(FollowerLink.follower_id == user_id, FollowerLink.followed_id == followed_id)
+    )
+    if not still_following:
+        return 0 # Unfollowed before the task ran.
+
+    recent_items = select(FeedItem.id, FeedItem.author_id, FeedItem.ts).where(
+        FeedItem.author_id == followed_id,
+        FeedItem.visibility == FeedItem.VISIBILITY_PUBLIC
+    ).order_by(FeedItem.ts.desc(), FeedItem.id.desc()).limit(
+        current_app.config.get('HOME_TIMELINE_BACKFILL_SIZE', 200)
+    ).subquery()
+    rows = select(db.literal(user_id), recent_items.c.id, recent_items.c.author_id, recent_items.c.ts).where(
+        ~select(HomeTimeline.id).where(
+            HomeTimeline.user_id == user_id,
+            HomeTimeline.feed_item_id == recent_items.c.id
+        ).exists()
+    )
+    inserted = db.session.execute(
+        HomeTimeline.__table__.insert().from_select(['user_id', 'feed_item_id', 'author_id', 'ts'], rows)
+    ).rowcount
+    db.session.commit()
+    return inserted
+
+def purge_home_timeline(user_id, author_id):
+    """
+    Removes everything by `author_id` from `user_id`'s home timeline, e.g. on unfollow.
+    The caller is responsible for committing the session.
+    """
+    db.session.execute(delete(HomeTimeline).where(
+        HomeTimeline.user_id == user_id,
+        HomeTimeline.author_id == author_id
+    ))
+
+def home_timeline_rows(user, limit, cursor=None):
+    """
+    Reads one page of a user's home timeline, newest first.
+
+    Pushed rows come from `home_timeline`. Items by followed high-follower authors are
+    read from `feed_item` with the same keyset and merged in, so the page is bounded by
+    two index range scans of at most `limit` rows each.
+
+    Args:
+        user (User): The timeline owner.
+        limit (int): Maximum number of rows to return.
+        cursor (tuple, optional): (ts, feed_item_id) of the last row of the previous page.
+
+    Returns:
+        list: Rows with `id` (feed_item id), `ts`, `item_type` and `item_id` attributes.
+    """
+    from .api_utils import keyset_before
+
+    pushed_query = db.session.query(FeedItem.id, FeedItem.ts, FeedItem.item_type, FeedItem.item_id)\
+                             .join(HomeTimeline, HomeTimeline.feed_item_id == FeedItem.id)\
+                             .filter(HomeTimeline.user_id == user.id,
+                                     FeedItem.visibility == FeedItem.VISIBILITY_PUBLIC)
+    if cursor:
+        pushed_query = pushed_query.filter(keyset_before(HomeTimeline.ts, HomeTimeline.feed_item_id, *cursor))
+    rows = pushed_query.order_by(HomeTimeline.ts.desc(), HomeTimeline.feed_item_id.desc()).limit(limit).all()
+
+    high_follower_ids = high_follower_author_ids()
+    pulled_author_ids = []
+    if high_follower_ids:
+        pulled_author_ids = db.session.scalars(
+            select(FollowerLink.followed_id).where(
+                FollowerLink.follower_id == user.id,
+                FollowerLink.followed_id.in_(high_follower_ids)
+            )
+        ).all()
+    if not pulled_author_ids:
+        return rows
+
+    pulled_query = db.session.query(FeedItem.id, FeedItem.ts, FeedItem.item_type, FeedItem.item_id)\
+                             .filter(FeedItem.author_id.in_(pulled_author_ids),
+                                     FeedItem.visibility == FeedItem.VISIBILITY_PUBLIC)
+    if cursor:
+        pulled_query = pulled_query.filter(keyset_before(FeedItem.ts, FeedItem.id, *cursor))
+    pulled_rows = pulled_query.order_by(FeedItem.ts.desc(), FeedItem.id.desc()).limit(limit).all()
+
+    # An author who crossed the threshold may still have older pushed rows; dedupe by id.
+    merged = {row.id: row for row in rows}
+    merged.update({row.id: row for row in pulled_rows})
+    return sorted(merged.values(), key=lambda row: (row.ts, row.id), reverse=True)[:limit]
+
+def backfill_all_home_timelines():
+    """
+    Runs `backfill_home_timeline` for every existing follow, e.g. after upgrading to a
+    version with home timelines. Safe to run repeatedly.
+
+    Returns:
+        int: The total number of timeline rows inserted.
+    """
+    links = db.session.execute(select(FollowerLink.follower_id, FollowerLink.followed_id)).all()
+    return sum(backfill_home_timeline(follower_id, followed_id) for follower_id, followed_id in links)
@@ -0,0 +1,32 @@
+"""
+gunicorn settings for `antisocialnet.wsgi`. Run from the repository root:
+
+    gunicorn -c antisocialnet/gunicorn.conf.py
+
+The app is loaded once in the master and the workers are forked from it (see `wsgi`).
+Bind address, worker count and threads per worker come from the app's config
+(WEB_BIND, WEB_WORKERS, WEB_THREADS), so they can be set through the environment.
+"""
+import gc
+import os
+
+from antisocialnet.config import config_by_name, ProductionConfig
+
+# Until `wsgi` freezes the loaded app, collections in the master would only leave freed
+# holes in pages the workers are about to share.
+gc.disable()
+
+_config = config_by_name.get(os.environ.get('FLASK_ENV', 'production'), ProductionConfig)
+
+wsgi_app = 'antisocialnet.wsgi:app'
+preload_app = True
+bind = _config.WEB_BIND
+workers = _config.WEB_WORKERS
+threads = _config.WEB_THREADS
+
+def post_fork(server, worker):
+    gc.enable()
+    from antisocialnet import db
+    from antisocialnet.wsgi import app
+    with app.app_context():
+        db.engine.dispose(close=False) # Don't share connections the master may have opened
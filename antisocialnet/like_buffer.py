@@ -0,0 +1,211 @@
+"""
+Optional write-behind buffer for likes (LIKE_BUFFER_ENABLED).
+
+During a spike every like on a popular item is its own transaction updating the same
+counter row. With the buffer enabled, the like endpoint only records the intent in
+process memory and answers with an optimistic count. A background flusher wakes every
+LIKE_BUFFER_FLUSH_INTERVAL_MS, coalesces the intents (a user's repeated or
+contradicting clicks on one item collapse to the last one) and writes them with
+`models.write_like_batch`: a few multi-row statements and one counter update per item,
+in a single transaction.
+
+Durability: intents live only in this process until flushed, so a crash loses at most
+one interval's worth. The queue is bounded by LIKE_BUFFER_MAX_PENDING; when it's full
+the request that hits the bound flushes synchronously. Pending intents are also flushed
+at interpreter exit. Queue depth, the age of the oldest unflushed intent (the current
+durability lag) and flush latency are reported by `LikeBuffer.stats()`.
+
+The buffer is per process; with several workers each flushes its own intents, and the
+counters stay exact since they're adjusted by the rows each batch actually changed.
+"""
+import atexit
+import os
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app
+
+from . import db
+from .models import read_like_counts, write_like_batch
+from .notification_utils import schedule_like_notifications
+
+class LikeBuffer:
+    """Process-local queue of like/unlike intents with a periodic group-commit flusher."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._intents = {} # (user_id, target_type, target_id) -> liked
+        self._pending_deltas = {} # (target_type, target_id) -> optimistic net change of _intents
+        self._in_flight = {} # intents being written by the current flush
+        self._in_flight_deltas = {}
+        self._oldest_intent_at = None
+        self._known_counts = OrderedDict() # (target_type, target_id) -> stored like_count when last read
+        self._flusher_pid = None
+        self._exit_flush_app = None # Set once the exit flush is registered
+        self._metrics = {
+            'recorded': 0,
+            'coalesced': 0,
+            'flushes': 0,
+            'flush_failures': 0,
+            'rows_flushed': 0,
+            'last_flush_ms': 0.0,
+            'max_flush_ms': 0.0,
+            'total_flush_ms': 0.0,
+        }
+
+    def record(self, user_id, target_type, target_id, liked):
+        """
+        Queues a like (or unlike) and returns the optimistic like count to show: the
+        stored count plus the net effect of this process's unflushed intents. The user's
+        previous state isn't read, so a like of an already-liked item is counted until the
+        next flush corrects it.
+
+        Returns:
+            int or None: The optimistic like count, or None if the item doesn't exist.
+
+        Raises:
+            ValueError: If `target_type` can't be liked.
+        """
+        app = current_app._get_current_object()
+        target = (target_type, target_id)
+        with self._lock:
+            base_count = self._known_counts.get(target)
+        if base_count is None:
+            base_count = read_like_counts([target]).get(target)
+            if base_count is None:
+                return None
+            self._remember_counts({target: base_count}, app)
+
+        key = (user_id, target_type, target_id)
+        with self._lock:
+            previous = self._intents.get(key, self._in_flight.get(key))
+            if key in self._intents:
+                self._metrics['coalesced'] += 1
+            if previous is None or previous != liked:
+                delta = 1 if liked else -1
+                self._pending_deltas[target] = self._pending_deltas.get(target, 0) + delta
+            self._intents[key] = liked
+            self._metrics['recorded'] += 1
+            if self._oldest_intent_at is None:
+                self._oldest_intent_at = time.monotonic()
+            queue_depth = len(self._intents)
+            like_count = max(0, self._known_counts.get(target, base_count)
+                             + self._in_flight_deltas.get(target, 0) + self._pending_deltas.get(target, 0))
+
+        if app.config.get('TASKS_RUN_INLINE', False) or queue_depth >= app.config.get('LIKE_BUFFER_MAX_PENDING', 10000):
+            self.flush() # Tests stay deterministic; a full queue applies backpressure.
+        else:
+            self._ensure_flusher(app)
+        return like_count
+
+    def pending_state(self, user_id, target_type, target_id):
+        """Returns the unflushed liked/unliked state of a user's like, or None if there's none."""
+        key = (user_id, target_type, target_id)
+        with self._lock:
+            return self._intents.get(key, self._in_flight.get(key))
+
+    def flush(self):
+        """
+        Writes all queued intents in one transaction. On failure they're put back (behind
+        any newer intents for the same like) for the next flush.
+
+        Returns:
+            int: The number of intents written.
+        """
+        with self._flush_lock:
+            with self._lock:
+                if not self._intents:
+                    return 0
+                self._in_flight, self._intents = self._intents, {}
+                self._in_flight_deltas, self._pending_deltas = self._pending_deltas, {}
+                oldest_intent_at, self._oldest_intent_at = self._oldest_intent_at, None
+                in_flight = self._in_flight
+
+            started = time.perf_counter()
+            inserted = []
+            try:
+                # A transaction of its own: a flush forced mid-request must not commit (or
+                # roll back) what that request has pending in its session.
+                with db.engine.begin() as connection:
+                    counts = write_like_batch(
+                        [key for key, liked in in_flight.items() if liked],
+                        [key for key, liked in in_flight.items() if not liked],
+                        inserted=inserted, connection=connection
+                    )
+            except Exception as e:
+                with self._lock:
+                    for key, liked in in_flight.items():
+                        self._intents.setdefault(key, liked)
+                    for target, delta in self._in_flight_deltas.items():
+                        self._pending_deltas[target] = self._pending_deltas.get(target, 0) + delta
+                    self._in_flight, self._in_flight_deltas = {}, {}
+                    self._oldest_intent_at = min(filter(None, (oldest_intent_at, self._oldest_intent_at)), default=None)
+                    self._metrics['flush_failures'] += 1
+                current_app.logger.error(f"Flushing {len(in_flight)} buffered like(s) failed: {e}", exc_info=True)
+                return 0
+
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self._remember_counts(counts, current_app._get_current_object())
+            schedule_like_notifications(inserted)
+            with self._lock:
+                self._in_flight, self._in_flight_deltas = {}, {}
+                self._metrics['flushes'] += 1
+                self._metrics['rows_flushed'] += len(in_flight)
+                self._metrics['last_flush_ms'] = elapsed_ms
+                self._metrics['max_flush_ms'] = max(self._metrics['max_flush_ms'], elapsed_ms)
+                self._metrics['total_flush_ms'] += elapsed_ms
+            return len(in_flight)
+
+    def stats(self):
+        """Returns queue depth, durability lag and flush latency metrics for this process."""
+        with self._lock:
+            metrics = dict(self._metrics)
+            metrics['queue_depth'] = len(self._intents)
+            metrics['in_flight'] = len(self._in_flight)
+            metrics['oldest_pending_age_ms'] = (
+                (time.monotonic() - self._oldest_intent_at) * 1000 if self._oldest_intent_at is not None else 0.0
+            )
+        metrics['avg_flush_ms'] = metrics['total_flush_ms'] / metrics['flushes'] if metrics['flushes'] else 0.0
+        metrics['flusher_running'] = self._flusher_pid == os.getpid()
+        return metrics
+
+    def _remember_counts(self, counts, app):
+        limit = app.config.get('LIKE_BUFFER_COUNT_CACHE_SIZE', 10000)
+        with self._lock:
+            for target, like_count in counts.items():
+                self._known_counts[target] = like_count
+                self._known_counts.move_to_end(target)
+            while len(self._known_counts) > limit:
+                self._known_counts.popitem(last=False)
+
+    def _ensure_flusher(self, app):
+        # Started lazily, and again in a forked worker, whose copy of the thread is gone.
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+            # Forked workers inherit the registration, which flushes their own queue.
+            register_exit_flush = self._exit_flush_app is None
+            self._exit_flush_app = app
+        threading.Thread(
+            target=self._run_flusher, args=(app,), name='antisocialnet-like-flusher', daemon=True
+        ).start()
+        if register_exit_flush:
+            atexit.register(self._flush_at_exit)
+
+    def _run_flusher(self, app):
+        interval = app.config.get('LIKE_BUFFER_FLUSH_INTERVAL_MS', 200) / 1000
+        while True:
+            time.sleep(interval)
+            with app.app_context():
+                try:
+                    self.flush()
+                except Exception as e: # pragma: no cover - flush() already logs and re-queues
+                    app.logger.error(f"Like buffer flusher error: {e}", exc_info=True)
+
+    def _flush_at_exit(self):
+        with self._exit_flush_app.app_context():
+            self.flush()
+
+like_buffer = LikeBuffer()
@@ -0,0 +1,198 @@
+"""
+Per-user Bloom filters answering "has this user liked this item?" without a query.
+
+Most items shown to a viewer (feed, comments, like details) aren't liked by them, so
+`User.has_liked_item` first asks the viewer's filter: "no" is definite, and only a
+"maybe" is checked against the `like` table. Each filter is sized for its user's like
+count at LIKE_FILTER_FALSE_POSITIVE_RATE and built lazily with one query.
+
+Filters only ever gain bits. A like made by this process sets its bits right away; an
+unlike leaves them set, which can only cause a false positive (checked in the database).
+Likes made by other processes are picked up by a catch-up query, run at most once per
+request per user, for like ids above the filter's watermark less LIKE_FILTER_RESCAN_IDS.
+Ids are allocated before commit, so on PostgreSQL a like can become visible after one
+with a higher id; re-scanning that window below the watermark picks it up. A filter is
+rebuilt when it fills beyond its capacity, after many unlikes, or after
+LIKE_FILTER_TTL_SECONDS. (Like ids must not be reused: SQLite can reuse the highest
+deleted rowid, so with several processes on SQLite another process's like can be missed
+until the TTL rebuild.)
+
+All filters together stay under LIKE_FILTER_MEMORY_BYTES by evicting the least
+recently used users.
+"""
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app, g, has_app_context
+from sqlalchemy import select
+
+from . import db
+
+class UserLikeFilter:
+    """Bloom filter over one user's liked (target_type, target_id) pairs."""
+
+    def __init__(self, capacity, false_positive_rate):
+        self.capacity = max(64, capacity)
+        self.num_bits = max(64, math.ceil(-self.capacity * math.log(false_positive_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / self.capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.added = 0
+        self.removed = 0
+        self.watermark = 0 # Highest like id seen
+        self.built_at = time.monotonic()
+
+    @property
+    def size_bytes(self):
+        return len(self.bits)
+
+    def _positions(self, target_type, target_id):
+        digest = hashlib.blake2b(f'{target_type}:{target_id}'.encode('utf-8'), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return ((first + index * second) % self.num_bits for index in range(self.num_hashes))
+
+    def add(self, target_type, target_id):
+        for position in self._positions(target_type, target_id):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.added += 1
+
+    def might_contain(self, target_type, target_id):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(target_type, target_id))
+
+    def is_saturated(self):
+        """True once false positives would exceed the configured rate noticeably."""
+        return self.added > self.capacity or self.removed > self.capacity // 2
+
+class LikeFilterCache:
+    """LRU of `UserLikeFilter`s within a fixed memory budget, with hit/false-positive stats."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._filters = OrderedDict() # user_id -> UserLikeFilter
+        self._memory_bytes = 0
+        self._metrics = {
+            'checks': 0,
+            'definite_negatives': 0,
+            'maybes': 0,
+            'false_positives': 0,
+            'builds': 0,
+            'syncs': 0,
+            'evictions': 0,
+        }
+
+    def has_liked(self, user_id, target_type, target_id, query_database):
+        """
+        Answers from the user's filter when it says "no", otherwise calls
+        `query_database()` (which must return a bool) and records whether the filter's
+        "maybe" was a false positive.
+        """
+        like_filter = self._filter_for(user_id)
+        with self._lock:
+            self._metrics['checks'] += 1
+            if like_filter is not None and not like_filter.might_contain(target_type, target_id):
+                self._metrics['definite_negatives'] += 1
+                return False
+            self._metrics['maybes'] += 1
+        liked = query_database()
+        if not liked:
+            with self._lock:
+                self._metrics['false_positives'] += 1
+        return liked
+
+    def add(self, user_id, target_type, target_id):
+        """Records a like made by this process in the user's filter, if it's cached."""
+        with self._lock:
+            like_filter = self._filters.get(user_id)
+            if like_filter is not None:
+                like_filter.add(target_type, target_id)
+
+    def note_unlike(self, user_id):
+        with self._lock:
+            like_filter = self._filters.get(user_id)
+            if like_filter is not None:
+                like_filter.removed += 1
+
+    def invalidate(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                self._filters.clear()
+                self._memory_bytes = 0
+            elif user_id in self._filters:
+                self._memory_bytes -= self._filters.pop(user_id).size_bytes
+
+    def stats(self):
+        with self._lock:
+            metrics = dict(self._metrics)
+            metrics['users_cached'] = len(self._filters)
+            metrics['memory_bytes'] = self._memory_bytes
+        metrics['memory_budget_bytes'] = current_app.config.get('LIKE_FILTER_MEMORY_BYTES', 8 * 1024 * 1024)
+        # Share of checks answered without a query, and share of not-liked items the filter
+        # couldn't rule out (the classic Bloom false-positive rate).
+        metrics['hit_rate'] = metrics['definite_negatives'] / metrics['checks'] if metrics['checks'] else 0.0
+        negatives = metrics['definite_negatives'] + metrics['false_positives']
+        metrics['false_positive_rate'] = metrics['false_positives'] / negatives if negatives else 0.0
+        return metrics
+
+    def _filter_for(self, user_id):
+        if not has_app_context():
+            return None
+        config = current_app.config
+        with self._lock:
+            like_filter = self._filters.get(user_id)
+            if like_filter is not None:
+                self._filters.move_to_end(user_id)
+                expired = time.monotonic() - like_filter.built_at > config.get('LIKE_FILTER_TTL_SECONDS', 3600)
+                if expired or like_filter.is_saturated():
+                    self._memory_bytes -= self._filters.pop(user_id).size_bytes
+                    like_filter = None
+
+        synced_users = g.setdefault('_like_filter_synced_users', set())
+        if like_filter is None:
+            like_filter = self._build(user_id, config)
+        elif user_id not in synced_users:
+            self._sync(like_filter, user_id)
+        synced_users.add(user_id)
+        return like_filter
+
+    @staticmethod
+    def _new_likes(user_id, after_id):
+        from .models import Like # Local import to avoid circular dependency
+        return db.session.execute(
+            select(Like.id, Like.target_type, Like.target_id).where(Like.user_id == user_id, Like.id > after_id)
+        ).all()
+
+    def _sync(self, like_filter, user_id):
+        rescan_ids = current_app.config.get('LIKE_FILTER_RESCAN_IDS', 1000)
+        rows = self._new_likes(user_id, like_filter.watermark - rescan_ids)
+        with self._lock:
+            for like_id, target_type, target_id in rows:
+                # Re-scanned likes are mostly in the filter already; don't count them twice
+                if not like_filter.might_contain(target_type, target_id):
+                    like_filter.add(target_type, target_id)
+                like_filter.watermark = max(like_filter.watermark, like_id)
+            self._metrics['syncs'] += 1
+
+    def _build(self, user_id, config):
+        rows = self._new_likes(user_id, 0)
+        like_filter = UserLikeFilter(2 * len(rows), config.get('LIKE_FILTER_FALSE_POSITIVE_RATE', 0.01))
+        for like_id, target_type, target_id in rows:
+            like_filter.add(target_type, target_id)
+            like_filter.watermark = max(like_filter.watermark, like_id)
+        like_filter.added = len(rows)
+
+        budget = config.get('LIKE_FILTER_MEMORY_BYTES', 8 * 1024 * 1024)
+        with self._lock:
+            previous = self._filters.pop(user_id, None)
+            if previous is not None:
+                self._memory_bytes -= previous.size_bytes
+            self._filters[user_id] = like_filter
+            self._memory_bytes += like_filter.size_bytes
+            while self._memory_bytes > budget and len(self._filters) > 1:
+                _, evicted = self._filters.popitem(last=False)
+                self._memory_bytes -= evicted.size_bytes
+                self._metrics['evictions'] += 1
+            self._metrics['builds'] += 1
+        return like_filter
+
+like_filter_cache = LikeFilterCache()
@@ -0,0 +1,237 @@
+"""
+Resolution of @FullName mentions to users.
+
+Rendering linkifies mentions on every page view, so names are resolved against a
+process-local index from lowercased full name to user ids instead of one
+`lower(full_name) = ...` query per mention. The index is built lazily with a single
+query and kept correct within the process by per-name invalidation when a user is
+created, renamed or deleted (applied on commit). Other processes' changes are picked
+up when the index expires after MENTION_INDEX_TTL_SECONDS.
+
+Lookups for names whose entry has been invalidated, or for everything while another
+thread is (re)building the index, fall back to one batched IN query.
+
+Resolved mentions are baked into stored HTML and recorded in `content_mention` at write
+time, unresolved ones included. When a name is added, renamed or removed,
+`schedule_mention_relink` queues a background re-render of the content that mentions
+it, found through content_mention by user id or by name.
+"""
+import threading
+import time
+from flask import current_app
+from sqlalchemy import select, func, or_
+from sqlalchemy.orm import Session
+
+from . import db
+from .models import User, Post, UserPhoto, Comment, ContentMention, rerender_matching_content
+from .tasks import task, enqueue
+
+class MentionIndex:
+    """Process-local map of lowercased full name to the ids of users with that name."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._names = None # dict: lowercased full name -> tuple of user ids
+        self._stale_names = set()
+        self._expires_at = 0.0
+
+    def invalidate(self, names=None):
+        """
+        Marks the given full names as stale, or the whole index if `names` is None.
+        Stale names are re-resolved with a query on their next lookup.
+        """
+        with self._lock:
+            if names is None:
+                self._names = None
+            else:
+                self._stale_names.update(name.lower() for name in names if name)
+
+    def resolve(self, names, connection=None):
+        """
+        Resolves full names to user ids.
+
+        Args:
+            names (iterable[str]): Full names as written in the mentions (any case).
+            connection (Connection, optional): Connection for any queries, e.g. when
+                                               resolving from inside a flush.
+
+        Returns:
+            dict: Maps each lowercased name to a tuple of the ids of users with that full
+                  name. A tuple of length one means the mention is unambiguous.
+        """
+        lowered_names = {' '.join(name.split()).lower() for name in names if name}
+        if not lowered_names:
+            return {}
+
+        index = self._current_index(connection)
+        if index is None:
+            return self._query(lowered_names, connection)
+
+        with self._lock:
+            stale_names = lowered_names & self._stale_names
+        resolved = {name: index.get(name, ()) for name in lowered_names - stale_names}
+        if stale_names:
+            refreshed = self._query(stale_names, connection)
+            with self._lock:
+                if self._names is index:
+                    for name in stale_names:
+                        if refreshed[name]:
+                            index[name] = refreshed[name]
+                        else:
+                            index.pop(name, None)
+                    self._stale_names -= stale_names
+            resolved.update(refreshed)
+        return resolved
+
+    def _current_index(self, connection=None):
+        now = time.monotonic()
+        with self._lock:
+            if self._names is not None and self._expires_at > now:
+                return self._names
+        # Only one thread builds; the others fall back to querying rather than waiting.
+        if not self._build_lock.acquire(blocking=False):
+            return None
+        try:
+            with self._lock:
+                invalidated_since = set(self._stale_names)
+            names = {}
+            for user_id, full_name in (connection or db.session).execute(select(User.id, User.full_name)):
+                if full_name:
+                    key = full_name.lower()
+                    names[key] = names.get(key, ()) + (user_id,)
+            with self._lock:
+                self._names = names
+                # Names invalidated while building may have been read before the change.
+                self._stale_names -= invalidated_since
+                self._expires_at = now + current_app.config.get('MENTION_INDEX_TTL_SECONDS', 300)
+            return names
+        finally:
+            self._build_lock.release()
+
+    @staticmethod
+    def _query(lowered_names, connection=None):
+        resolved = {name: () for name in lowered_names}
+        rows = (connection or db.session).execute(
+            select(User.id, func.lower(User.full_name)).where(func.lower(User.full_name).in_(lowered_names))
+        )
+        for user_id, lowered_name in rows:
+            resolved[lowered_name] = resolved.get(lowered_name, ()) + (user_id,)
+        return resolved
+
+mention_index = MentionIndex()
+
+def resolve_mentions(names, connection=None):
+    """Resolves mentioned full names to user ids. See `MentionIndex.resolve`."""
+    return mention_index.resolve(names, connection=connection)
+
+# Changed names are collected per session during the flush and applied to the index only
+# once the transaction commits, so other threads never cache a not-yet-committed name.
+_PENDING_KEY = 'mention_index_pending_names'
+
+def _pending_names(target):
+    session = db.inspect(target).session
+    return session.info.setdefault(_PENDING_KEY, set()) if session is not None else None
+
+@db.event.listens_for(User, 'after_insert')
+@db.event.listens_for(User, 'after_delete')
+def on_user_name_added_or_removed(mapper, connection, target):
+    pending = _pending_names(target)
+    if pending is not None:
+        pending.add(target.full_name)
+
+@db.event.listens_for(User, 'after_update')
+def on_user_renamed(mapper, connection, target):
+    history = db.inspect(target).attrs.full_name.history
+    if not history.has_changes():
+        return
+    pending = _pending_names(target)
+    if pending is None:
+        return
+    if not history.deleted:
+        pending.add(None) # The previous name wasn't loaded; drop the whole index.
+    pending.update(history.deleted)
+    pending.update(history.added)
+
+@db.event.listens_for(Session, 'after_commit')
+def on_session_committed(session):
+    names = session.info.pop(_PENDING_KEY, None)
+    if names:
+        mention_index.invalidate(None if None in names else names)
+
+@db.event.listens_for(Session, 'after_rollback')
+def on_session_rolled_back(session):
+    session.info.pop(_PENDING_KEY, None)
+
+@task('mentions.relink', priority=-5)
+def relink_mentions(names=(), user_ids=(), content=(), former_names=()):
+    """
+    Re-renders the posts, photo captions and comments whose mention links may have
+    changed, so their stored HTML and content_mention rows are current:
+
+    * those with a resolved mention of one of `user_ids` (renamed users), found
+      through content_mention;
+    * those listed in `content` as [content_type, content_id] pairs (e.g. what
+      mentioned a since deleted user);
+    * those mentioning one of `names` (new full names) or `former_names`, whether the
+      mention resolved or not, as another user having or losing the name can change
+      its link. Also found through content_mention, by its `name` column.
+
+    Returns:
+        int: The number of rows re-rendered.
+    """
+    mentioned_names = sorted({' '.join(name.split()).lower() for name in (*names, *former_names) if name})
+    content_ids = {}
+    for content_type, content_id in content:
+        content_ids.setdefault(content_type, set()).add(content_id)
+    mention_table = ContentMention.__table__
+    mention_conditions = []
+    if user_ids:
+        mention_conditions.append(mention_table.c.user_id.in_(user_ids))
+    if mentioned_names:
+        mention_conditions.append(mention_table.c.name.in_(mentioned_names))
+
+    relinked = 0
+    for model in (Post, UserPhoto, Comment):
+        table = model.__table__
+        conditions = []
+        if mention_conditions:
+            conditions.append(table.c.id.in_(select(mention_table.c.content_id).where(
+                mention_table.c.content_type == model.target_type_name, or_(*mention_conditions)
+            )))
+        if content_ids.get(model.target_type_name):
+            conditions.append(table.c.id.in_(sorted(content_ids[model.target_type_name])))
+        if conditions:
+            relinked += rerender_matching_content(model, or_(*conditions))
+    current_app.logger.info(
+        f"Relinked mentions (names {mentioned_names}, users {list(user_ids)}, {len(content)} listed item(s)) "
+        f"in {relinked} row(s)."
+    )
+    return relinked
+
+def mentioned_content(user_id):
+    """
+    Returns the [content_type, content_id] pairs of content with a resolved mention of
+    the user. Read it before deleting the user, whose content_mention rows go with them.
+    """
+    mention_table = ContentMention.__table__
+    return [list(row) for row in db.session.execute(
+        select(mention_table.c.content_type, mention_table.c.content_id)
+        .where(mention_table.c.user_id == user_id).distinct()
+    )]
+
+def schedule_mention_relink(new_names=(), user_ids=(), content=(), former_names=()):
+    """
+    Queues `relink_mentions` after committing a change to users' full names:
+
+    * a new user: their name in `new_names`;
+    * a rename: the user's id in `user_ids`, the new name in `new_names` and the old one
+      in `former_names`;
+    * a deletion: `mentioned_content(user_id)`, read before deleting, as `content`, and
+      the name in `former_names`.
+    """
+    new_names = sorted({name for name in new_names if name})
+    former_names = sorted({name for name in former_names if name})
+    if new_names or user_ids or content or former_names:
+        enqueue('mentions.relink', names=new_names, user_ids=list(user_ids), content=list(content),
+                former_names=former_names)
@@ -1,10 +1,15 @@
 from . import db  # Import db from __init__.py
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
-from sqlalchemy import desc, or_, select, func
+from sqlalchemy import desc, or_, select, func, bindparam, delete
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import foreign # Added for polymorphic relationships
 from datetime import datetime, timezone, timedelta # Added timedelta
-from .utils import generate_slug_util # Import the renamed utility
+import json
+import time
+from .utils import generate_slug_util, render_content_util, scan_mentions_util, RENDER_VERSION # Import the renamed utility
+from .like_filter import like_filter_cache
 import jwt # For token generation
 from flask import current_app # For accessing app config (SECRET_KEY)
 
@@ -38,6 +43,26 @@ class User(UserMixin, db.Model):
     is_admin = db.Column(db.Boolean, default=False, nullable=False) # Admin flag
     is_approved = db.Column(db.Boolean, default=False, nullable=False)
     is_active = db.Column(db.Boolean, default=False, nullable=False)
+
+    # Denormalized profile stats, kept in step by the mapper events near reconcile_counters().
+    # post_count only counts published posts.
+    follower_count = db.Column(db.Integer, nullable=False, default=0, server_default='0', index=True)
+    following_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    post_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    photo_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    # Broadcast notification watermarks (see BroadcastNotification): broadcasts up to
+    # broadcast_read_id have been read, and those up to broadcast_joined_id predate the
+    # account and aren't shown.
+    broadcast_read_id = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    broadcast_joined_id = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    # Personal notifications up to notifications_read_id are read whatever their is_read
+    # flag says, so "mark all as read" only moves this watermark. unread_notifications
+    # counts the unread ones above it (see NotificationUnreadCount for per-type counts).
+    notifications_read_id = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    unread_notifications = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
     posts = db.relationship(
         'Post', backref='author', lazy='dynamic', order_by=lambda: desc(Post.created_at) # Use lambda for Post ref
     )
@@ -79,25 +104,41 @@ class User(UserMixin, db.Model):
         return str(self.id)
 
     def follow(self, user):
-        if not self.is_following(user):
-            # Ensure user cannot follow themselves
-            if self == user:
-                return False # Or raise an error
-            # Create a FollowerLink instance
-            link = FollowerLink(follower_id=self.id, followed_id=user.id)
-            db.session.add(link)
-            return True
-        return False # Already following or self-follow attempt
+        return self.set_following(user, True)[0] # False if already following or self-follow attempt
 
     def unfollow(self, user):
-        link = FollowerLink.query.filter_by(
-            follower_id=self.id,
-            followed_id=user.id
-        ).first()
-        if link:
-            db.session.delete(link)
-            return True
-        return False # Was not following
+        return self.set_following(user, False)[0] # False if was not following
+
+    def set_following(self, user, following=True):
+        """
+        Follows or unfollows `user` with a single idempotent statement (INSERT ... ON
+        CONFLICT DO NOTHING, or DELETE) instead of check-then-act, so concurrent clicks
+        can't race. Both users' stored counters are adjusted in the same transaction, only
+        if a row actually changed. The caller commits.
+
+        Returns:
+            tuple: (changed, follower_count), where follower_count is `user`'s new count.
+        """
+        if self.id == user.id:
+            return False, user.follower_count # Ensure user cannot follow themselves
+        connection = db.session.connection()
+        link_table = FollowerLink.__table__
+        if following:
+            changed = _insert_ignoring_duplicates(link_table, {'follower_id': self.id, 'followed_id': user.id})
+        else:
+            changed = connection.execute(delete(link_table).where(
+                link_table.c.follower_id == self.id,
+                link_table.c.followed_id == user.id
+            )).rowcount > 0
+        if not changed:
+            return False, user.follower_count
+
+        delta = 1 if following else -1
+        _adjust_user_counter(connection, self.id, 'following_count', delta)
+        follower_count = _adjust_user_counter(connection, user.id, 'follower_count', delta)
+        from .typeahead_utils import note_follower_count_change # Local import to avoid circular dependency
+        note_follower_count_change(db.session, user.id, delta)
+        return True, follower_count
 
     def is_following(self, user):
         return FollowerLink.query.filter_by(
@@ -106,24 +147,56 @@ class User(UserMixin, db.Model):
         ).count() > 0
 
     def like_item(self, target_type: str, target_id: int):
-        if not self.has_liked_item(target_type, target_id):
-            # Ensure the Like model is correctly referenced here
-            like = Like(user_id=self.id, target_type=target_type, target_id=target_id)
-            db.session.add(like)
-            return True
-        return False
+        return self.set_item_liked(target_type, target_id, True)[0]
 
     def unlike_item(self, target_type: str, target_id: int):
-        # Ensure the Like model is correctly referenced here
-        like = Like.query.filter_by(user_id=self.id, target_type=target_type, target_id=target_id).first()
-        if like:
-            db.session.delete(like)
-            return True
-        return False
+        return self.set_item_liked(target_type, target_id, False)[0]
+
+    def set_item_liked(self, target_type: str, target_id: int, liked: bool = True):
+        """
+        Likes or unlikes an item with a single idempotent statement (INSERT ... ON CONFLICT
+        DO NOTHING, or DELETE). The item's stored like_count is adjusted with UPDATE ...
+        RETURNING in the same transaction, only if a row actually changed. The caller commits.
+
+        Returns:
+            tuple: (changed, like_count), where like_count is None if the item doesn't exist.
+
+        Raises:
+            ValueError: If `target_type` can't be liked.
+        """
+        counter_table = _like_counter_table(target_type)
+        connection = db.session.connection()
+        like_table = Like.__table__
+        if liked:
+            changed = _insert_ignoring_duplicates(
+                like_table, {'user_id': self.id, 'target_type': target_type, 'target_id': target_id}
+            )
+        else:
+            changed = connection.execute(delete(like_table).where(
+                like_table.c.user_id == self.id,
+                like_table.c.target_type == target_type,
+                like_table.c.target_id == target_id
+            )).rowcount > 0
+        if changed:
+            like_count = _adjust_counter(connection, counter_table, 'like_count', target_id, 1 if liked else -1)
+            if liked:
+                like_filter_cache.add(self.id, target_type, target_id)
+            else:
+                like_filter_cache.note_unlike(self.id)
+        else:
+            like_count = connection.scalar(select(counter_table.c.like_count).where(counter_table.c.id == target_id))
+        return changed, like_count
 
     def has_liked_item(self, target_type: str, target_id: int):
-        # Ensure the Like model is correctly referenced here
-        return Like.query.filter_by(user_id=self.id, target_type=target_type, target_id=target_id).count() > 0
+        from .like_buffer import like_buffer # Local import to avoid circular dependency
+        pending_state = like_buffer.pending_state(self.id, target_type, target_id)
+        if pending_state is not None:
+            return pending_state # Not flushed yet
+        # Only hits the database when the user's Bloom filter can't rule the like out.
+        return like_filter_cache.has_liked(
+            self.id, target_type, target_id,
+            lambda: Like.query.filter_by(user_id=self.id, target_type=target_type, target_id=target_id).count() > 0
+        )
 
     def get_reset_password_token(self, expires_in_seconds=1800): # Default 30 minutes
         """
@@ -239,23 +312,54 @@ class Category(db.Model):
 
 
 class PolymorphicLikeMixin:
-    """Mixin for models that can be liked."""
-    @property
-    def like_count(self):
-        return self.likes.count()
+    """
+    Mixin for models that can be liked. `like_count` is a denormalized counter kept in
+    step with the `like` table by the Like mapper events below.
+    """
+    like_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
 class PolymorphicCommentMixin:
-    """Mixin for models that can be commented on."""
-    @property
-    def comment_count(self):
-        return self.comments.count()
+    """
+    Mixin for models that can be commented on. `comment_count` is a denormalized counter
+    kept in step with the `comment` table by the Comment mapper events below.
+    """
+    comment_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+class RenderedContentMixin:
+    """
+    Mixin for models whose Markdown source is rendered to sanitized HTML at write time.
+
+    Subclasses set `rendered_fields` to (source attribute, HTML attribute) and
+    `target_type_name` to the TARGET_TYPES name their @mentions are recorded under in
+    `content_mention`. The `on_rendered_content_saving` hook resolves mentions, fills the
+    HTML column (with mention links), `excerpt` (plain text) and `render_version`
+    whenever the source changes; `flask content rerender` refreshes rows rendered by an
+    older `RENDER_VERSION`.
+    """
+    rendered_fields = None
+    target_type_name = None
+    excerpt = db.Column(db.Text, nullable=True)
+    render_version = db.Column(db.Integer, nullable=True)
 
-class Post(db.Model, PolymorphicLikeMixin):
+    def get_rendered(self):
+        """
+        Returns (html, excerpt), rendering on the fly only if the stored copy is missing
+        or was produced by an older renderer.
+        """
+        source_name, html_name = self.rendered_fields
+        if self.render_version == RENDER_VERSION and getattr(self, html_name) is not None:
+            return getattr(self, html_name), self.excerpt
+        return render_content_util(getattr(self, source_name))
+
+class Post(db.Model, PolymorphicLikeMixin, PolymorphicCommentMixin, RenderedContentMixin):
     __tablename__ = 'post'
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(255), nullable=False)
     type = db.Column(db.String(50), default='post')
     content = db.Column(db.Text, nullable=False)
+    content_html = db.Column(db.Text, nullable=True) # Sanitized HTML, rendered at write time
+    rendered_fields = ('content', 'content_html')
+    target_type_name = 'post'
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     created_at = db.Column(
         db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc)
@@ -300,13 +404,14 @@ class Post(db.Model, PolymorphicLikeMixin):
                             cascade='all, delete-orphan',
                             overlaps="likes,likes,likes")
 
-import misaka
-class Comment(db.Model, PolymorphicLikeMixin):
+class Comment(db.Model, PolymorphicLikeMixin, RenderedContentMixin):
     __tablename__ = 'comment'
     id = db.Column(db.Integer, primary_key=True)
     type = db.Column(db.String(50), default='comment')
     text = db.Column(db.Text, nullable=False)
-    text_html = db.Column(db.Text, nullable=True) # Added to store rendered HTML
+    text_html = db.Column(db.Text, nullable=True) # Sanitized HTML, rendered at write time
+    rendered_fields = ('text', 'text_html')
+    target_type_name = 'comment'
     created_at = db.Column(
         db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc)
     )
@@ -337,12 +442,32 @@ class Comment(db.Model, PolymorphicLikeMixin):
                             cascade='all, delete-orphan',
                             overlaps="likes,likes")
 
-# Event listener to render markdown to html before saving
-@db.event.listens_for(Comment, 'before_insert')
-@db.event.listens_for(Comment, 'before_update')
-def on_comment_saving(mapper, connection, target):
-    if target.text:
-        target.text_html = misaka.html(target.text, extensions=('fenced-code', 'tables'))
+# Render Markdown to sanitized HTML before saving, for every RenderedContentMixin model.
+@db.event.listens_for(RenderedContentMixin, 'before_insert', propagate=True)
+@db.event.listens_for(RenderedContentMixin, 'before_update', propagate=True)
+def on_rendered_content_saving(mapper, connection, target):
+    source_name, html_name = target.rendered_fields
+    if db.inspect(target).persistent and not _attributes_changed(target, source_name) \
+            and target.render_version == RENDER_VERSION:
+        return
+    source = getattr(target, source_name)
+    mentions = scan_mentions_util(source, connection=connection)
+    html, excerpt = render_content_util(source, _linked_spans(mentions))
+    setattr(target, html_name, html)
+    target.excerpt = excerpt
+    target.render_version = RENDER_VERSION
+    target._pending_mentions = mentions # Written to content_mention once the row has an id.
+
+@db.event.listens_for(RenderedContentMixin, 'after_insert', propagate=True)
+@db.event.listens_for(RenderedContentMixin, 'after_update', propagate=True)
+def on_rendered_content_saved(mapper, connection, target):
+    mentions = target.__dict__.pop('_pending_mentions', None)
+    if mentions is not None:
+        _replace_content_mentions(connection, target.target_type_name, [(target.id, mentions)])
+
+@db.event.listens_for(RenderedContentMixin, 'after_delete', propagate=True)
+def on_rendered_content_deleted(mapper, connection, target):
+    _replace_content_mentions(connection, target.target_type_name, [(target.id, [])])
 
 class Postable(db.Model):
     __tablename__ = 'postable'
@@ -354,7 +479,7 @@ class Postable(db.Model):
         'polymorphic_on': type
     }
 
-class UserPhoto(db.Model, PolymorphicLikeMixin):
+class UserPhoto(db.Model, PolymorphicLikeMixin, PolymorphicCommentMixin, RenderedContentMixin):
     __tablename__ = 'user_photo'
     id = db.Column(db.Integer, primary_key=True)
     type = db.Column(db.String(50), default='userphoto')
@@ -362,6 +487,9 @@ class UserPhoto(db.Model, PolymorphicLikeMixin):
     # image_filename stores path relative to GALLERY_UPLOAD_FOLDER, e.g. "user_id/image.jpg"
     image_filename = db.Column(db.String(255), nullable=False)
     caption = db.Column(db.Text, nullable=True)
+    caption_html = db.Column(db.Text, nullable=True) # Sanitized HTML, rendered at write time
+    rendered_fields = ('caption', 'caption_html')
+    target_type_name = 'userphoto'
     uploaded_at = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
 
     __mapper_args__ = {
@@ -385,6 +513,201 @@ class UserPhoto(db.Model, PolymorphicLikeMixin):
     def __repr__(self):
         return f'<UserPhoto {self.image_filename} user_id={self.user_id}>'
 
+class FeedItem(db.Model):
+    """
+    Materialized row of the global timeline, one per post or gallery photo.
+
+    Rows are kept in sync with `Post` and `UserPhoto` by the mapper events below, so
+    reading the feed is a single range scan over `ix_feed_item_ts_id` instead of a
+    sorted UNION over both content tables.
+    """
+    __tablename__ = 'feed_item'
+    VISIBILITY_PUBLIC = 'public'
+    VISIBILITY_UNPUBLISHED = 'unpublished'
+
+    id = db.Column(db.Integer, primary_key=True)
+    item_type = db.Column(db.String(20), nullable=False) # 'post' or 'photo', as exposed by the feed API
+    item_id = db.Column(db.Integer, nullable=False)
+    author_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    ts = db.Column(db.DateTime, nullable=False)
+    visibility = db.Column(db.String(20), nullable=False, default=VISIBILITY_PUBLIC)
+
+    __table_args__ = (
+        db.UniqueConstraint('item_type', 'item_id', name='_feed_item_target_uc'),
+    )
+
+    def __repr__(self):
+        return f'<FeedItem {self.id} {self.item_type}:{self.item_id} ts={self.ts} visibility={self.visibility}>'
+
+# Newest-first index backing the feed's keyset pagination on (ts, id).
+db.Index('ix_feed_item_ts_id', FeedItem.ts.desc(), FeedItem.id.desc())
+# Per-author range scans: home timeline backfill and read-time merge of high-follower authors.
+db.Index('ix_feed_item_author_ts', FeedItem.author_id, FeedItem.ts.desc(), FeedItem.id.desc())
+
+class HomeTimeline(db.Model):
+    """
+    Per-user "following" timeline: one row per feed item pushed to a follower.
+
+    Rows are written by the background fan-out in `feed_utils` and copy the item's
+    `ts` so a page is a range scan on (user_id, ts, feed_item_id). `author_id` lets an
+    unfollow purge that author's rows with a single DELETE.
+    """
+    __tablename__ = 'home_timeline'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False) # Timeline owner
+    feed_item_id = db.Column(db.Integer, db.ForeignKey('feed_item.id', ondelete='CASCADE'), nullable=False)
+    author_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    ts = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'feed_item_id', name='_home_timeline_user_item_uc'),
+        db.Index('ix_home_timeline_user_author', 'user_id', 'author_id'),
+    )
+
+    def __repr__(self):
+        return f'<HomeTimeline user_id={self.user_id} feed_item_id={self.feed_item_id} ts={self.ts}>'
+
+db.Index('ix_home_timeline_user_ts', HomeTimeline.user_id, HomeTimeline.ts.desc(), HomeTimeline.feed_item_id.desc())
+
+def _post_feed_visibility(post):
+    return FeedItem.VISIBILITY_PUBLIC if post.is_published else FeedItem.VISIBILITY_UNPUBLISHED
+
+def _attributes_changed(target, *attribute_names):
+    state = db.inspect(target)
+    return any(state.attrs[name].history.has_changes() for name in attribute_names)
+
+# Keep feed_item in sync with its source tables. These run inside the flush, on the
+# same connection, so the feed row commits or rolls back together with the content.
+@db.event.listens_for(Post, 'after_insert')
+def on_post_inserted(mapper, connection, target):
+    connection.execute(FeedItem.__table__.insert().values(
+        item_type='post', item_id=target.id, author_id=target.user_id,
+        ts=target.created_at, visibility=_post_feed_visibility(target)
+    ))
+
+@db.event.listens_for(Post, 'after_update')
+def on_post_updated(mapper, connection, target):
+    if _attributes_changed(target, 'is_published', 'created_at', 'user_id'):
+        feed_table = FeedItem.__table__
+        connection.execute(feed_table.update().where(
+            feed_table.c.item_type == 'post', feed_table.c.item_id == target.id
+        ).values(author_id=target.user_id, ts=target.created_at, visibility=_post_feed_visibility(target)))
+
+@db.event.listens_for(UserPhoto, 'after_insert')
+def on_user_photo_inserted(mapper, connection, target):
+    connection.execute(FeedItem.__table__.insert().values(
+        item_type='photo', item_id=target.id, author_id=target.user_id,
+        ts=target.uploaded_at, visibility=FeedItem.VISIBILITY_PUBLIC
+    ))
+
+@db.event.listens_for(UserPhoto, 'after_update')
+def on_user_photo_updated(mapper, connection, target):
+    if _attributes_changed(target, 'uploaded_at', 'user_id'):
+        feed_table = FeedItem.__table__
+        connection.execute(feed_table.update().where(
+            feed_table.c.item_type == 'photo', feed_table.c.item_id == target.id
+        ).values(author_id=target.user_id, ts=target.uploaded_at))
+
+@db.event.listens_for(Post, 'after_delete')
+@db.event.listens_for(UserPhoto, 'after_delete')
+def on_feed_source_deleted(mapper, connection, target):
+    item_type = 'post' if isinstance(target, Post) else 'photo'
+    feed_table = FeedItem.__table__
+    feed_item_ids = select(feed_table.c.id).where(
+        feed_table.c.item_type == item_type, feed_table.c.item_id == target.id
+    )
+    # Not every backend enforces ON DELETE CASCADE (SQLite doesn't by default).
+    timeline_table = HomeTimeline.__table__
+    connection.execute(timeline_table.delete().where(timeline_table.c.feed_item_id.in_(feed_item_ids)))
+    connection.execute(feed_table.delete().where(
+        feed_table.c.item_type == item_type, feed_table.c.item_id == target.id
+    ))
+
+def backfill_feed_items():
+    """
+    Inserts feed_item rows for posts and gallery photos that don't have one yet,
+    e.g. content created before the table existed. Safe to run repeatedly.
+
+    Returns:
+        tuple[int, int]: The number of post and photo rows inserted.
+    """
+    feed_table = FeedItem.__table__
+    columns = ['item_type', 'item_id', 'author_id', 'ts', 'visibility']
+
+    missing_posts = select(
+        db.literal('post'), Post.id, Post.user_id, Post.created_at,
+        db.case((Post.is_published == True, FeedItem.VISIBILITY_PUBLIC), else_=FeedItem.VISIBILITY_UNPUBLISHED) # noqa E712
+    ).where(~select(feed_table.c.id).where(
+        feed_table.c.item_type == 'post', feed_table.c.item_id == Post.id
+    ).exists())
+    missing_photos = select(
+        db.literal('photo'), UserPhoto.id, UserPhoto.user_id, UserPhoto.uploaded_at,
+        db.literal(FeedItem.VISIBILITY_PUBLIC)
+    ).where(~select(feed_table.c.id).where(
+        feed_table.c.item_type == 'photo', feed_table.c.item_id == UserPhoto.id
+    ).exists())
+
+    posts_inserted = db.session.execute(feed_table.insert().from_select(columns, missing_posts)).rowcount
+    photos_inserted = db.session.execute(feed_table.insert().from_select(columns, missing_photos)).rowcount
+    db.session.commit()
+    return posts_inserted, photos_inserted
+
+class ContentMention(db.Model):
+    """
+    An @mention in a post, photo caption or comment, recorded at write time.
+    `span_start`/`span_end` are character offsets of the "@Full Name" text in the
+    source, so the render path can link mentions without resolving names again.
+
+    `name` is the mentioned name, space-normalized and lowercased. `user_id` is the user
+    it resolved to, or NULL if no user or several users had that name when the content
+    was rendered. A new or renamed user's content to relink is found by `name`.
+    """
+    __tablename__ = 'content_mention'
+    id = db.Column(db.Integer, primary_key=True)
+    content_type = db.Column(db.String(50), nullable=False) # RenderedContentMixin.target_type_name
+    content_id = db.Column(db.Integer, nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=True, index=True)
+    name = db.Column(db.String(120), nullable=False, index=True) # As long as User.full_name
+    span_start = db.Column(db.Integer, nullable=False)
+    span_end = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (db.Index('ix_content_mention_content', 'content_type', 'content_id'),)
+
+    def __repr__(self):
+        return f'<ContentMention {self.content_type} {self.content_id} {self.name!r} user_id={self.user_id} span={self.span_start}:{self.span_end}>'
+
+def _linked_spans(mentions):
+    """The (user_id, span_start, span_end) of the resolved mentions from `scan_mentions_util`."""
+    return [(user_id, span_start, span_end) for _, user_id, span_start, span_end in mentions if user_id is not None]
+
+def _replace_content_mentions(executor, content_type, mentions_by_id):
+    """
+    Replaces the content_mention rows of the given content with new spans.
+
+    Args:
+        executor: A Connection (inside flush events) or the Session.
+        content_type (str): The content's `target_type_name`.
+        mentions_by_id (list): (content_id, mentions) pairs, the mentions as returned by
+                               `scan_mentions_util`.
+    """
+    mention_table = ContentMention.__table__
+    content_ids = [content_id for content_id, _ in mentions_by_id]
+    if not content_ids:
+        return
+    executor.execute(mention_table.delete().where(
+        mention_table.c.content_type == content_type, mention_table.c.content_id.in_(content_ids)
+    ))
+    max_name_length = mention_table.c.name.type.length
+    rows = [
+        {'content_type': content_type, 'content_id': content_id, 'name': name, 'user_id': user_id,
+         'span_start': span_start, 'span_end': span_end}
+        for content_id, mentions in mentions_by_id
+        for name, user_id, span_start, span_end in mentions
+        if len(name) <= max_name_length # Longer names can't belong to a user
+    ]
+    if rows:
+        executor.execute(mention_table.insert(), rows)
+
 class CommentFlag(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     comment_id = db.Column(db.Integer, db.ForeignKey('comment.id'), nullable=False)
@@ -430,6 +753,448 @@ class Like(db.Model):
         return f'<Like user_id={self.user_id} target_type={self.target_type} target_id={self.target_id}>'
 
 
+# Denormalized like/comment counters. Each entry is (counted model, counter column,
+# source model, source target_type values). Photo likes are written as 'photo' while
+# photo comments use 'userphoto', so both names are accepted for UserPhoto.
+_COUNTER_SOURCES = (
+    (Post, 'like_count', Like, ('post',)),
+    (Comment, 'like_count', Like, ('comment',)),
+    (UserPhoto, 'like_count', Like, ('photo', 'userphoto')),
+    (Post, 'comment_count', Comment, ('post',)),
+    (UserPhoto, 'comment_count', Comment, ('userphoto', 'photo')),
+)
+
+def _update_keeping_timestamps(table, values):
+    # Maintaining derived columns isn't an edit: keep `onupdate` columns such as updated_at as they are.
+    values = dict(values)
+    values.update({column.name: column for column in table.c if column.onupdate is not None})
+    return table.update().values(values)
+
+def _adjust_counter(connection, table, counter_name, row_id, delta):
+    # One round trip where the backend supports UPDATE ... RETURNING (SQLite 3.35+, PostgreSQL).
+    statement = _update_keeping_timestamps(
+        table, {counter_name: table.c[counter_name] + delta}
+    ).where(table.c.id == row_id)
+    if connection.dialect.update_returning:
+        return connection.execute(statement.returning(table.c[counter_name])).scalar()
+    connection.execute(statement)
+    return connection.scalar(select(table.c[counter_name]).where(table.c.id == row_id))
+
+def _adjust_counters(connection, source_model, target_type, target_id, delta):
+    for model, counter_name, counter_source, target_types in _COUNTER_SOURCES:
+        if counter_source is source_model and target_type in target_types:
+            table = model.__table__
+            connection.execute(_update_keeping_timestamps(
+                table, {counter_name: table.c[counter_name] + delta}
+            ).where(table.c.id == target_id))
+
+def _like_counter_table(target_type):
+    for model, counter_name, counter_source, target_types in _COUNTER_SOURCES:
+        if counter_source is Like and target_type in target_types:
+            return model.__table__
+    raise ValueError(f"Items of type '{target_type}' can't be liked.")
+
+def _insert_ignoring_duplicates(table, values, connection=None):
+    """
+    Inserts a row unless it would violate a unique constraint, in one statement where the
+    backend supports INSERT ... ON CONFLICT DO NOTHING (falling back to a savepoint).
+    Runs on `connection` if given, otherwise in the session.
+
+    Returns:
+        bool: True if the row was inserted, False if it already existed.
+    """
+    savepoint_owner = connection or db.session
+    connection = connection or db.session.connection()
+    dialect_insert = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}.get(connection.dialect.name)
+    if dialect_insert is not None:
+        return connection.execute(dialect_insert(table).values(values).on_conflict_do_nothing()).rowcount == 1
+    try:
+        with savepoint_owner.begin_nested():
+            connection.execute(table.insert().values(values))
+        return True
+    except IntegrityError:
+        return False
+
+def read_like_counts(targets, connection=None):
+    """
+    Reads the stored like_count of (target_type, target_id) pairs with one query per
+    table, on `connection` if given. Returns a dict keyed by pair; items that don't
+    exist are left out.
+    """
+    ids_by_type = {}
+    for target_type, target_id in targets:
+        ids_by_type.setdefault(target_type, set()).add(target_id)
+    counts = {}
+    for target_type, target_ids in ids_by_type.items():
+        table = _like_counter_table(target_type)
+        rows = (connection or db.session).execute(select(table.c.id, table.c.like_count).where(table.c.id.in_(target_ids)))
+        counts.update({(target_type, row_id): like_count for row_id, like_count in rows})
+    return counts
+
+def write_like_batch(liked_keys, unliked_keys, chunk_size=500, inserted=None, connection=None):
+    """
+    Applies many like/unlike intents at once, e.g. from the write-behind buffer in
+    `like_buffer`. Likes are a multi-row INSERT ... ON CONFLICT DO NOTHING RETURNING and
+    unlikes a DELETE ... RETURNING, so only rows that actually changed are counted; the
+    counters then get one executemany UPDATE per table with the net change per item.
+    The caller commits.
+
+    Args:
+        liked_keys, unliked_keys (iterable): (user_id, target_type, target_id) tuples.
+        inserted (list, optional): Receives the liked keys that were actually new.
+        connection (Connection, optional): Where to write, e.g. a transaction of its own
+                                           rather than the session's.
+
+    Returns:
+        dict: (target_type, target_id) -> new like_count for every affected item that exists.
+    """
+    connection = connection or db.session.connection()
+    like_table = Like.__table__
+    dialect_insert = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}.get(connection.dialect.name)
+    deltas = {}
+    def add_delta(target_type, target_id, delta):
+        deltas[(target_type, target_id)] = deltas.get((target_type, target_id), 0) + delta
+
+    liked_keys, unliked_keys = list(liked_keys), list(unliked_keys)
+    now = datetime.now(timezone.utc)
+    for start in range(0, len(liked_keys), chunk_size):
+        chunk = liked_keys[start:start + chunk_size]
+        if dialect_insert is not None and connection.dialect.insert_returning:
+            rows = connection.execute(dialect_insert(like_table).values([
+                {'user_id': user_id, 'target_type': target_type, 'target_id': target_id, 'timestamp': now}
+                for user_id, target_type, target_id in chunk
+            ]).on_conflict_do_nothing().returning(like_table.c.user_id, like_table.c.target_type, like_table.c.target_id))
+            for user_id, target_type, target_id in rows:
+                add_delta(target_type, target_id, 1)
+                like_filter_cache.add(user_id, target_type, target_id)
+                if inserted is not None:
+                    inserted.append((user_id, target_type, target_id))
+        else:
+            for user_id, target_type, target_id in chunk:
+                if _insert_ignoring_duplicates(
+                    like_table, {'user_id': user_id, 'target_type': target_type, 'target_id': target_id}, connection
+                ):
+                    add_delta(target_type, target_id, 1)
+                    like_filter_cache.add(user_id, target_type, target_id)
+                    if inserted is not None:
+                        inserted.append((user_id, target_type, target_id))
+
+    for start in range(0, len(unliked_keys), chunk_size):
+        chunk = unliked_keys[start:start + chunk_size]
+        statement = delete(like_table).where(
+            db.tuple_(like_table.c.user_id, like_table.c.target_type, like_table.c.target_id).in_(chunk)
+        )
+        if connection.dialect.delete_returning:
+            deleted = connection.execute(statement.returning(like_table.c.user_id, like_table.c.target_type, like_table.c.target_id))
+            for user_id, target_type, target_id in deleted:
+                add_delta(target_type, target_id, -1)
+                like_filter_cache.note_unlike(user_id)
+        else:
+            for user_id, target_type, target_id in chunk:
+                if connection.execute(delete(like_table).where(
+                    like_table.c.user_id == user_id,
+                    like_table.c.target_type == target_type,
+                    like_table.c.target_id == target_id
+                )).rowcount:
+                    add_delta(target_type, target_id, -1)
+                    like_filter_cache.note_unlike(user_id)
+
+    deltas_by_type = {}
+    for (target_type, target_id), delta in deltas.items():
+        if delta:
+            deltas_by_type.setdefault(target_type, []).append({'counter_row_id': target_id, 'counter_delta': delta})
+    for target_type, params in deltas_by_type.items():
+        table = _like_counter_table(target_type)
+        connection.execute(_update_keeping_timestamps(
+            table, {'like_count': table.c.like_count + bindparam('counter_delta')}
+        ).where(table.c.id == bindparam('counter_row_id')), params)
+
+    return read_like_counts({
+        (target_type, target_id)
+        for _, target_type, target_id in liked_keys + unliked_keys
+    }, connection)
+
+# Like the feed_item hooks, these run inside the flush so a counter commits or rolls back
+# with its row. Deletes are counted in before_delete, while the row's attributes can
+# still be loaded.
+@db.event.listens_for(Like, 'after_insert')
+@db.event.listens_for(Comment, 'after_insert')
+def on_counted_row_inserted(mapper, connection, target):
+    _adjust_counters(connection, mapper.class_, target.target_type, target.target_id, 1)
+
+@db.event.listens_for(Like, 'before_delete')
+@db.event.listens_for(Comment, 'before_delete')
+def on_counted_row_deleted(mapper, connection, target):
+    _adjust_counters(connection, mapper.class_, target.target_type, target.target_id, -1)
+
+# Likes written through the ORM (the single-statement paths update the filter themselves).
+# Setting bits early is safe: a rolled-back like only causes a false positive.
+@db.event.listens_for(Like, 'after_insert')
+def on_like_inserted(mapper, connection, target):
+    like_filter_cache.add(target.user_id, target.target_type, target.target_id)
+
+@db.event.listens_for(Like, 'before_delete')
+def on_like_deleted(mapper, connection, target):
+    like_filter_cache.note_unlike(target.user_id)
+
+def _adjust_user_counter(connection, user_id, counter_name, delta):
+    return _adjust_counter(connection, User.__table__, counter_name, user_id, delta)
+
+def _recount_user_counter(connection, user_ids, counter_name):
+    user_table = User.__table__
+    actual = dict(_user_counter_definitions())[counter_name]
+    connection.execute(_update_keeping_timestamps(
+        user_table, {counter_name: actual.scalar_subquery()}
+    ).where(user_table.c.id.in_(user_ids)))
+
+@db.event.listens_for(FollowerLink, 'after_insert')
+def on_follower_link_inserted(mapper, connection, target):
+    _adjust_user_counter(connection, target.follower_id, 'following_count', 1)
+    _adjust_user_counter(connection, target.followed_id, 'follower_count', 1)
+
+@db.event.listens_for(FollowerLink, 'before_delete')
+def on_follower_link_deleted(mapper, connection, target):
+    _adjust_user_counter(connection, target.follower_id, 'following_count', -1)
+    _adjust_user_counter(connection, target.followed_id, 'follower_count', -1)
+
+@db.event.listens_for(Post, 'after_insert')
+def on_post_counted(mapper, connection, target):
+    if target.is_published:
+        _adjust_user_counter(connection, target.user_id, 'post_count', 1)
+
+@db.event.listens_for(Post, 'after_update')
+def on_post_recounted(mapper, connection, target):
+    state = db.inspect(target)
+    published_history, author_history = state.attrs.is_published.history, state.attrs.user_id.history
+    if published_history.has_changes() or author_history.has_changes():
+        # The previous value may not have been loaded, so recount rather than adjust.
+        user_ids = {target.user_id, *author_history.deleted}
+        _recount_user_counter(connection, user_ids, 'post_count')
+
+@db.event.listens_for(Post, 'before_delete')
+def on_post_uncounted(mapper, connection, target):
+    if target.is_published:
+        _adjust_user_counter(connection, target.user_id, 'post_count', -1)
+
+@db.event.listens_for(UserPhoto, 'after_insert')
+def on_user_photo_counted(mapper, connection, target):
+    _adjust_user_counter(connection, target.user_id, 'photo_count', 1)
+
+@db.event.listens_for(UserPhoto, 'after_update')
+def on_user_photo_recounted(mapper, connection, target):
+    author_history = db.inspect(target).attrs.user_id.history
+    if author_history.has_changes():
+        _recount_user_counter(connection, {target.user_id, *author_history.deleted}, 'photo_count')
+
+@db.event.listens_for(UserPhoto, 'before_delete')
+def on_user_photo_uncounted(mapper, connection, target):
+    _adjust_user_counter(connection, target.user_id, 'photo_count', -1)
+
+def _user_counter_definitions():
+    """Returns (counter name, correlated COUNT select) for each denormalized User stat."""
+    user_table, link_table = User.__table__, FollowerLink.__table__
+    post_table, photo_table = Post.__table__, UserPhoto.__table__
+    notification_table = Notification.__table__
+    return [
+        ('follower_count', select(func.count()).select_from(link_table).where(link_table.c.followed_id == user_table.c.id)),
+        ('following_count', select(func.count()).select_from(link_table).where(link_table.c.follower_id == user_table.c.id)),
+        ('post_count', select(func.count()).select_from(post_table).where(
+            post_table.c.user_id == user_table.c.id, post_table.c.is_published == True # noqa E712
+        )),
+        ('photo_count', select(func.count()).select_from(photo_table).where(photo_table.c.user_id == user_table.c.id)),
+        ('unread_notifications', select(func.count()).select_from(notification_table).where(
+            notification_table.c.user_id == user_table.c.id,
+            notification_table.c.is_read == False, # noqa E712
+            notification_table.c.id > user_table.c.notifications_read_id
+        )),
+    ]
+
+def _counter_definitions():
+    for model, counter_name, source_model, target_types in _COUNTER_SOURCES:
+        table, source_table = model.__table__, source_model.__table__
+        yield table, counter_name, select(func.count(source_table.c.id)).where(
+            source_table.c.target_type.in_(target_types),
+            source_table.c.target_id == table.c.id
+        )
+    for counter_name, actual in _user_counter_definitions():
+        yield User.__table__, counter_name, actual
+
+def reconcile_counters(fix=True):
+    """
+    Recomputes every denormalized counter (like/comment counts, the User profile stats
+    and unread notification counts) from its source table in bulk, one correlated
+    UPDATE per counter.
+
+    Args:
+        fix (bool): If False, only report drift without changing anything.
+
+    Returns:
+        dict: Maps 'table.column' to the number of rows whose stored value was wrong.
+    """
+    drift = {}
+    for table, counter_name, actual in _counter_definitions():
+        actual = actual.scalar_subquery()
+        counter = table.c[counter_name]
+        drifted = db.session.scalar(select(func.count()).select_from(table).where(counter != actual))
+        if fix and drifted:
+            db.session.execute(_update_keeping_timestamps(table, {counter_name: actual}).where(counter != actual))
+        drift[f'{table.name}.{counter_name}'] = drifted
+    drift['notification_unread_count.unread_count'] = _reconcile_unread_counts_by_type(fix)
+    if fix:
+        db.session.commit()
+    return drift
+
+def _reconcile_unread_counts_by_type(fix):
+    # Compares the current (non-stale) per-type rows with a GROUP BY over unread
+    # notifications and rewrites the rows of users whose counts drifted.
+    user_table, notification_table = User.__table__, Notification.__table__
+    counts_table = NotificationUnreadCount.__table__
+    actual = {
+        (user_id, notification_type): count for user_id, notification_type, count in db.session.execute(
+            select(notification_table.c.user_id, notification_table.c.type, func.count())
+            .join(user_table, user_table.c.id == notification_table.c.user_id)
+            .where(notification_table.c.is_read == False, # noqa E712
+                   notification_table.c.id > user_table.c.notifications_read_id)
+            .group_by(notification_table.c.user_id, notification_table.c.type)
+        )
+    }
+    stored = {
+        (user_id, notification_type): count for user_id, notification_type, count in db.session.execute(
+            select(counts_table.c.user_id, counts_table.c.type, counts_table.c.unread_count)
+            .join(user_table, user_table.c.id == counts_table.c.user_id)
+            .where(counts_table.c.read_id == user_table.c.notifications_read_id, counts_table.c.unread_count != 0)
+        )
+    }
+    drifted = {key for key in actual.keys() | stored.keys() if actual.get(key, 0) != stored.get(key, 0)}
+    if fix and drifted:
+        user_ids = {user_id for user_id, _ in drifted}
+        read_ids = dict(db.session.execute(
+            select(user_table.c.id, user_table.c.notifications_read_id).where(user_table.c.id.in_(user_ids))
+        ).all())
+        db.session.execute(delete(counts_table).where(counts_table.c.user_id.in_(user_ids)))
+        rows = [
+            {'user_id': user_id, 'type': notification_type, 'unread_count': count, 'read_id': read_ids[user_id]}
+            for (user_id, notification_type), count in actual.items() if user_id in user_ids
+        ]
+        if rows:
+            db.session.execute(counts_table.insert(), rows)
+    return len(drifted)
+
+def rerender_stored_content(force=False, batch_size=500):
+    """
+    Re-renders the stored HTML, excerpts and mentions of posts, photo captions and
+    comments, e.g. after RENDER_VERSION was bumped for a renderer or allowed-tags change.
+
+    Args:
+        force (bool): Re-render every row, not only those rendered by another version.
+        batch_size (int): Rows per batch.
+
+    Returns:
+        dict: Maps each table name to the number of rows re-rendered.
+    """
+    rerendered = {}
+    for model in (Post, UserPhoto, Comment):
+        table = model.__table__
+        condition = None
+        if not force:
+            condition = or_(table.c.render_version.is_(None), table.c.render_version != RENDER_VERSION)
+        rerendered[table.name] = rerender_matching_content(model, condition, batch_size)
+    return rerendered
+
+def rerender_matching_content(model, condition=None, batch_size=500):
+    """
+    Re-renders the stored HTML, excerpt and content_mention rows of every `model` row
+    matching `condition` (a WHERE clause on its table, or None for all rows).
+
+    Rows are processed in id order, `batch_size` at a time. Each batch is written with
+    one executemany UPDATE plus one DELETE/INSERT of its mentions and committed on its
+    own, so an interrupted run can be resumed.
+
+    Returns:
+        int: The number of rows re-rendered.
+    """
+    table = model.__table__
+    source_name, html_name = model.rendered_fields
+    rerender_row = _update_keeping_timestamps(table, {
+        html_name: bindparam('b_html'), 'excerpt': bindparam('b_excerpt'), 'render_version': RENDER_VERSION
+    }).where(table.c.id == bindparam('b_id'))
+
+    last_id, count = 0, 0
+    while True:
+        batch_query = select(table.c.id, table.c[source_name]).where(table.c.id > last_id)
+        if condition is not None:
+            batch_query = batch_query.where(condition)
+        rows = db.session.execute(batch_query.order_by(table.c.id).limit(batch_size)).all()
+        if not rows:
+            break
+        params, mentions_by_id = [], []
+        for row_id, source in rows:
+            mentions = scan_mentions_util(source)
+            html, excerpt = render_content_util(source, _linked_spans(mentions))
+            params.append({'b_id': row_id, 'b_html': html, 'b_excerpt': excerpt})
+            mentions_by_id.append((row_id, mentions))
+        db.session.execute(rerender_row, params)
+        _replace_content_mentions(db.session, model.target_type_name, mentions_by_id)
+        db.session.commit()
+        count += len(rows)
+        last_id = rows[-1].id
+    return count
+
+# Registry of the polymorphic (target_type, target_id) names used by Like, Comment,
+# Notification and Activity. Gallery photos have been written under several names over
+# time ('userphoto' by comments, 'photo' by likes, 'user_photo' in older docs), so all of
+# them resolve to UserPhoto.
+TARGET_TYPES = {}
+
+def register_target_type(model, *names):
+    """Registers `model` as the class behind each of the given target_type names."""
+    for name in names:
+        TARGET_TYPES[name] = model
+
+register_target_type(Post, 'post')
+register_target_type(Comment, 'comment')
+register_target_type(UserPhoto, 'userphoto', 'photo', 'user_photo')
+register_target_type(User, 'user')
+
+def resolve_target(target_type, target_id):
+    """Returns the object behind a single (target_type, target_id) pair, or None."""
+    model = TARGET_TYPES.get(target_type)
+    if model is None or target_id is None:
+        return None
+    return db.session.get(model, target_id)
+
+def resolve_targets(pairs):
+    """
+    Resolves many (target_type, target_id) pairs with one IN query per model, however
+    many pairs and type-name aliases there are. Objects already in the session's
+    identity map are still returned from the query, so the cost stays fixed.
+
+    Args:
+        pairs (iterable): (target_type, target_id) tuples. Unknown types and None ids
+                          are ignored.
+
+    Returns:
+        dict: Maps each resolvable (target_type, target_id) pair to its object. Pairs
+              whose target no longer exists are absent.
+    """
+    pairs = set(pairs)
+    ids_by_model = {}
+    for target_type, target_id in pairs:
+        model = TARGET_TYPES.get(target_type)
+        if model is not None and target_id is not None:
+            ids_by_model.setdefault(model, set()).add(target_id)
+
+    objects_by_model = {
+        model: {obj.id: obj for obj in db.session.scalars(select(model).where(model.id.in_(ids)))}
+        for model, ids in ids_by_model.items()
+    }
+    resolved = {}
+    for target_type, target_id in pairs:
+        obj = objects_by_model.get(TARGET_TYPES.get(target_type), {}).get(target_id)
+        if obj is not None:
+            resolved[(target_type, target_id)] = obj
+    return resolved
+
 class Notification(db.Model):
     __tablename__ = 'notification'
     id = db.Column(db.Integer, primary_key=True)
@@ -441,6 +1206,11 @@ class Notification(db.Model):
     is_read = db.Column(db.Boolean, default=False, nullable=False)
     timestamp = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), nullable=False)
 
+    # Coalesced notifications (see `notify`): one row stands for actor_count events, with
+    # actor_id the most recent actor and recent_actor_ids a JSON list of the latest few.
+    actor_count = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    recent_actor_ids = db.Column(db.Text, nullable=True)
+
     # Relationships to easily get related objects from a notification
     # user is defined by backref from User.notifications
     actor = db.relationship('User', foreign_keys=[actor_id])
@@ -448,46 +1218,42 @@ class Notification(db.Model):
     # related_comment = db.relationship('Comment', foreign_keys=[related_comment_id]) # REMOVED
 
     # New polymorphic target fields
-    target_type = db.Column(db.String(50), nullable=True) # e.g., 'post', 'comment', 'user_photo', 'user'
+    target_type = db.Column(db.String(50), nullable=True) # A TARGET_TYPES name, e.g. 'post', 'comment', 'userphoto', 'user'
     target_id = db.Column(db.Integer, nullable=True)
 
     # Remove ForeignKeyConstraints for old columns from __table_args__
-    __table_args__ = (db.Index('ix_notification_target', 'target_type', 'target_id'),)
+    __table_args__ = (
+        db.Index('ix_notification_target', 'target_type', 'target_id'),
+        # Finding the open group a new event coalesces into.
+        db.Index('ix_notification_coalesce', 'user_id', 'type', 'target_type', 'target_id'),
+    )
+
+    @property
+    def recent_actor_id_list(self):
+        """Ids of the most recent actors, newest first (just `actor_id` for plain notifications)."""
+        if self.recent_actor_ids:
+            return json.loads(self.recent_actor_ids)
+        return [self.actor_id] if self.actor_id is not None else []
 
 
     def get_target_object(self):
         """
-        Retrieves the actual target object (e.g., Post, Comment, UserPhoto, User)
-        associated with this notification based on its `target_type` and `target_id`.
-
-        This method dynamically imports model classes to avoid circular dependencies
-        at the module level and uses `db.session.get()` for efficient lookup.
+        Retrieves the target object (e.g., Post, Comment, UserPhoto, User) of this
+        notification. To resolve the targets of many notifications, use
+        `resolve_targets` instead.
 
         Returns:
-            db.Model | None: The SQLAlchemy model instance corresponding to the
-                             notification's target, or None if the target_type is
-                             unrecognized, or if target_type/target_id are not set.
+            db.Model | None: The target instance, or None if target_type is unknown,
+                             target_type/target_id are not set, or the target is gone.
         """
-        if not self.target_type or self.target_id is None:
-            return None
-
-        # Import models locally to avoid circular imports at module level if Notification is imported by these models
-        from .models import Post, Comment, UserPhoto, User
-
-        if self.target_type == 'post':
-            return db.session.get(Post, self.target_id)
-        elif self.target_type == 'comment':
-            return db.session.get(Comment, self.target_id)
-        elif self.target_type == 'photo': # Assuming 'photo' is used for UserPhoto
-            return db.session.get(UserPhoto, self.target_id)
-        elif self.target_type == 'user':
-            return db.session.get(User, self.target_id)
-        # Add other types as needed
-        return None
+        return resolve_target(self.target_type, self.target_id)
 
     def __repr__(self):
         return f'<Notification {self.id} type={self.type} user_id={self.user_id} is_read={self.is_read} target_type={self.target_type} target_id={self.target_id}>'
 
+# Listing a user's notifications newest first. On PostgreSQL the table is also partitioned
+# by month on timestamp (see the migration and `notification_utils.prune_notifications`).
+db.Index('ix_notification_user_timestamp', Notification.user_id, Notification.timestamp.desc(), Notification.id.desc())
 
 def create_notification(user_id, type, actor_id=None, target_type=None, target_id=None):
     """
@@ -503,6 +1269,373 @@ def create_notification(user_id, type, actor_id=None, target_type=None, target_i
     db.session.add(notification)
     db.session.commit()
 
+# Notification types whose events collapse into one row per recipient, e.g. "Ana and 41
+# others liked your post". The value says whether a group is per target (likes of one
+# post) or per recipient only (new followers, whose target is each follower).
+COALESCED_NOTIFICATION_TYPES = {
+    'new_like': True,
+    'new_comment': True,
+    'new_follower': False,
+}
+
+def notify(user_id, type, actor_ids, target_type=None, target_id=None):
+    """
+    Notifies `user_id` that `actor_ids` (oldest first) did something. For
+    COALESCED_NOTIFICATION_TYPES the event is folded into the recipient's latest
+    unread notification of the same type and target if that was updated within
+    NOTIFICATION_COALESCE_WINDOW_SECONDS: its actor_count grows, it moves to the top
+    and the newest actors are remembered. Otherwise a new notification row is added.
+    Actors equal to the recipient are ignored. The caller commits.
+
+    actor_count counts events; an actor already among the recent actors (say, liking
+    again after an unlike) isn't counted twice.
+
+    Returns:
+        Notification or None: The new or updated notification, or None if there was
+                              nobody to notify about.
+    """
+    actor_ids = [actor_id for actor_id in dict.fromkeys(actor_ids) if actor_id != user_id]
+    if not actor_ids:
+        return None
+    now = datetime.now(timezone.utc)
+    recent_limit = current_app.config.get('NOTIFICATION_RECENT_ACTORS', 3)
+    newest_first = actor_ids[::-1]
+
+    window = current_app.config.get('NOTIFICATION_COALESCE_WINDOW_SECONDS', 86400)
+    group = None
+    if type in COALESCED_NOTIFICATION_TYPES and window > 0:
+        read_id = select(User.notifications_read_id).where(User.id == user_id).scalar_subquery()
+        query = Notification.query.filter(
+            Notification.user_id == user_id,
+            Notification.type == type,
+            Notification.is_read == False, # noqa E712
+            Notification.id > read_id,
+            Notification.timestamp >= now - timedelta(seconds=window)
+        )
+        if COALESCED_NOTIFICATION_TYPES[type]:
+            query = query.filter(Notification.target_type == target_type, Notification.target_id == target_id)
+        group = query.order_by(Notification.id.desc()).first()
+
+    if group is None:
+        notification = Notification(
+            user_id=user_id, type=type, actor_id=newest_first[0],
+            target_type=target_type, target_id=target_id, timestamp=now,
+            actor_count=len(actor_ids), recent_actor_ids=json.dumps(newest_first[:recent_limit])
+        )
+        db.session.add(notification)
+        return notification
+
+    previous_recent = group.recent_actor_id_list
+    new_actor_count = sum(1 for actor_id in actor_ids if actor_id not in previous_recent)
+    group.recent_actor_ids = json.dumps(list(dict.fromkeys(newest_first + previous_recent))[:recent_limit])
+    group.actor_id = newest_first[0]
+    group.timestamp = now
+    if new_actor_count:
+        group.actor_count = Notification.actor_count + new_actor_count # Atomic with concurrent events
+    if not COALESCED_NOTIFICATION_TYPES[type]:
+        group.target_type, group.target_id = target_type, target_id
+    return group
+
+class NotificationUnreadCount(db.Model):
+    """
+    A user's unread personal notifications of one type, for per-type badges. A row only
+    counts while its read_id equals the user's `notifications_read_id`; once that
+    watermark moves (mark all as read) the row is stale, reads as zero and is reset by
+    the next notification of its type, so marking all as read never touches this table.
+    """
+    __tablename__ = 'notification_unread_count'
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), primary_key=True)
+    type = db.Column(db.String(50), primary_key=True)
+    unread_count = db.Column(db.Integer, nullable=False, default=0)
+    read_id = db.Column(db.Integer, nullable=False, default=0) # The user's notifications_read_id this count is relative to
+
+def _adjust_unread_notifications(connection, user_id, notification_id, type_deltas):
+    """
+    Adjusts a user's unread counters (total and per type) for notifications that became
+    unread (positive deltas) or read/deleted (negative deltas). Notifications at or
+    below the user's notifications_read_id are already read, so nothing changes unless
+    `notification_id`, the lowest id involved, is above it.
+    """
+    user_table, counts_table = User.__table__, NotificationUnreadCount.__table__
+    statement = _update_keeping_timestamps(
+        user_table, {'unread_notifications': user_table.c.unread_notifications + sum(type_deltas.values())}
+    ).where(user_table.c.id == user_id)
+    if notification_id is not None: # None for notifications being created
+        statement = statement.where(user_table.c.notifications_read_id < notification_id)
+    if connection.dialect.update_returning:
+        read_id = connection.execute(statement.returning(user_table.c.notifications_read_id)).scalar()
+    elif connection.execute(statement).rowcount:
+        read_id = connection.scalar(select(user_table.c.notifications_read_id).where(user_table.c.id == user_id))
+    else:
+        read_id = None
+    if read_id is None:
+        return
+
+    dialect_insert = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}.get(connection.dialect.name)
+    for notification_type, delta in type_deltas.items():
+        key = (counts_table.c.user_id == user_id) & (counts_table.c.type == notification_type)
+        if delta < 0:
+            connection.execute(counts_table.update().values(unread_count=counts_table.c.unread_count + delta)
+                               .where(key, counts_table.c.read_id == read_id))
+            continue
+        # Counts relative to an older watermark restart from these notifications.
+        restarted_count = db.case((counts_table.c.read_id == read_id, counts_table.c.unread_count + delta), else_=delta)
+        if dialect_insert is not None:
+            insert = dialect_insert(counts_table).values(
+                user_id=user_id, type=notification_type, unread_count=delta, read_id=read_id
+            )
+            connection.execute(insert.on_conflict_do_update(
+                index_elements=[counts_table.c.user_id, counts_table.c.type],
+                set_={'unread_count': restarted_count, 'read_id': read_id}
+            ))
+        elif not connection.execute(counts_table.update().values(unread_count=restarted_count, read_id=read_id).where(key)).rowcount:
+            connection.execute(counts_table.insert().values(
+                user_id=user_id, type=notification_type, unread_count=delta, read_id=read_id
+            ))
+
+def count_new_notifications(connection, user_ids, notification_type):
+    """
+    Bulk counterpart of the after_insert hook below, for notifications written with a
+    multi-row INSERT: counts one new unread `notification_type` notification for each
+    of `user_ids` with one UPDATE and one INSERT ... SELECT ... ON CONFLICT.
+    """
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+    dialect_insert = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}.get(connection.dialect.name)
+    if dialect_insert is None:
+        for user_id in user_ids:
+            _adjust_unread_notifications(connection, user_id, None, {notification_type: 1})
+        return
+    user_table, counts_table = User.__table__, NotificationUnreadCount.__table__
+    connection.execute(_update_keeping_timestamps(
+        user_table, {'unread_notifications': user_table.c.unread_notifications + 1}
+    ).where(user_table.c.id.in_(user_ids)))
+    insert = dialect_insert(counts_table).from_select(
+        ['user_id', 'type', 'unread_count', 'read_id'],
+        select(user_table.c.id, db.literal(notification_type), db.literal(1), user_table.c.notifications_read_id)
+        .where(user_table.c.id.in_(user_ids))
+    )
+    connection.execute(insert.on_conflict_do_update(
+        index_elements=[counts_table.c.user_id, counts_table.c.type],
+        set_={
+            'unread_count': db.case(
+                (counts_table.c.read_id == insert.excluded.read_id, counts_table.c.unread_count + 1), else_=1
+            ),
+            'read_id': insert.excluded.read_id,
+        }
+    ))
+
+# Like the other counters, these run inside the flush so the unread counts commit or roll
+# back with the notification. Bulk UPDATEs go through `mark_notifications_read` instead.
+@db.event.listens_for(Notification, 'after_insert')
+def on_notification_inserted(mapper, connection, target):
+    if not target.is_read:
+        _adjust_unread_notifications(connection, target.user_id, target.id, {target.type: 1})
+
+@db.event.listens_for(Notification, 'after_update')
+def on_notification_updated(mapper, connection, target):
+    if db.inspect(target).attrs.is_read.history.has_changes():
+        delta = -1 if target.is_read else 1
+        _adjust_unread_notifications(connection, target.user_id, target.id, {target.type: delta})
+
+@db.event.listens_for(Notification, 'before_delete')
+def on_notification_deleted(mapper, connection, target):
+    if not target.is_read:
+        _adjust_unread_notifications(connection, target.user_id, target.id, {target.type: -1})
+
+def mark_notifications_read(user, notification_ids):
+    """
+    Marks some of a user's notifications read with one UPDATE and adjusts the unread
+    counters by the rows that actually changed. Notifications covered by the user's
+    notifications_read_id are already read and left as they are. The caller commits.
+
+    Returns:
+        int: The number of notifications that were unread.
+    """
+    notification_ids = list(notification_ids)
+    if not notification_ids:
+        return 0
+    connection = db.session.connection()
+    table, user_table = Notification.__table__, User.__table__
+    read_id = select(user_table.c.notifications_read_id).where(user_table.c.id == user.id).scalar_subquery()
+    condition = (table.c.user_id == user.id) & table.c.id.in_(notification_ids) \
+        & (table.c.id > read_id) & (table.c.is_read == False) # noqa E712
+    if connection.dialect.update_returning:
+        changed = connection.execute(
+            table.update().values(is_read=True).where(condition).returning(table.c.id, table.c.type)
+        ).all()
+    else:
+        changed = connection.execute(select(table.c.id, table.c.type).where(condition)).all()
+        connection.execute(table.update().values(is_read=True).where(table.c.id.in_([row.id for row in changed])))
+    if changed:
+        type_deltas = {}
+        for _, notification_type in changed:
+            type_deltas[notification_type] = type_deltas.get(notification_type, 0) - 1
+        _adjust_unread_notifications(connection, user.id, min(row.id for row in changed), type_deltas)
+    return len(changed)
+
+def mark_all_notifications_read(user):
+    """
+    Marks all of a user's notifications read, broadcasts included, with a single UPDATE
+    of the user row: both read watermarks move up to the newest notification and the
+    unread counter drops to zero. Per-type counts go stale with the old watermark (see
+    NotificationUnreadCount). The caller commits.
+
+    Returns:
+        int: The number of personal notifications that were unread.
+    """
+    user_table, notification_table = User.__table__, Notification.__table__
+    broadcast_table = BroadcastNotification.__table__
+    newest_notification_id = select(func.max(notification_table.c.id))\
+        .where(notification_table.c.user_id == user.id).scalar_subquery()
+    newest_broadcast_id = select(func.max(broadcast_table.c.id)).scalar_subquery()
+    def advanced(column, newest_id):
+        # Watermarks never move back, e.g. if the newest notification has since been deleted.
+        return db.case((newest_id > column, newest_id), else_=column)
+    db.session.execute(_update_keeping_timestamps(user_table, {
+        'notifications_read_id': advanced(user_table.c.notifications_read_id, newest_notification_id),
+        'broadcast_read_id': advanced(user_table.c.broadcast_read_id, newest_broadcast_id),
+        'unread_notifications': 0,
+    }).where(user_table.c.id == user.id))
+    return user.unread_notifications
+
+def unread_notification_counts(user):
+    """
+    Returns the user's unread notification counts per type, broadcasts included, from
+    the maintained counters rather than by counting notification rows.
+    """
+    counts_table = NotificationUnreadCount.__table__
+    rows = db.session.execute(select(counts_table.c.type, counts_table.c.unread_count).where(
+        counts_table.c.user_id == user.id,
+        counts_table.c.read_id == user.notifications_read_id,
+        counts_table.c.unread_count > 0
+    ))
+    counts = dict(rows.all())
+    for broadcast_type, broadcast_count in _unread_broadcast_counts(user):
+        counts[broadcast_type] = counts.get(broadcast_type, 0) + broadcast_count
+    return counts
+
+async def unread_notification_counts_async(session, user):
+    """`unread_notification_counts` for coroutines, with an `AsyncSession` (see `async_db`)."""
+    counts_table = NotificationUnreadCount.__table__
+    rows = await session.execute(select(counts_table.c.type, counts_table.c.unread_count).where(
+        counts_table.c.user_id == user.id,
+        counts_table.c.read_id == user.notifications_read_id,
+        counts_table.c.unread_count > 0
+    ))
+    counts = dict(rows.all())
+    read_id = max(user.broadcast_read_id, user.broadcast_joined_id)
+    if _latest_broadcast['id'] > read_id or _latest_broadcast['expires_at'] <= time.monotonic():
+        broadcast_rows = await session.execute(
+            select(BroadcastNotification.type, func.count())
+            .where(BroadcastNotification.id > read_id)
+            .group_by(BroadcastNotification.type)
+        )
+        for broadcast_type, broadcast_count in broadcast_rows.all():
+            counts[broadcast_type] = counts.get(broadcast_type, 0) + broadcast_count
+    return counts
+
+def count_unread_notifications(user):
+    """The user's total unread notifications, broadcasts included; usually without a query."""
+    return user.unread_notifications + sum(count for _, count in _unread_broadcast_counts(user))
+
+class BroadcastNotification(db.Model):
+    """
+    A notification addressed to every user, stored once instead of as one Notification
+    row per user. It's merged into each user's notifications when they're read, and
+    counts as read once the user's `broadcast_read_id` watermark reaches it. Users
+    don't see broadcasts sent before they registered (`broadcast_joined_id`).
+    """
+    __tablename__ = 'broadcast_notification'
+    id = db.Column(db.Integer, primary_key=True)
+    actor_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True) # User who performed action
+    type = db.Column(db.String(50), nullable=False) # e.g., 'user_approved', 'site_setting_changed'
+    target_type = db.Column(db.String(50), nullable=True) # A TARGET_TYPES name
+    target_id = db.Column(db.Integer, nullable=True)
+    timestamp = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), nullable=False, index=True)
+
+    actor = db.relationship('User', foreign_keys=[actor_id])
+
+    def get_target_object(self):
+        """Retrieves the target object of this broadcast. See `Notification.get_target_object`."""
+        return resolve_target(self.target_type, self.target_id)
+
+    def __repr__(self):
+        return f'<BroadcastNotification {self.id} type={self.type} target_type={self.target_type} target_id={self.target_id}>'
+
+def create_broadcast_notification(type, actor_id=None, target_type=None, target_id=None):
+    """
+    Creates and saves a notification for every user as a single row, so notifying the
+    whole user base costs the same as notifying one user.
+    """
+    broadcast = BroadcastNotification(
+        type=type,
+        actor_id=actor_id,
+        target_type=target_type,
+        target_id=target_id
+    )
+    db.session.add(broadcast)
+    db.session.commit()
+    remember_latest_broadcast_id(broadcast.id)
+    return broadcast
+
+class NotificationFanOut(db.Model):
+    """
+    A background job notifying every follower of `actor_id` about one new item, e.g. a
+    'new_photo_by_followed_user' notification per gallery photo. Followers are handled
+    in id order and `last_follower_id` is committed with each batch of notifications,
+    so an interrupted job resumes where it stopped (see `notification_utils`).
+    """
+    __tablename__ = 'notification_fan_out'
+    id = db.Column(db.Integer, primary_key=True)
+    actor_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    type = db.Column(db.String(50), nullable=False)
+    target_type = db.Column(db.String(50), nullable=True)
+    target_id = db.Column(db.Integer, nullable=True)
+    last_follower_id = db.Column(db.Integer, nullable=False, default=0) # Followers up to this id are notified
+    notified_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+    completed_at = db.Column(db.DateTime, nullable=True, index=True)
+
+    def __repr__(self):
+        return f'<NotificationFanOut {self.id} type={self.type} actor_id={self.actor_id} last_follower_id={self.last_follower_id}>'
+
+# Newest broadcast id, cached per process so unread badges only query broadcasts when
+# there is one the user hasn't read. Other processes' broadcasts show up within
+# LATEST_BROADCAST_TTL_SECONDS.
+_latest_broadcast = {'id': 0, 'expires_at': 0.0}
+
+def latest_broadcast_id():
+    now = time.monotonic()
+    if _latest_broadcast['expires_at'] <= now:
+        latest_id = db.session.scalar(select(func.max(BroadcastNotification.id))) or 0
+        _latest_broadcast.update(
+            id=max(latest_id, _latest_broadcast['id']),
+            expires_at=now + current_app.config.get('LATEST_BROADCAST_TTL_SECONDS', 60)
+        )
+    return _latest_broadcast['id']
+
+def remember_latest_broadcast_id(broadcast_id):
+    """Records a broadcast known to exist (e.g. one just sent) without waiting for the TTL."""
+    _latest_broadcast['id'] = max(_latest_broadcast['id'], broadcast_id)
+
+def _unread_broadcast_counts(user):
+    read_id = max(user.broadcast_read_id, user.broadcast_joined_id)
+    if latest_broadcast_id() <= read_id:
+        return []
+    return db.session.execute(
+        select(BroadcastNotification.type, func.count())
+        .where(BroadcastNotification.id > read_id)
+        .group_by(BroadcastNotification.type)
+    ).all()
+
+@db.event.listens_for(User, 'before_insert')
+def on_user_joining(mapper, connection, target):
+    # New accounts start after the latest broadcast, like per-user notifications did.
+    latest_broadcast_id = connection.scalar(select(func.max(BroadcastNotification.id))) or 0
+    target.broadcast_joined_id = target.broadcast_read_id = latest_broadcast_id
+
 class Activity(db.Model):
     __tablename__ = 'activity'
     id = db.Column(db.Integer, primary_key=True)
@@ -531,7 +1664,7 @@ class Activity(db.Model):
     # target_post = db.relationship('Post', foreign_keys=[target_post_id]) # REMOVED (was implicitly defined by FK)
 
     # New polymorphic target fields
-    target_type = db.Column(db.String(50), nullable=True) # e.g., 'post', 'comment', 'user_photo', 'user'
+    target_type = db.Column(db.String(50), nullable=True) # A TARGET_TYPES name, e.g. 'post', 'comment', 'userphoto', 'user'
     target_id = db.Column(db.Integer, nullable=True)
 
     # Add an index for common queries
@@ -544,37 +1677,21 @@ class Activity(db.Model):
 
     def get_target_object(self):
         """
-        Retrieves the actual target object (e.g., Post, Comment, UserPhoto, User)
-        associated with this activity based on its `target_type` and `target_id`.
-
-        This method dynamically imports model classes to avoid circular dependencies
-        at the module level and uses `db.session.get()` for efficient lookup.
+        Retrieves the target object (e.g., Post, Comment, UserPhoto, User) of this
+        activity. To resolve the targets of many activities, use `resolve_targets` instead.
 
         Returns:
-            db.Model | None: The SQLAlchemy model instance corresponding to the
-                             activity's target, or None if the target_type is
-                             unrecognized, or if target_type/target_id are not set.
+            db.Model | None: The target instance, or None if target_type is unknown,
+                             target_type/target_id are not set, or the target is gone.
         """
-        if not self.target_type or self.target_id is None:
-            return None
-
-        # Import models locally
-        from .models import Post, Comment, UserPhoto, User
-
-        if self.target_type == 'post':
-            return db.session.get(Post, self.target_id)
-        elif self.target_type == 'comment':
-            return db.session.get(Comment, self.target_id)
-        elif self.target_type == 'photo': # Assuming 'photo' is used for UserPhoto
-            return db.session.get(UserPhoto, self.target_id)
-        elif self.target_type == 'user':
-            return db.session.get(User, self.target_id)
-        # Add other types as needed
-        return None
+        return resolve_target(self.target_type, self.target_id)
 
     def __repr__(self):
         return f'<Activity {self.id} type={self.type} user_id={self.user_id} target_type={self.target_type} target_id={self.target_id}>'
 
+# Keyset pagination of the activity stream orders by (timestamp, id).
+db.Index('ix_activity_timestamp_id', Activity.timestamp.desc(), Activity.id.desc())
+
 
 class SiteSetting(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -619,3 +1736,37 @@ class SiteSetting(db.Model):
         setting.value_type = value_type
 
         db.session.commit()
+
+class TaskJob(db.Model):
+    """
+    A queued run of a registered task (see `tasks` and `worker`), used when TASK_BACKEND
+    is 'database'. Workers lease a job by setting `leased_until`; a job whose lease runs
+    out (its worker died) is picked up again. Failed runs are retried with backoff until
+    `max_attempts`, after which the job stays here with status 'dead' for inspection.
+    Jobs that succeed are deleted.
+    """
+    __tablename__ = 'task_job'
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_DEAD = 'dead'
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    kwargs = db.Column(db.Text, nullable=False, default='{}') # JSON object of the task's keyword arguments
+    priority = db.Column(db.Integer, nullable=False, default=0) # Higher runs first
+    status = db.Column(db.String(20), nullable=False, default=STATUS_QUEUED)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_at = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc)) # Not before
+    leased_until = db.Column(db.DateTime, nullable=True)
+    leased_by = db.Column(db.String(255), nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+
+    __table_args__ = (
+        # Backs the workers' "next runnable job" lookup.
+        db.Index('ix_task_job_runnable', 'status', 'priority', 'run_at'),
+    )
+
+    def __repr__(self):
+        return f'<TaskJob {self.id} {self.name} status={self.status} attempts={self.attempts}/{self.max_attempts}>'
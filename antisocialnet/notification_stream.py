@@ -0,0 +1,470 @@
+"""
+Live notifications: a Server-Sent Events stream and a long-poll fallback.
+
+Open streams cost nothing while their user has no news. Each process runs one
+`NotificationBroker`, and streams (or long polls) just wait on it for their user. The
+broker learns about changes in two ways:
+
+* Commits in this process: inserted and updated `Notification` rows (new notifications,
+  coalesced groups growing, reads) and new broadcasts are collected in the session and
+  published when the transaction commits. Follower fan-out publishes each batch.
+* Everything else (other processes, bulk UPDATEs such as mark-all-read): while any
+  stream is open, one poller thread per process checks every
+  NOTIFICATION_STREAM_POLL_SECONDS with a few indexed queries over the connected users,
+  however many streams there are.
+
+A woken stream loads what changed for its user and sends `notification` events (new
+notifications, in id order, then coalesced groups that grew, which replace the client's
+copy with the same id) and an `unread` event when the unread counts change. Event ids
+are "<notification id>-<broadcast id>-<load time in ms>", the newest of each delivered
+and when groups were last checked, so a reconnecting EventSource resumes from
+Last-Event-ID. Idle streams get a comment frame every
+NOTIFICATION_STREAM_HEARTBEAT_SECONDS and end after NOTIFICATION_STREAM_MAX_SECONDS, when
+the browser reconnects (re-checking the session). A stream only holds a database
+connection while loading; waiting, it's a thread (or greenlet, under gevent) blocked on
+an event, or under ASGI (see `asgi`) just a coroutine.
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+from datetime import datetime, timezone, timedelta
+from flask import current_app
+from sqlalchemy import select, func
+from sqlalchemy.orm import Session, joinedload
+
+from . import db
+from .models import (
+    Notification, BroadcastNotification, User, unread_notification_counts, remember_latest_broadcast_id
+)
+from .api_utils import serialize_notifications
+
+# Coalesced groups updated this long before a load are checked again on the next one, in
+# case the transaction that updated them hadn't committed yet.
+_UPDATE_SKEW = timedelta(seconds=5)
+
+class NotificationBroker:
+    """Wakes the streams of users whose notifications changed; one per process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {} # user_id -> open streams and polls
+        self._versions = {} # user_id -> change counter, kept while subscribed
+        self._broadcast_version = 0
+        self._waiters = {} # user_id -> set of objects with a thread-safe set(), e.g. threading.Event
+        self._poller_pid = None
+
+    def subscribe(self, user_id, app=None):
+        app = app or current_app._get_current_object()
+        with self._lock:
+            self._subscribers[user_id] = self._subscribers.get(user_id, 0) + 1
+            self._versions.setdefault(user_id, 0)
+            start_poller = self._poller_pid != os.getpid()
+            if start_poller:
+                # Started lazily, and again in a forked worker, whose copy of the thread is gone.
+                self._poller_pid = os.getpid()
+        if start_poller:
+            threading.Thread(
+                target=self._run_poller, args=(app,), name='antisocialnet-notification-poller', daemon=True
+            ).start()
+
+    def unsubscribe(self, user_id):
+        with self._lock:
+            remaining = self._subscribers.get(user_id, 1) - 1
+            if remaining > 0:
+                self._subscribers[user_id] = remaining
+            else:
+                self._subscribers.pop(user_id, None)
+                self._versions.pop(user_id, None)
+
+    def version(self, user_id):
+        with self._lock:
+            return (self._versions.get(user_id, 0), self._broadcast_version)
+
+    def publish(self, user_ids=(), broadcast=False):
+        """Wakes the waiting streams of `user_ids`, or of everyone for a broadcast."""
+        with self._lock:
+            woken = set()
+            for user_id in user_ids:
+                if user_id in self._versions:
+                    self._versions[user_id] += 1
+                    woken.update(self._waiters.get(user_id, ()))
+            if broadcast:
+                self._broadcast_version += 1
+                for events in self._waiters.values():
+                    woken.update(events)
+        for event in woken:
+            event.set()
+
+    def wait(self, user_id, seen_version, timeout):
+        """
+        Blocks until the user's notifications change after `seen_version` (from
+        `version`) or `timeout` seconds pass. The user must be subscribed.
+
+        Returns:
+            tuple: The user's current version.
+        """
+        event = threading.Event()
+        if self._add_waiter(user_id, seen_version, event):
+            try:
+                event.wait(max(0, timeout))
+            finally:
+                self._remove_waiter(user_id, event)
+        return self.version(user_id)
+
+    async def wait_async(self, user_id, seen_version, timeout):
+        """Like `wait`, but suspends the calling coroutine instead of blocking its thread."""
+        waiter = _AsyncWaiter(asyncio.get_running_loop())
+        if self._add_waiter(user_id, seen_version, waiter):
+            try:
+                await asyncio.wait_for(waiter.event.wait(), max(0, timeout))
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self._remove_waiter(user_id, waiter)
+        return self.version(user_id)
+
+    def _add_waiter(self, user_id, seen_version, waiter):
+        # Returns False instead if there's news already.
+        with self._lock:
+            if (self._versions.get(user_id, 0), self._broadcast_version) != seen_version:
+                return False
+            self._waiters.setdefault(user_id, set()).add(waiter)
+            return True
+
+    def _remove_waiter(self, user_id, waiter):
+        with self._lock:
+            waiters = self._waiters.get(user_id)
+            if waiters is not None:
+                waiters.discard(waiter)
+                if not waiters:
+                    del self._waiters[user_id]
+
+    def _run_poller(self, app):
+        state = None
+        interval = app.config.get('NOTIFICATION_STREAM_POLL_SECONDS', 1.0)
+        while True:
+            with self._lock:
+                if not self._subscribers:
+                    self._poller_pid = None # Restarted by the next subscriber
+                    return
+                user_ids = list(self._subscribers)
+            with app.app_context():
+                try:
+                    state = self._poll(user_ids, state)
+                except Exception as e: # pragma: no cover - e.g. the database is unreachable
+                    app.logger.error(f"Notification stream poller error: {e}", exc_info=True)
+                finally:
+                    db.session.remove()
+            time.sleep(interval)
+
+    def _poll(self, user_ids, state):
+        """
+        Compares the connected users' notifications with the previous poll's `state` and
+        wakes those that changed. Returns the new state.
+        """
+        started = datetime.now(timezone.utc)
+        max_notification_id = db.session.scalar(select(func.max(Notification.id))) or 0
+        max_broadcast_id = db.session.scalar(select(func.max(BroadcastNotification.id))) or 0
+        user_states = {}
+        changed = set()
+        for start in range(0, len(user_ids), 500):
+            chunk = user_ids[start:start + 500]
+            for row in db.session.execute(select(
+                User.id, User.unread_notifications, User.notifications_read_id, User.broadcast_read_id
+            ).where(User.id.in_(chunk))):
+                user_states[row[0]] = tuple(row[1:])
+            if state is None:
+                continue
+            # New rows (including bulk inserts with an older timestamp) and rows updated
+            # since the last poll (coalesced groups).
+            changed.update(db.session.scalars(select(Notification.user_id).where(
+                Notification.id > state['notification_id'], Notification.user_id.in_(chunk)
+            ).distinct()))
+            changed.update(db.session.scalars(select(Notification.user_id).where(
+                Notification.user_id.in_(chunk), Notification.timestamp >= state['since']
+            ).distinct()))
+        if state is not None:
+            changed.update(
+                user_id for user_id, user_state in user_states.items()
+                if state['users'].get(user_id, user_state) != user_state
+            )
+            broadcast = max_broadcast_id > state['broadcast_id']
+            if broadcast:
+                remember_latest_broadcast_id(max_broadcast_id)
+            if changed or broadcast:
+                self.publish(changed, broadcast=broadcast)
+        return {
+            'notification_id': max_notification_id,
+            'broadcast_id': max_broadcast_id,
+            'users': user_states,
+            'since': started - _UPDATE_SKEW,
+        }
+
+class _AsyncWaiter:
+    """Wakes a coroutine's asyncio.Event from whichever thread publishes."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.event = asyncio.Event()
+
+    def set(self):
+        self.loop.call_soon_threadsafe(self.event.set)
+
+notification_broker = NotificationBroker()
+
+class NotificationFeed:
+    """
+    What one stream or long poll has delivered to a user, and loading what's new since.
+    The cursor is "<notification id>-<broadcast id>-<load time in ms>", as used for SSE
+    event ids. After a load, `event_ids` has the cursor to resume from after each of the
+    loaded notifications, so a client that only got part of them resumes at the right row.
+    """
+
+    def __init__(self, user_id, cursor=None):
+        self.user_id = user_id
+        self.notification_id, self.broadcast_id, loaded_at = self.parse_cursor(cursor)
+        self.resumed = self.notification_id is not None
+        self.loaded_at = loaded_at or datetime.now(timezone.utc)
+        # A resumed feed picks up groups updated since its previous load; later loads also
+        # re-check the last few seconds (never before this start) and skip versions
+        # they've already sent.
+        self._started_at = self.updated_since = self.loaded_at
+        self._sent_versions = {} # notification id -> timestamp of the version sent
+        self._unread = None
+        self.event_ids = []
+
+    @staticmethod
+    def parse_cursor(cursor):
+        try:
+            notification_id, broadcast_id, loaded_at_ms = (int(part) for part in (cursor or '').split('-'))
+        except ValueError:
+            return None, None, None
+        loaded_at = datetime.fromtimestamp(loaded_at_ms / 1000, timezone.utc)
+        return max(0, notification_id), max(0, broadcast_id), min(loaded_at, datetime.now(timezone.utc))
+
+    @staticmethod
+    def format_cursor(notification_id, broadcast_id, loaded_at):
+        return f'{notification_id}-{broadcast_id}-{int(loaded_at.timestamp() * 1000)}'
+
+    @property
+    def cursor(self):
+        return self.format_cursor(self.notification_id, self.broadcast_id, self.loaded_at)
+
+    def load(self):
+        """
+        Loads notifications newer than the cursor, coalesced groups updated since the last
+        load, and the unread counts, then releases the database connection.
+
+        Returns:
+            tuple: (serialized notifications, unread counts by type or None if unchanged)
+        """
+        try:
+            return self._load()
+        finally:
+            db.session.close()
+
+    def _load(self):
+        user = db.session.get(User, self.user_id)
+        if user is None:
+            return [], None
+        page_size = current_app.config.get('NOTIFICATION_STREAM_REPLAY_LIMIT', 100)
+        if self.notification_id is None:
+            # A new stream starts from now; only the unread counts are sent.
+            self.notification_id = db.session.scalar(
+                select(func.max(Notification.id)).where(Notification.user_id == user.id)
+            ) or 0
+            self.broadcast_id = db.session.scalar(select(func.max(BroadcastNotification.id))) or 0
+            new, broadcasts, updated = [], [], []
+        else:
+            new = _load_pages(
+                Notification.query.options(joinedload(Notification.actor))
+                .filter(Notification.user_id == user.id), Notification.id, self.notification_id, page_size
+            )
+            broadcasts = _load_pages(
+                BroadcastNotification.query.options(joinedload(BroadcastNotification.actor)),
+                BroadcastNotification.id, max(self.broadcast_id, user.broadcast_joined_id), page_size
+            )
+            updated = _load_pages(
+                Notification.query.options(joinedload(Notification.actor))
+                .filter(Notification.user_id == user.id, Notification.id <= self.notification_id,
+                        Notification.timestamp >= self.updated_since), Notification.id, 0, page_size
+            )
+            updated = [n for n in updated if self._sent_versions.get(n.id) != n.timestamp]
+
+        window_start, row_notification_id, row_broadcast_id = self.updated_since, self.notification_id, self.broadcast_id
+        self.loaded_at = datetime.now(timezone.utc)
+        self.updated_since = max(self._started_at, self.loaded_at - _UPDATE_SKEW)
+        self._sent_versions = {
+            notification_id: timestamp for notification_id, timestamp in self._sent_versions.items()
+            if timestamp.replace(tzinfo=timezone.utc) >= self.updated_since
+        }
+        for notification in new + updated:
+            self._sent_versions[notification.id] = notification.timestamp
+        if new:
+            self.notification_id = new[-1].id
+        if broadcasts:
+            self.broadcast_id = broadcasts[-1].id
+            remember_latest_broadcast_id(self.broadcast_id)
+
+        # Updated groups go first: resuming after one re-checks this load's window for
+        # updates, while resuming after a new row or broadcast only skips what came before it.
+        self.event_ids = [self.format_cursor(row_notification_id, row_broadcast_id, window_start) for _ in updated]
+        for notification in new + broadcasts:
+            if isinstance(notification, BroadcastNotification):
+                row_broadcast_id = notification.id
+            else:
+                row_notification_id = notification.id
+            self.event_ids.append(self.format_cursor(row_notification_id, row_broadcast_id, self.loaded_at))
+        if self.event_ids:
+            self.event_ids[-1] = self.cursor # Everything was delivered with the last one
+
+        notifications = serialize_notifications(
+            updated + new + broadcasts,
+            broadcast_read_id=user.broadcast_read_id, notifications_read_id=user.notifications_read_id
+        )
+        unread = unread_notification_counts(user)
+        if unread == self._unread:
+            return notifications, None
+        self._unread = unread
+        return notifications, unread
+
+def _load_pages(query, id_column, after_id, page_size):
+    """All rows of `query` with `id_column` above `after_id`, in id order, read `page_size` at a time."""
+    rows = []
+    while True:
+        page = query.filter(id_column > after_id).order_by(id_column).limit(page_size).all()
+        rows.extend(page)
+        if len(page) < page_size:
+            return rows
+        after_id = page[-1].id
+
+def sse_frame(data, event=None, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    if event is not None:
+        lines.append(f'event: {event}')
+    lines.append(f'data: {json.dumps(data)}')
+    return '\n'.join(lines) + '\n\n'
+
+def retry_frame():
+    """Tells EventSource how soon to reconnect after a stream ends."""
+    return f'retry: {int(current_app.config.get("NOTIFICATION_STREAM_POLL_SECONDS", 1.0) * 1000) + 1000}\n\n'
+
+def feed_frames(feed, notifications, unread):
+    """The SSE frames for one `NotificationFeed.load()` result."""
+    frames = [
+        sse_frame(notification, event='notification', event_id=event_id)
+        for notification, event_id in zip(notifications, feed.event_ids)
+    ]
+    if unread is not None:
+        frames.append(sse_frame(
+            {'unread_count': sum(unread.values()), 'unread_by_type': unread}, event='unread', event_id=feed.cursor
+        ))
+    return frames
+
+def poll_result(feed, notifications, unread):
+    """The JSON body of a long poll answered with `notifications` and `unread` counts."""
+    return {
+        'notifications': notifications,
+        'unread_count': sum(unread.values()) if unread else 0,
+        'unread_by_type': unread or {},
+        'cursor': feed.cursor,
+    }
+
+def notification_event_stream(user_id, last_event_id=None):
+    """
+    Yields the SSE frames of one notification stream until NOTIFICATION_STREAM_MAX_SECONDS
+    pass or the client disconnects.
+    """
+    config = current_app.config
+    heartbeat_seconds = config.get('NOTIFICATION_STREAM_HEARTBEAT_SECONDS', 15)
+    deadline = time.monotonic() + config.get('NOTIFICATION_STREAM_MAX_SECONDS', 300)
+    feed = NotificationFeed(user_id, last_event_id)
+    notification_broker.subscribe(user_id)
+    try:
+        yield retry_frame()
+        version = notification_broker.version(user_id)
+        changed = True
+        last_frame_at = time.monotonic()
+        while True:
+            if changed:
+                frames = feed_frames(feed, *feed.load())
+                yield from frames
+                if frames:
+                    last_frame_at = time.monotonic()
+            now = time.monotonic()
+            if now >= deadline:
+                return
+            if now - last_frame_at >= heartbeat_seconds:
+                yield ': heartbeat\n\n'
+                last_frame_at = now
+            timeout = min(deadline, last_frame_at + heartbeat_seconds) - now
+            new_version = notification_broker.wait(user_id, version, timeout)
+            changed, version = new_version != version, new_version
+    finally:
+        notification_broker.unsubscribe(user_id)
+
+def long_poll_notifications(user_id, cursor=None, timeout=None):
+    """
+    Returns what's new since `cursor` (as from a previous call), waiting up to `timeout`
+    seconds (at most NOTIFICATION_LONG_POLL_SECONDS) for a notification or a change of
+    the unread counts if there's nothing yet. Without a cursor it answers right away
+    with the current unread counts and a cursor to poll with.
+
+    Returns:
+        dict: notifications, unread_count, unread_by_type and the next cursor.
+    """
+    max_timeout = current_app.config.get('NOTIFICATION_LONG_POLL_SECONDS', 25)
+    timeout = max_timeout if timeout is None else max(0, min(timeout, max_timeout))
+    deadline = time.monotonic() + timeout
+    feed = NotificationFeed(user_id, cursor)
+    notification_broker.subscribe(user_id)
+    try:
+        version = notification_broker.version(user_id)
+        notifications, unread = feed.load() # The first load always has the unread counts
+        while feed.resumed and not notifications and time.monotonic() < deadline:
+            new_version = notification_broker.wait(user_id, version, deadline - time.monotonic())
+            if new_version == version:
+                continue
+            version = new_version
+            notifications, changed_unread = feed.load()
+            if changed_unread is not None:
+                unread = changed_unread
+                break
+    finally:
+        notification_broker.unsubscribe(user_id)
+    return poll_result(feed, notifications, unread)
+
+# Recipients of notifications changed in a transaction are published once it commits, so
+# streams never load (or miss) uncommitted rows.
+_PENDING_KEY = 'notification_stream_pending'
+
+def _pending(session):
+    return session.info.setdefault(_PENDING_KEY, {'user_ids': set(), 'broadcast': False})
+
+@db.event.listens_for(Notification, 'after_insert')
+@db.event.listens_for(Notification, 'after_update')
+@db.event.listens_for(Notification, 'after_delete')
+def on_notification_changed(mapper, connection, target):
+    session = db.inspect(target).session
+    if session is not None:
+        _pending(session)['user_ids'].add(target.user_id)
+
+@db.event.listens_for(BroadcastNotification, 'after_insert')
+def on_broadcast_sent(mapper, connection, target):
+    session = db.inspect(target).session
+    if session is not None:
+        _pending(session)['broadcast'] = True
+
+@db.event.listens_for(Session, 'after_commit')
+def on_session_committed(session):
+    pending = session.info.pop(_PENDING_KEY, None)
+    if pending:
+        notification_broker.publish(pending['user_ids'], broadcast=pending['broadcast'])
+
+@db.event.listens_for(Session, 'after_rollback')
+def on_session_rolled_back(session):
+    session.info.pop(_PENDING_KEY, None)
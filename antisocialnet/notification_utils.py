@@ -0,0 +1,303 @@
+"""
+Background fan-out of notifications to an author's followers.
+
+Notifying followers of a new post or gallery photo used to happen inside the request,
+one ORM object per follower and item. Now the request only records a
+`NotificationFanOut` job per item and queues the 'notifications.fan_out' task, which
+streams followers in id order, FANOUT_BATCH_SIZE at a time, and writes each batch with
+one multi-row INSERT (batched by SQLAlchemy's insertmanyvalues). The job's
+`last_follower_id` is committed together with each batch, so a job interrupted by a
+crash or deploy resumes exactly after the last notified follower, without duplicates,
+when `flask notifications resume-fan-out` runs.
+
+Likes notify the item's owner through the 'notifications.likes' task, which coalesces
+them into one group per item (see `models.notify`), so a burst of likes costs the
+request nothing and the owner gets "Ana and 41 others liked your post".
+
+Retention: `prune_notifications` (the 'notifications.prune' task, or `flask
+notifications prune` from cron) moves read notifications older than
+NOTIFICATION_RETENTION_DAYS into gzipped NDJSON files, one per month, under
+NOTIFICATION_ARCHIVE_DIR. On PostgreSQL the table is partitioned by month: the pruner
+also creates the next NOTIFICATION_PARTITION_MONTHS_AHEAD partitions and drops old
+partitions once they're empty.
+"""
+import gzip
+import json
+import os
+import re
+from datetime import datetime, timezone, timedelta
+from flask import current_app
+from sqlalchemy import select, update, delete, or_, text
+
+from . import db
+from .models import Notification, NotificationFanOut, FollowerLink, User, count_new_notifications, notify, resolve_target
+from .notification_stream import notification_broker
+from .tasks import task, enqueue
+
+def schedule_follower_notifications(actor_id, type, target_type, target_ids):
+    """
+    Records a fan-out job for each target and queues it, so every follower of
+    `actor_id` gets a `type` notification about each item. Call it after committing the
+    items themselves.
+
+    Returns:
+        list: The ids of the created NotificationFanOut jobs.
+    """
+    jobs = [
+        NotificationFanOut(actor_id=actor_id, type=type, target_type=target_type, target_id=target_id)
+        for target_id in target_ids
+    ]
+    if not jobs:
+        return []
+    db.session.add_all(jobs)
+    db.session.commit()
+    job_ids = [job.id for job in jobs]
+    for job_id in job_ids:
+        enqueue('notifications.fan_out', job_id=job_id)
+    return job_ids
+
+@task('notifications.fan_out')
+def fan_out_notifications(job_id):
+    """
+    Runs (or resumes) a NotificationFanOut job. Each batch of followers gets its
+    notifications, unread counters and the job's progress in one transaction.
+    Followers who follow after the job passed their id aren't notified.
+
+    Returns:
+        int: The number of notifications written by this run.
+    """
+    job = db.session.get(NotificationFanOut, job_id)
+    if job is None or job.completed_at is not None:
+        return 0
+
+    batch_size = current_app.config.get('FANOUT_BATCH_SIZE', 1000)
+    notification_table = Notification.__table__
+    notification_values = {
+        'actor_id': job.actor_id,
+        'type': job.type,
+        'target_type': job.target_type,
+        'target_id': job.target_id,
+        'is_read': False,
+        'timestamp': job.created_at, # Every follower sees the item at the time it was published
+    }
+    last_follower_id = job.last_follower_id
+    written = 0
+    while True:
+        follower_ids = db.session.scalars(
+            select(FollowerLink.follower_id)
+            .where(FollowerLink.followed_id == notification_values['actor_id'],
+                   FollowerLink.follower_id > last_follower_id)
+            .order_by(FollowerLink.follower_id)
+            .limit(batch_size)
+        ).all()
+        if not follower_ids:
+            break
+
+        # Claim the batch by moving the job's cursor first, so two runners of one job
+        # (say, a resume while the original is still going) never notify anyone twice.
+        claimed = db.session.execute(
+            update(NotificationFanOut)
+            .where(NotificationFanOut.id == job_id, NotificationFanOut.last_follower_id == last_follower_id)
+            .values(last_follower_id=follower_ids[-1],
+                    notified_count=NotificationFanOut.notified_count + len(follower_ids)),
+            execution_options={'synchronize_session': False}
+        ).rowcount
+        if not claimed:
+            db.session.rollback()
+            db.session.refresh(job)
+            last_follower_id = job.last_follower_id
+            continue
+
+        db.session.execute(notification_table.insert(), [
+            dict(notification_values, user_id=follower_id) for follower_id in follower_ids
+        ])
+        count_new_notifications(db.session.connection(), follower_ids, notification_values['type'])
+        db.session.commit()
+        notification_broker.publish(follower_ids) # Bulk inserts skip the ORM hooks that do this
+        last_follower_id = follower_ids[-1]
+        written += len(follower_ids)
+
+    db.session.execute(
+        update(NotificationFanOut)
+        .where(NotificationFanOut.id == job_id, NotificationFanOut.completed_at.is_(None))
+        .values(completed_at=datetime.now(timezone.utc)),
+        execution_options={'synchronize_session': False}
+    )
+    db.session.commit()
+    current_app.logger.info(f"Notification fan-out {job_id} ({notification_values['type']}) wrote {written} notification(s).")
+    return written
+
+def resume_notification_fan_outs():
+    """
+    Runs every fan-out job that hasn't completed, e.g. after workers were restarted
+    while jobs were in progress. Jobs still running elsewhere are shared safely: each
+    batch is claimed before it's written.
+
+    Returns:
+        int: The number of jobs resumed.
+    """
+    job_ids = db.session.scalars(
+        select(NotificationFanOut.id).where(NotificationFanOut.completed_at.is_(None)).order_by(NotificationFanOut.id)
+    ).all()
+    for job_id in job_ids:
+        fan_out_notifications(job_id)
+    return len(job_ids)
+
+def schedule_like_notifications(likes):
+    """
+    Queues one 'notifications.likes' task per liked item for the given new likes, in
+    the order they were made. Call it after committing the likes.
+
+    Args:
+        likes (iterable): (user_id, target_type, target_id) tuples.
+    """
+    likers_by_target = {}
+    for user_id, target_type, target_id in likes:
+        likers_by_target.setdefault((target_type, target_id), []).append(user_id)
+    for (target_type, target_id), actor_ids in likers_by_target.items():
+        enqueue('notifications.likes', target_type=target_type, target_id=target_id, actor_ids=actor_ids)
+
+@task('notifications.likes')
+def notify_likes(target_type, target_id, actor_ids):
+    """Adds the likers of an item to its owner's 'new_like' notification group."""
+    item = resolve_target(target_type, target_id)
+    owner_id = getattr(item, 'user_id', None)
+    if owner_id is None:
+        return # The item was deleted meanwhile, or has no owner to tell
+    notify(owner_id, 'new_like', actor_ids, target_type=target_type, target_id=target_id)
+    db.session.commit()
+
+_PARTITION_NAME = re.compile(r'^notification_p(\d{4})_(\d{2})$') # As created by the migration
+
+def _add_months(month_start, months):
+    years, month_index = divmod(month_start.month - 1 + months, 12)
+    return month_start.replace(year=month_start.year + years, month=month_index + 1)
+
+def _notification_partitions(connection):
+    """
+    Returns {month start: partition name} for the monthly partitions of `notification`,
+    or None if the table isn't partitioned (SQLite, or a table made by `db.create_all`).
+    """
+    if connection.dialect.name != 'postgresql' or not connection.scalar(text(
+        "SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'notification'::regclass"
+    )):
+        return None
+    partitions = {}
+    for name in connection.scalars(text(
+        "SELECT child.relname FROM pg_inherits JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE pg_inherits.inhparent = 'notification'::regclass"
+    )):
+        match = _PARTITION_NAME.match(name)
+        if match:
+            partitions[datetime(int(match.group(1)), int(match.group(2)), 1)] = name
+    return partitions
+
+def ensure_notification_partitions():
+    """
+    Creates the monthly partitions for this month and the next
+    NOTIFICATION_PARTITION_MONTHS_AHEAD months that don't exist yet, so new rows don't
+    land in the default partition. Does nothing unless the table is partitioned.
+
+    Returns:
+        list: The names of the created partitions.
+    """
+    partitions = _notification_partitions(db.session.connection())
+    if partitions is None:
+        return []
+    this_month = datetime.now(timezone.utc).replace(tzinfo=None, day=1, hour=0, minute=0, second=0, microsecond=0)
+    created = []
+    for offset in range(current_app.config.get('NOTIFICATION_PARTITION_MONTHS_AHEAD', 2) + 1):
+        month_start = _add_months(this_month, offset)
+        if month_start in partitions:
+            continue
+        name = f'notification_p{month_start:%Y_%m}'
+        db.session.execute(text(
+            f"CREATE TABLE {name} PARTITION OF notification "
+            f"FOR VALUES FROM ('{month_start:%Y-%m-%d}') TO ('{_add_months(month_start, 1):%Y-%m-%d}')"
+        ))
+        created.append(name)
+    db.session.commit()
+    return created
+
+def _drop_empty_notification_partitions(cutoff):
+    """Drops monthly partitions that end before `cutoff` and hold no rows any more."""
+    partitions = _notification_partitions(db.session.connection())
+    dropped = []
+    for month_start, name in sorted((partitions or {}).items()):
+        if _add_months(month_start, 1) > cutoff:
+            break
+        if db.session.scalar(text(f"SELECT 1 FROM {name} LIMIT 1")) is None:
+            db.session.execute(text(f"ALTER TABLE notification DETACH PARTITION {name}"))
+            db.session.execute(text(f"DROP TABLE {name}"))
+            dropped.append(name)
+    db.session.commit()
+    return dropped
+
+def _archive_notification_rows(rows, archive_dir):
+    """
+    Appends rows to their month's gzipped NDJSON archive (each append is a new gzip
+    member; gzip readers see one stream) and syncs the files to disk.
+    """
+    rows_by_month = {}
+    for row in rows:
+        rows_by_month.setdefault(f"{row['timestamp']:%Y-%m}", []).append(row)
+    os.makedirs(archive_dir, exist_ok=True)
+    for month, month_rows in rows_by_month.items():
+        with open(os.path.join(archive_dir, f'notifications-{month}.ndjson.gz'), 'ab') as archive_file:
+            with gzip.GzipFile(fileobj=archive_file, mode='ab') as gzip_file:
+                for row in month_rows:
+                    record = {key: value.isoformat() if isinstance(value, datetime) else value for key, value in row.items()}
+                    gzip_file.write((json.dumps(record) + '\n').encode('utf-8'))
+            archive_file.flush()
+            os.fsync(archive_file.fileno())
+
+@task('notifications.prune', priority=-10)
+def prune_notifications(retention_days=None):
+    """
+    Archives and deletes read notifications (flagged read, or at or below their
+    recipient's read watermark) older than `retention_days`, NOTIFICATION_RETENTION_DAYS
+    by default. Each batch is written to the archive before it's deleted, so a crash in
+    between archives that batch twice on the next run; archive readers should skip ids
+    they've seen. Unread notifications are kept whatever their age, and so are unread
+    counters, which never count read rows.
+
+    On PostgreSQL, also creates upcoming monthly partitions and drops emptied old ones.
+
+    Returns:
+        tuple: (number of notifications archived, names of dropped partitions)
+    """
+    config = current_app.config
+    if retention_days is None:
+        retention_days = config.get('NOTIFICATION_RETENTION_DAYS', 90)
+    batch_size = config.get('NOTIFICATION_PRUNE_BATCH_SIZE', 1000)
+    archive_dir = config.get('NOTIFICATION_ARCHIVE_DIR') or os.path.join(current_app.instance_path, 'notification_archive')
+    cutoff = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(days=retention_days)
+    ensure_notification_partitions()
+
+    table = Notification.__table__
+    is_read = or_(
+        table.c.is_read,
+        table.c.id <= select(User.notifications_read_id).where(User.id == table.c.user_id).scalar_subquery()
+    )
+    archived = 0
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            select(table).where(table.c.id > last_id, table.c.timestamp < cutoff, is_read)
+            .order_by(table.c.id).limit(batch_size)
+        ).mappings().all()
+        if not rows:
+            break
+        _archive_notification_rows(rows, archive_dir)
+        ids = [row['id'] for row in rows]
+        db.session.execute(delete(table).where(table.c.id.in_(ids)))
+        db.session.commit()
+        last_id = ids[-1]
+        archived += len(ids)
+
+    dropped = _drop_empty_notification_partitions(cutoff)
+    current_app.logger.info(
+        f"Archived {archived} notification(s) older than {retention_days} day(s) to {archive_dir}"
+        f"{f'; dropped partitions {dropped}' if dropped else ''}."
+    )
+    return archived, dropped
@@ -4,10 +4,13 @@ from datetime import datetime, timezone
 import functools
 from sqlalchemy.orm import joinedload
 
-from antisocialnet.models import User, CommentFlag, SiteSetting, Comment, create_notification
+from antisocialnet.models import User, CommentFlag, SiteSetting, Comment, create_broadcast_notification
 from antisocialnet.forms import SiteSettingsForm
 from antisocialnet import db
-from antisocialnet.api_utils import serialize_comment_flag, serialize_user_profile
+from antisocialnet.api_utils import serialize_comment_flag, serialize_user_profiles
+from antisocialnet.mention_utils import schedule_mention_relink, mentioned_content
+from antisocialnet.like_buffer import like_buffer
+from antisocialnet.like_filter import like_filter_cache
 
 admin_bp = Blueprint('admin', __name__, url_prefix='/api/v1/admin')
 
@@ -70,9 +73,8 @@ def site_settings():
         SiteSetting.set('posts_per_page', form.posts_per_page.data, 'int')
         SiteSetting.set('allow_registrations', form.allow_registrations.data, 'bool')
         db.session.commit()
-        # Notify users
-        for user in User.query.all():
-            create_notification(user_id=user.id, actor_id=current_user.id, type='site_setting_changed')
+        # Notify users with a single broadcast row
+        create_broadcast_notification(actor_id=current_user.id, type='site_setting_changed')
         return jsonify(status='success', message='Site settings updated successfully.')
     return jsonify(errors=form.errors), 400
 
@@ -83,7 +85,7 @@ def pending_users():
     per_page = current_app.config.get('ADMIN_USERS_PER_PAGE', 15)
     users_query = User.query.filter_by(is_approved=False, is_active=False).order_by(User.id.asc())
     user_pagination = users_query.paginate(page=page, per_page=per_page, error_out=False)
-    pending_users = [serialize_user_profile(user) for user in user_pagination.items]
+    pending_users = serialize_user_profiles(user_pagination.items)
     return jsonify(users=pending_users, pagination={
         'page': user_pagination.page,
         'per_page': user_pagination.per_page,
@@ -103,9 +105,8 @@ def approve_user(user_id):
     user_to_approve.is_approved = True
     user_to_approve.is_active = True
     db.session.commit()
-    # Notify users
-    for user in User.query.all():
-        create_notification(user_id=user.id, actor_id=current_user.id, type='user_approved', target_type='user', target_id=user_to_approve.id)
+    # Notify users with a single broadcast row
+    create_broadcast_notification(actor_id=current_user.id, type='user_approved', target_type='user', target_id=user_id)
     return jsonify(status='success', message=f'User {user_to_approve.username} approved successfully.')
 
 @admin_bp.route('/users/<int:user_id>/reject', methods=['POST'])
@@ -119,6 +120,21 @@ def reject_user(user_id):
     if user_to_reject.is_admin:
         return jsonify(status='error', message='Cannot reject an administrator account.'), 400
 
+    rejected_full_name = user_to_reject.full_name
+    mentioning_content = mentioned_content(user_to_reject.id) # Deleted along with the user
     db.session.delete(user_to_reject)
     db.session.commit()
+    schedule_mention_relink(content=mentioning_content, former_names=[rejected_full_name])
     return jsonify(status='success', message=f'User {user_to_reject.username} rejected and deleted.')
+
+@admin_bp.route('/like-buffer', methods=['GET'])
+@admin_required
+def like_buffer_stats():
+    """Queue depth, durability lag and flush latency of this worker's like buffer."""
+    return jsonify(enabled=current_app.config.get('LIKE_BUFFER_ENABLED', False), stats=like_buffer.stats())
+
+@admin_bp.route('/like-filter', methods=['GET'])
+@admin_required
+def like_filter_stats():
+    """Hit rate, false-positive rate and memory use of this worker's like Bloom filters."""
+    return jsonify(stats=like_filter_cache.stats())
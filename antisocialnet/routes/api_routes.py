@@ -1,10 +1,20 @@
-from flask import Blueprint, jsonify, request, current_app
+from datetime import datetime
+import bleach
+from flask import Blueprint, jsonify, request, current_app, url_for
 from flask_login import login_required, current_user
-from ..models import Post, UserPhoto, Activity, User, SiteSetting # Import necessary models
+from ..models import Post, UserPhoto, Comment, Activity, User, SiteSetting, FeedItem, FollowerLink, notify # Import necessary models
+from ..forms import CommentForm
 from sqlalchemy import or_
-from sqlalchemy.orm import selectinload
+from sqlalchemy.orm import selectinload, contains_eager
 from .. import db # For potential direct DB operations if needed, though mostly model queries
-from ..api_utils import serialize_post_item, serialize_photo_item, serialize_comment_item, serialize_user_profile
+from ..feed_utils import home_timeline_rows
+from ..search_utils import search_posts, search_users, highlight_snippet
+from ..typeahead_utils import typeahead_index
+from ..like_buffer import like_buffer
+from ..mention_utils import resolve_mentions
+from ..utils import extract_mentions
+from ..notification_utils import schedule_like_notifications
+from ..api_utils import serialize_post_item, serialize_photo_item, serialize_comment_item, serialize_user_profile, serialize_user_profiles, serialize_feed_items, serialize_activities, encode_cursor, decode_cursor, keyset_before
 
 
 api_bp = Blueprint('api', __name__, url_prefix='/api/v1')
@@ -13,57 +23,141 @@ api_bp = Blueprint('api', __name__, url_prefix='/api/v1')
 @login_required
 def get_feed():
     """
-    API endpoint to retrieve a paginated feed of items (posts and photos).
+    API endpoint to retrieve a feed of items (posts and photos), read from the
+    materialized `feed_item` table.
+
+    Two pagination modes are supported:
+    - Page mode (default): OFFSET-based pagination by `page`, with
+      `total_items`/`total_pages`.
+    - Cursor mode: pass the opaque `cursor` returned as `next_cursor` by the previous
+      page (pass it empty, `?cursor=`, for the first page). No total is computed and
+      every page costs the same regardless of depth.
     """
-    page = request.args.get('page', 1, type=int)
     per_page = request.args.get('per_page', current_app.config.get('POSTS_PER_PAGE', 10), type=int)
+    per_page = max(1, min(per_page, current_app.config.get('FEED_MAX_PER_PAGE', 100)))
+    cursor = request.args.get('cursor')
+
+    feed_query = db.session.query(FeedItem.id, FeedItem.ts, FeedItem.item_type, FeedItem.item_id)\
+                           .filter(FeedItem.visibility == FeedItem.VISIBILITY_PUBLIC)
+
+    if cursor is None:
+        page = request.args.get('page', 1, type=int)
+        feed_pagination = feed_query.order_by(FeedItem.ts.desc(), FeedItem.id.desc())\
+                                    .paginate(page=page, per_page=per_page, error_out=False)
+        return jsonify({
+            "items": serialize_feed_items(feed_pagination.items, viewer=current_user),
+            "pagination": {
+                "page": feed_pagination.page,
+                "per_page": feed_pagination.per_page,
+                "total_items": feed_pagination.total,
+                "total_pages": feed_pagination.pages,
+                "has_next": feed_pagination.has_next,
+                "has_prev": feed_pagination.has_prev,
+                "next_page_url": url_for('api.get_feed', page=feed_pagination.next_num, per_page=per_page, _external=True) if feed_pagination.has_next else None,
+                "prev_page_url": url_for('api.get_feed', page=feed_pagination.prev_num, per_page=per_page, _external=True) if feed_pagination.has_prev else None
+            }
+        })
 
-    # Union query for posts and photos
-    posts_query = db.session.query(
-        Post.id,
-        Post.created_at.label('timestamp'),
-        db.literal('post').label('type')
-    ).filter(Post.is_published == True)
-
-    photos_query = db.session.query(
-        UserPhoto.id,
-        UserPhoto.uploaded_at.label('timestamp'),
-        db.literal('photo').label('type')
-    )
+    if cursor:
+        try:
+            cursor_ts, cursor_id = decode_cursor(cursor, datetime.fromisoformat, int)
+        except ValueError:
+            return jsonify(status="error", message="Invalid cursor."), 400
+        feed_query = feed_query.filter(keyset_before(FeedItem.ts, FeedItem.id, cursor_ts, cursor_id))
+
+    # Fetch one extra row to learn whether another page exists without counting.
+    rows = feed_query.order_by(FeedItem.ts.desc(), FeedItem.id.desc()).limit(per_page + 1).all()
+    has_next = len(rows) > per_page
+    rows = rows[:per_page]
+    next_cursor = encode_cursor(rows[-1].ts, rows[-1].id) if has_next else None
+
+    return jsonify({
+        "items": serialize_feed_items(rows, viewer=current_user),
+        "pagination": {
+            "per_page": per_page,
+            "has_next": has_next,
+            "next_cursor": next_cursor,
+            "next_page_url": url_for('api.get_feed', cursor=next_cursor, per_page=per_page, _external=True) if has_next else None
+        }
+    })
+
+@api_bp.route('/feed/following', methods=['GET'])
+@login_required
+def get_following_feed():
+    """
+    API endpoint for the current user's "following" timeline: posts and photos by the
+    people they follow, newest first. Uses the same cursor pagination as `get_feed`.
+    """
+    per_page = request.args.get('per_page', current_app.config.get('POSTS_PER_PAGE', 10), type=int)
+    per_page = max(1, min(per_page, current_app.config.get('FEED_MAX_PER_PAGE', 100)))
+    cursor = request.args.get('cursor')
+
+    cursor_values = None
+    if cursor:
+        try:
+            cursor_values = decode_cursor(cursor, datetime.fromisoformat, int)
+        except ValueError:
+            return jsonify(status="error", message="Invalid cursor."), 400
+
+    rows = home_timeline_rows(current_user, per_page + 1, cursor_values)
+    has_next = len(rows) > per_page
+    rows = rows[:per_page]
+    next_cursor = encode_cursor(rows[-1].ts, rows[-1].id) if has_next else None
+
+    return jsonify({
+        "items": serialize_feed_items(rows, viewer=current_user),
+        "pagination": {
+            "per_page": per_page,
+            "has_next": has_next,
+            "next_cursor": next_cursor,
+            "next_page_url": url_for('api.get_following_feed', cursor=next_cursor, per_page=per_page, _external=True) if has_next else None
+        }
+    })
+
+@api_bp.route('/activity', methods=['GET'])
+@login_required
+def get_activity():
+    """
+    API endpoint for the activity stream (new posts, follows, ...), newest first.
+
+    Pass `scope=following` to only include activity by the people the current user
+    follows; by default activity by everyone with a public profile is included, plus the
+    current user's own. Uses the same cursor pagination as `get_feed`, keyed on
+    (timestamp, id).
+    """
+    per_page = request.args.get('per_page', current_app.config.get('ACTIVITIES_PER_PAGE', 20), type=int)
+    per_page = max(1, min(per_page, current_app.config.get('FEED_MAX_PER_PAGE', 100)))
+    cursor = request.args.get('cursor')
+    scope = request.args.get('scope', 'all')
+    if scope not in ('all', 'following'):
+        return jsonify(status="error", message="Invalid scope. Use 'all' or 'following'."), 400
+
+    activity_query = Activity.query.join(Activity.actor).options(contains_eager(Activity.actor))
+    if scope == 'following':
+        followed_ids = db.session.query(FollowerLink.followed_id).filter(FollowerLink.follower_id == current_user.id)
+        activity_query = activity_query.filter(Activity.user_id.in_(followed_ids))
+    else:
+        activity_query = activity_query.filter(or_(User.is_profile_public == True, User.id == current_user.id)) # noqa E712
+
+    if cursor:
+        try:
+            cursor_ts, cursor_id = decode_cursor(cursor, datetime.fromisoformat, int)
+        except ValueError:
+            return jsonify(status="error", message="Invalid cursor."), 400
+        activity_query = activity_query.filter(keyset_before(Activity.timestamp, Activity.id, cursor_ts, cursor_id))
 
-    feed_query = posts_query.union_all(photos_query).order_by(db.desc('timestamp'))
-    feed_pagination = feed_query.paginate(page=page, per_page=per_page, error_out=False)
-
-    serialized_feed_items = []
-    for item in feed_pagination.items:
-        if item.type == "post":
-            post = db.session.get(Post, item.id)
-            serialized_item = serialize_post_item(post)
-            if current_user.is_authenticated:
-                serialized_item["data"]["is_liked_by_current_user"] = current_user.has_liked_item('post', item.id)
-            else:
-                serialized_item["data"]["is_liked_by_current_user"] = False
-            serialized_feed_items.append(serialized_item)
-        elif item.type == "photo":
-            photo = db.session.get(UserPhoto, item.id)
-            serialized_item = serialize_photo_item(photo)
-            if current_user.is_authenticated:
-                serialized_item["data"]["is_liked_by_current_user"] = current_user.has_liked_item('photo', item.id)
-            else:
-                serialized_item["data"]["is_liked_by_current_user"] = False
-            serialized_feed_items.append(serialized_item)
+    activities = activity_query.order_by(Activity.timestamp.desc(), Activity.id.desc()).limit(per_page + 1).all()
+    has_next = len(activities) > per_page
+    activities = activities[:per_page]
+    next_cursor = encode_cursor(activities[-1].timestamp, activities[-1].id) if has_next else None
 
     return jsonify({
-        "items": serialized_feed_items,
+        "items": serialize_activities(activities),
         "pagination": {
-            "page": feed_pagination.page,
-            "per_page": feed_pagination.per_page,
-            "total_items": feed_pagination.total,
-            "total_pages": feed_pagination.pages,
-            "has_next": feed_pagination.has_next,
-            "has_prev": feed_pagination.has_prev,
-            "next_page_url": url_for('api.get_feed', page=feed_pagination.next_num, per_page=per_page, _external=True) if feed_pagination.has_next else None,
-            "prev_page_url": url_for('api.get_feed', page=feed_pagination.prev_num, per_page=per_page, _external=True) if feed_pagination.has_prev else None
+            "per_page": per_page,
+            "has_next": has_next,
+            "next_cursor": next_cursor,
+            "next_page_url": url_for('api.get_activity', cursor=next_cursor, per_page=per_page, scope=scope, _external=True) if has_next else None
         }
     })
 
@@ -100,34 +194,43 @@ from ..models import Comment
 @api_bp.route('/item/<string:target_type>/<int:target_id>/like', methods=['POST'])
 @login_required
 def like_item(target_type, target_id):
+    """
+    API endpoint to like or unlike an item. Idempotent: the like row is written or
+    removed with a single statement and the new count comes back from the counter
+    update, so a click costs two statements and a commit. With LIKE_BUFFER_ENABLED the
+    like is queued in `like_buffer` instead and the count returned is optimistic.
+    """
     action = request.json.get('action', 'like') # 'like' or 'unlike'
 
     if target_type not in ['post', 'comment', 'photo']:
         return jsonify(status="error", message="Invalid item type."), 404
-
-    target_model = None
-    if target_type == 'post':
-        target_model = Post
-    elif target_type == 'comment':
-        target_model = Comment
-    elif target_type == 'photo':
-        target_model = UserPhoto
-
-    target_item = target_model.query.get_or_404(target_id)
-
-    if action == 'like':
-        if not current_user.has_liked_item(target_type, target_item.id):
-            current_user.like_item(target_type, target_item.id)
-            db.session.commit()
-    elif action == 'unlike':
-        if current_user.has_liked_item(target_type, target_item.id):
-            current_user.unlike_item(target_type, target_item.id)
-            db.session.commit()
+    if action not in ('like', 'unlike'):
+        return jsonify(status="error", message="Invalid action. Use 'like' or 'unlike'."), 400
+
+    if current_app.config.get('LIKE_BUFFER_ENABLED', False):
+        like_count = like_buffer.record(current_user.id, target_type, target_id, action == 'like')
+        if like_count is None:
+            return jsonify(status="error", message="Item not found."), 404
+        return jsonify({
+            'status': 'success',
+            'user_has_liked': action == 'like',
+            'new_like_count': like_count,
+            'buffered': True
+        })
+
+    changed, like_count = current_user.set_item_liked(target_type, target_id, action == 'like')
+    if like_count is None:
+        db.session.rollback()
+        return jsonify(status="error", message="Item not found."), 404
+    if changed:
+        db.session.commit()
+        if action == 'like':
+            schedule_like_notifications([(current_user.id, target_type, target_id)])
 
     return jsonify({
         'status': 'success',
-        'user_has_liked': current_user.has_liked_item(target_type, target_item.id),
-        'new_like_count': target_item.likes.count()
+        'user_has_liked': action == 'like',
+        'new_like_count': like_count
     })
 
 @api_bp.route('/item/<string:target_type>/<int:target_id>/like_details', methods=['GET'])
@@ -153,7 +256,7 @@ def get_item_like_details(target_type, target_id):
     if hasattr(item, 'user') and hasattr(item.user, 'is_profile_public') and not item.user.is_profile_public and item.user_id != current_user.id and not current_user.is_admin:
          return jsonify(status="error", message="Forbidden to view like details for this item."), 403
 
-    like_count = item.likes.count()
+    like_count = item.like_count
     current_user_has_liked = current_user.has_liked_item(target_type, target_id)
 
     return jsonify(
@@ -196,42 +299,24 @@ def post_item_comment(target_type, target_id):
             target_id=target_item.id
         )
         db.session.add(new_comment)
-        db.session.commit()
-        from sqlalchemy import func
+        db.session.flush() # Assigns new_comment.id, the target of mention notifications
+        notify(target_item.user_id, 'new_comment', [current_user.id], target_type=target_type, target_id=target_item.id)
 
         mentioned_full_names = extract_mentions(new_comment.text)
-        new_mentions_created = False
         if mentioned_full_names:
+            resolved = resolve_mentions(mentioned_full_names)
+            mentioned_user_ids = set()
             for name_str in mentioned_full_names:
-                mentioned_users = User.query.filter(func.lower(User.full_name) == func.lower(name_str)).all()
-                if len(mentioned_users) == 1:
-                    mentioned_user_obj = mentioned_users[0]
-                    if mentioned_user_obj.id != current_user.id:
-                        existing_notif = Notification.query.filter_by(
-                            user_id=mentioned_user_obj.id,
-                            actor_id=current_user.id,
-                            type='mention_in_comment',
-                            target_type='comment',
-                            target_id=new_comment.id
-                        ).first()
-                        if not existing_notif:
-                            mention_notification = Notification(
-                                user_id=mentioned_user_obj.id,
-                                actor_id=current_user.id,
-                                type='mention_in_comment',
-                                target_type='comment',
-                                target_id=new_comment.id
-                            )
-                            db.session.add(mention_notification)
-                            new_mentions_created = True
-                            current_app.logger.info(f"Mention notification created for user '{mentioned_user_obj.full_name}' (ID: {mentioned_user_obj.id}) in comment {new_comment.id}")
-                elif len(mentioned_users) > 1:
-                    current_app.logger.info(f"Ambiguous mention for '{name_str}' in comment {new_comment.id}: {len(mentioned_users)} users found. No notification sent.")
+                user_ids = resolved.get(name_str.lower(), ())
+                if len(user_ids) == 1:
+                    mentioned_user_ids.add(user_ids[0])
+                elif len(user_ids) > 1:
+                    current_app.logger.info(f"Ambiguous mention for '{name_str}' in comment {new_comment.id}: {len(user_ids)} users found. No notification sent.")
                 else:
                     current_app.logger.info(f"Mentioned name '{name_str}' in comment {new_comment.id} does not correspond to any user. No notification sent.")
-
-        if new_mentions_created:
-            db.session.commit()
+            for mentioned_user_id in sorted(mentioned_user_ids): # notify() skips self-mentions
+                notify(mentioned_user_id, 'mention_in_comment', [current_user.id], target_type='comment', target_id=new_comment.id)
+        db.session.commit()
 
         return jsonify(serialize_comment_item(new_comment)), 201
     else:
@@ -336,64 +421,115 @@ def dashboard_data():
 @api_bp.route('/search', methods=['GET'])
 def search_data():
     """
-    API endpoint for searching posts and users.
+    API endpoint for searching posts and users, backed by the full-text index in
+    `search_utils`. Results are ranked best match first, posts carry a highlighted
+    `search_snippet`, and each section is paginated separately with its own cursor:
+    pass `posts_cursor` or `users_cursor` from the previous response, together with
+    `type=posts` or `type=users` to only fetch that section.
     """
     query_param = request.args.get('q', '').strip()
-    page = request.args.get('page', 1, type=int)
-    posts_per_page = current_app.config.get('POSTS_PER_PAGE', 10)
-    users_per_page = current_app.config.get('USERS_PER_PAGE', 10)
-
-    posts_results, posts_pagination = [], None
-    users_results, users_pagination = [], None
-
-    if query_param:
-        search_term = f"%{query_param}%"
-        # Post search
-        posts_query = Post.query.filter(
-            Post.is_published==True,
-            Post.content.ilike(search_term)
-        ).options(selectinload(Post.categories), selectinload(Post.tags), selectinload(Post.author))\
-            .order_by(Post.published_at.desc(), Post.created_at.desc())
-        posts_pagination = posts_query.paginate(page=page, per_page=posts_per_page, error_out=False)
-        posts_results = [serialize_post_item(post) for post in posts_pagination.items]
-
-        # User search
-        user_query_base = User.query.filter(
-            or_(
-                User.username.ilike(search_term),
-                User.full_name.ilike(search_term)
-            )
+    search_type = request.args.get('type', 'all')
+    if search_type not in ('all', 'posts', 'users'):
+        return jsonify(status="error", message="Invalid type. Use 'all', 'posts' or 'users'."), 400
+    posts_per_page = request.args.get('per_page', current_app.config.get('POSTS_PER_PAGE', 10), type=int)
+    users_per_page = request.args.get('per_page', current_app.config.get('USERS_PER_PAGE', 10), type=int)
+    max_per_page = current_app.config.get('FEED_MAX_PER_PAGE', 100)
+    posts_per_page = max(1, min(posts_per_page, max_per_page))
+    users_per_page = max(1, min(users_per_page, max_per_page))
+
+    try:
+        posts_cursor, users_cursor = (
+            decode_cursor(request.args[name], float, int) if request.args.get(name) else None
+            for name in ('posts_cursor', 'users_cursor')
         )
-        if current_user.is_authenticated:
-            user_query_base = user_query_base.filter(User.id != current_user.id)
-
-        user_query = user_query_base.order_by(User.username.asc())
-        users_pagination = user_query.paginate(page=page, per_page=users_per_page, error_out=False)
+    except ValueError:
+        return jsonify(status="error", message="Invalid cursor."), 400
+
+    def paginate_section(rows, per_page, section_name):
+        has_next = len(rows) > per_page
+        rows = rows[:per_page]
+        next_cursor = encode_cursor(rows[-1].score, rows[-1].id) if has_next else None
+        next_page_url = url_for(
+            'api.search_data', q=query_param, type=section_name, per_page=per_page,
+            _external=True, **{f'{section_name}_cursor': next_cursor}
+        ) if has_next else None
+        return rows, {"per_page": per_page, "has_next": has_next, "next_cursor": next_cursor, "next_page_url": next_page_url}
+
+    posts_results, posts_pagination = [], {"per_page": posts_per_page, "has_next": False, "next_cursor": None, "next_page_url": None}
+    users_results, users_pagination = [], {"per_page": users_per_page, "has_next": False, "next_cursor": None, "next_page_url": None}
+
+    if query_param and search_type in ('all', 'posts'):
+        post_rows, posts_pagination = paginate_section(
+            search_posts(query_param, posts_per_page + 1, posts_cursor), posts_per_page, 'posts'
+        )
+        posts_by_id = {
+            post.id: post for post in Post.query.filter(Post.id.in_([row.id for row in post_rows]))
+                .options(selectinload(Post.categories), selectinload(Post.tags), selectinload(Post.author))
+        }
+        for row in post_rows:
+            post = posts_by_id.get(row.id)
+            if post is not None:
+                item = serialize_post_item(post)
+                item["data"]["search_snippet"] = str(highlight_snippet(row.snippet))
+                posts_results.append(item)
+
+    if query_param and search_type in ('all', 'users'):
+        exclude_user_id = current_user.id if current_user.is_authenticated else None
+        user_rows, users_pagination = paginate_section(
+            search_users(query_param, users_per_page + 1, users_cursor, exclude_user_id=exclude_user_id),
+            users_per_page, 'users'
+        )
+        users_by_id = {user.id: user for user in User.query.filter(User.id.in_([row.id for row in user_rows]))}
+        viewer = current_user._get_current_object()
         with current_app.test_request_context():
-            users_results = [serialize_user_profile(user) for user in users_pagination.items]
+            users_results = serialize_user_profiles(
+                [users_by_id[row.id] for row in user_rows if row.id in users_by_id], viewer=viewer
+            )
 
     return jsonify({
         'query': query_param,
         'posts': {
             'items': posts_results,
-            'pagination': {
-                'page': posts_pagination.page if posts_pagination else 1,
-                'per_page': posts_pagination.per_page if posts_pagination else posts_per_page,
-                'total_items': posts_pagination.total if posts_pagination else 0,
-                'total_pages': posts_pagination.pages if posts_pagination else 0,
-            }
+            'pagination': posts_pagination
         },
         'users': {
             'items': users_results,
-            'pagination': {
-                'page': users_pagination.page if users_pagination else 1,
-                'per_page': users_pagination.per_page if users_pagination else users_per_page,
-                'total_items': users_pagination.total if users_pagination else 0,
-                'total_pages': users_pagination.pages if users_pagination else 0,
-            }
+            'pagination': users_pagination
         }
     })
 
+@api_bp.route('/typeahead', methods=['GET'])
+@login_required
+def typeahead():
+    """
+    API endpoint for autocompleting @mentions and tags while typing. Matches users by
+    full name and tags by name, on any word prefix, most-followed users and most-used
+    tags first. Answered from the in-process index in `typeahead_utils`, without
+    querying the database.
+    """
+    query_param = request.args.get('q', '')
+    item_type = request.args.get('type', 'all')
+    kinds = {'all': ('user', 'tag'), 'users': ('user',), 'tags': ('tag',)}.get(item_type)
+    if kinds is None:
+        return jsonify(status="error", message="Invalid type. Use 'all', 'users' or 'tags'."), 400
+    limit = max(1, min(request.args.get('limit', 8, type=int), 20))
+
+    results = typeahead_index.lookup(query_param, kinds=kinds, limit=limit)
+    default_avatar = current_app.config.get('DEFAULT_AVATAR_PATH', 'img/default_avatar.png')
+    users = [{
+        "id": user['id'],
+        "full_name": user['label'],
+        "profile_photo_url": url_for('static', filename=user['profile_photo_url'] or default_avatar, _external=True),
+        "url": f"/profile/{user['id']}" # Same client-side route as mention links
+    } for user in results.get('user', [])]
+    tags = [{
+        "id": tag['id'],
+        "name": tag['label'],
+        "slug": tag['slug'],
+        "url": url_for('post.posts_by_tag', tag_slug=tag['slug'], _external=True)
+    } for tag in results.get('tag', [])]
+    return jsonify(query=query_param, users=users, tags=tags)
+
 @api_bp.route('/settings', methods=['GET'])
 @login_required
 def get_settings_data():
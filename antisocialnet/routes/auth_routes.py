@@ -4,6 +4,7 @@ from ..models import User, SiteSetting
 from ..forms import LoginForm, RegistrationForm, ChangePasswordForm, RequestPasswordResetForm, ResetPasswordForm
 from .. import db
 from ..email_utils import send_password_reset_email
+from ..mention_utils import schedule_mention_relink
 
 auth_bp = Blueprint('auth', __name__, url_prefix='/api/v1/auth')
 
@@ -34,6 +35,7 @@ def register():
             new_user.set_password(form.password.data)
             db.session.add(new_user)
             db.session.commit()
+            schedule_mention_relink(new_names=[new_user.full_name])
             return jsonify(status='success', message='Registration successful! Your account is pending admin approval.'), 201
         except Exception as e:
             db.session.rollback()
@@ -1,36 +1,113 @@
-from flask import Blueprint, request, jsonify, current_app
+import heapq
+from itertools import islice
+from flask import Blueprint, request, jsonify, current_app, Response, stream_with_context
 from flask_login import current_user, login_required
 from sqlalchemy.orm import joinedload
-from ..models import Notification
+from ..models import (
+    Notification, BroadcastNotification, User,
+    mark_notifications_read, mark_all_notifications_read, unread_notification_counts
+)
 from .. import db
-from ..api_utils import serialize_notification
+from ..api_utils import serialize_notifications
+from ..notification_stream import notification_event_stream, long_poll_notifications
 
 notification_bp = Blueprint('notification', __name__, url_prefix='/api/v1/notifications')
 
 @notification_bp.route('/', methods=['GET'])
 @login_required
 def list_notifications():
-    page = request.args.get('page', 1, type=int)
+    """
+    Lists the current user's notifications, newest first, with broadcasts (one row for
+    all users) merged in. Each page reads at most page * per_page rows from each source.
+    Listing marks the page's notifications as read; for broadcasts that means moving the
+    user's read watermark up to the newest one shown.
+    """
+    page = max(1, request.args.get('page', 1, type=int))
     per_page = current_app.config.get('POSTS_PER_PAGE', 20)
-    notifications_query = Notification.query.filter_by(user_id=current_user.id)\
-                                            .options(joinedload(Notification.actor))\
-                                            .order_by(Notification.timestamp.desc())
-    pagination = notifications_query.paginate(page=page, per_page=per_page, error_out=False)
-    notifications_list = [serialize_notification(n) for n in pagination.items]
+    user_id = current_user.id
+    broadcast_read_id = current_user.broadcast_read_id
+    notifications_read_id = current_user.notifications_read_id
 
-    ids_to_mark_read = [n['id'] for n in notifications_list if not n['is_read']]
+    personal_query = Notification.query.filter_by(user_id=user_id)
+    broadcast_query = BroadcastNotification.query.filter(BroadcastNotification.id > current_user.broadcast_joined_id)
+    window = page * per_page
+    personal = personal_query.options(joinedload(Notification.actor))\
+                             .order_by(Notification.timestamp.desc(), Notification.id.desc())\
+                             .limit(window).all()
+    broadcasts = broadcast_query.options(joinedload(BroadcastNotification.actor))\
+                                .order_by(BroadcastNotification.timestamp.desc(), BroadcastNotification.id.desc())\
+                                .limit(window).all()
+    page_items = list(islice(
+        heapq.merge(personal, broadcasts, key=lambda n: n.timestamp, reverse=True),
+        (page - 1) * per_page, window
+    ))
+    total_items = personal_query.count() + broadcast_query.count()
+    notifications_list = serialize_notifications(
+        page_items, broadcast_read_id=broadcast_read_id, notifications_read_id=notifications_read_id
+    )
+
+    ids_to_mark_read = [n['id'] for n in notifications_list if not n['is_read'] and not n['is_broadcast']]
+    newest_broadcast_id = max((n['id'] for n in notifications_list if n['is_broadcast']), default=0)
     if ids_to_mark_read:
-        Notification.query.filter(Notification.id.in_(ids_to_mark_read))\
-                          .update({'is_read': True}, synchronize_session='fetch')
+        mark_notifications_read(current_user, ids_to_mark_read)
+    if newest_broadcast_id > broadcast_read_id:
+        _advance_broadcast_watermark(user_id, newest_broadcast_id)
+    if ids_to_mark_read or newest_broadcast_id > broadcast_read_id:
         db.session.commit()
 
     return jsonify(notifications=notifications_list, pagination={
-        'page': pagination.page,
-        'per_page': pagination.per_page,
-        'total_items': pagination.total,
-        'total_pages': pagination.pages
+        'page': page,
+        'per_page': per_page,
+        'total_items': total_items,
+        'total_pages': -(-total_items // per_page)
     })
 
+def _advance_broadcast_watermark(user_id, broadcast_id):
+    # Only ever moves forward, even if two requests race.
+    User.query.filter(User.id == user_id, User.broadcast_read_id < broadcast_id)\
+              .update({'broadcast_read_id': broadcast_id}, synchronize_session=False)
+
+@notification_bp.route('/unread-count', methods=['GET'])
+@login_required
+def unread_count():
+    """
+    Returns the current user's unread notification count, total and per type (for
+    badges), from the maintained counters. Costs at most one small query, plus one
+    more when there are unread broadcasts.
+    """
+    counts_by_type = unread_notification_counts(current_user)
+    return jsonify(unread_count=sum(counts_by_type.values()), unread_by_type=counts_by_type)
+
+@notification_bp.route('/stream', methods=['GET'])
+@login_required
+def stream():
+    """
+    Server-Sent Events stream of the current user's new notifications (`notification`
+    events) and unread counts (`unread` events, sent on connect and whenever they
+    change). Reconnecting EventSources resume after their Last-Event-ID; `last_event_id`
+    in the query string does the same for clients that can't set the header.
+    """
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    response = Response(
+        stream_with_context(notification_event_stream(current_user.id, last_event_id)),
+        mimetype='text/event-stream'
+    )
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no' # Don't let nginx buffer the stream
+    return response
+
+@notification_bp.route('/poll', methods=['GET'])
+@login_required
+def poll():
+    """
+    Long-poll fallback for clients without EventSource: returns new notifications and
+    the unread counts once there's news since `cursor` (or after `timeout` seconds), with
+    the cursor for the next call. Without a cursor it returns right away.
+    """
+    return jsonify(long_poll_notifications(
+        current_user.id, request.args.get('cursor'), request.args.get('timeout', type=float)
+    ))
+
 @notification_bp.route('/<int:notification_id>/mark-read', methods=['POST'])
 @login_required
 def mark_as_read(notification_id):
@@ -43,7 +120,6 @@ def mark_as_read(notification_id):
 @notification_bp.route('/mark-all-read', methods=['POST'])
 @login_required
 def mark_all_as_read():
-    updated_count = Notification.query.filter_by(user_id=current_user.id, is_read=False)\
-                                      .update({'is_read': True}, synchronize_session='fetch')
+    updated_count = mark_all_notifications_read(current_user)
     db.session.commit()
     return jsonify(status='success', message=f'{updated_count} notification(s) marked as read.')
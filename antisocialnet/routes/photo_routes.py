@@ -2,7 +2,7 @@ from flask import Blueprint, jsonify, request, abort, url_for, current_app
 from flask_login import current_user, login_required
 import bleach
 from .. import db
-from ..models import UserPhoto, Comment, User, Notification
+from ..models import UserPhoto, Comment, User, Notification, notify
 from ..forms import CommentForm
 from ..utils import extract_mentions
 from ..api_utils import serialize_comment_item, serialize_photo_item
@@ -36,8 +36,9 @@ def add_photo_comment(photo_id):
     if form.validate():
         comment = Comment(text=form.text.data, user_id=current_user.id, target_type='userphoto', target_id=photo_id)
         db.session.add(comment)
+        notify(photo.user_id, 'new_comment', [current_user.id], target_type='userphoto', target_id=photo_id)
         db.session.commit()
-        # Handle notifications and activity
+        # Handle activity
         # ...
         return jsonify(serialize_comment_item(comment)), 201
     return jsonify(errors=form.errors), 400
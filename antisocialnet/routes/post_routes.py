@@ -3,10 +3,13 @@ from flask_login import current_user, login_required
 from datetime import datetime, timezone
 from sqlalchemy.orm import selectinload
 
-from ..models import Post, Category, Tag, Comment, CommentFlag, Notification, Activity, User
+from ..models import Post, Category, Tag, Comment, CommentFlag, Notification, Activity, User, notify
 from ..forms import PostForm, CommentForm, FlagCommentForm, EditCommentForm
 from .. import db
 from ..utils import update_post_relations_util, extract_mentions
+from ..tasks import enqueue
+from .. import feed_utils # noqa: F401 (registers the feed tasks)
+from ..notification_utils import schedule_follower_notifications
 from ..api_utils import serialize_post_item, serialize_comment_item
 
 post_bp = Blueprint('post', __name__, url_prefix='/api/v1/posts')
@@ -37,6 +40,8 @@ def create_post():
         activity = Activity(user_id=current_user.id, type='created_post', target_type='post', target_id=new_post.id)
         db.session.add(activity)
         db.session.commit()
+        enqueue('feed.fan_out_item', item_type='post', item_id=new_post.id)
+        schedule_follower_notifications(current_user.id, 'new_post_by_followed_user', 'post', [new_post.id])
 
         # Handle mentions and notifications
         # ...
@@ -81,8 +86,9 @@ def add_comment(post_id):
         comment = Comment(text=form.text.data, user_id=current_user.id, target_type='post',
                           target_id=post_id, parent_id=parent_id)
         db.session.add(comment)
+        notify(post.user_id, 'new_comment', [current_user.id], target_type='post', target_id=post_id)
         db.session.commit()
-        # Handle notifications and activity
+        # Handle activity
         # ...
         return jsonify(serialize_comment_item(comment)), 201
     return jsonify(errors=form.errors), 400
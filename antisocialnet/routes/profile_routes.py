@@ -9,11 +9,15 @@ import bleach
 from datetime import datetime
 
 from sqlalchemy.orm import selectinload
-from ..models import User, Post, Comment, UserPhoto, SiteSetting, Notification, Activity
+from ..models import User, Post, Comment, UserPhoto, SiteSetting, Notification, Activity, notify
 from ..forms import ProfileEditForm, GalleryPhotoUploadForm
 from .. import db
 from ..utils import ALLOWED_TAGS_CONFIG, ALLOWED_ATTRIBUTES_CONFIG, save_uploaded_file
-from ..api_utils import serialize_user_profile, serialize_post_item, serialize_photo_item
+from ..api_utils import serialize_user_profile, serialize_user_profiles, serialize_post_item, serialize_photo_item
+from ..tasks import enqueue
+from ..feed_utils import purge_home_timeline
+from ..mention_utils import schedule_mention_relink
+from ..notification_utils import schedule_follower_notifications
 
 profile_bp = Blueprint('profile', __name__, url_prefix='/api/v1/profile')
 
@@ -31,6 +35,7 @@ def edit_profile():
             attributes=ALLOWED_ATTRIBUTES_CONFIG,
             strip=True
         )
+        previous_full_name = current_user.full_name
         current_user.full_name = form.full_name.data
         current_user.website_url = form.website_url.data
         current_user.is_profile_public = form.is_profile_public.data
@@ -44,8 +49,9 @@ def edit_profile():
         current_user.birthdate = form.birthdate.data
 
         photo_file = request.files.get('profile_photo')
+        new_photo_db_path = None
+        crop_params = None
         if photo_file:
-            crop_params = None
             crop_x_str = request.form.get('crop_x')
             crop_y_str = request.form.get('crop_y')
             crop_width_str = request.form.get('crop_width')
@@ -69,13 +75,21 @@ def edit_profile():
                 max_size_bytes_config_key="MAX_PROFILE_PHOTO_SIZE_BYTES",
                 crop_coords=crop_params,
                 thumbnail_size=(200, 200),
-                existing_db_path=current_user.profile_photo_url
+                existing_db_path=current_user.profile_photo_url,
+                defer_processing=True
             )
             if new_photo_db_path:
                 current_user.profile_photo_url = new_photo_db_path
 
         try:
             db.session.commit()
+            if new_photo_db_path:
+                # Cropping and resizing happen in the background; the upload shows until then
+                enqueue('images.process_profile_photo', db_path=new_photo_db_path,
+                        crop_coords=crop_params, thumbnail_size=[200, 200])
+            if previous_full_name != current_user.full_name:
+                schedule_mention_relink(new_names=[current_user.full_name], user_ids=[current_user.id],
+                                        former_names=[previous_full_name])
             return jsonify(status='success', message='Profile updated successfully!', user=serialize_user_profile(current_user))
         except Exception as e:
             db.session.rollback()
@@ -117,18 +131,11 @@ def upload_gallery_photo():
         if new_photos:
             try:
                 db.session.commit()
-                # Create notifications for followers
-                for follower in current_user.followers:
-                    for photo in new_photos:
-                        notification = Notification(
-                            user_id=follower.id,
-                            actor_id=current_user.id,
-                            type='new_photo_by_followed_user',
-                            target_type='userphoto',
-                            target_id=photo.id
-                        )
-                        db.session.add(notification)
-                db.session.commit()
+                photo_ids = [photo.id for photo in new_photos]
+                # Followers are notified by a background job, not in this request
+                schedule_follower_notifications(current_user.id, 'new_photo_by_followed_user', 'userphoto', photo_ids)
+                for photo_id in photo_ids:
+                    enqueue('feed.fan_out_item', item_type='photo', item_id=photo_id)
                 return jsonify(status='success', message=f'{len(new_photos)} photo(s) uploaded to gallery successfully!')
             except Exception as e:
                 db.session.rollback()
@@ -162,30 +169,25 @@ def follow_user(user_id):
     user = User.query.get_or_404(user_id)
     if user == current_user:
         return jsonify(status='error', message='You cannot perform this action on yourself.'), 400
-    if current_user.is_following(user):
-        return jsonify(status='error', message=f"You are already following {user.full_name or ('@' + user.username)}."), 400
-
-    if current_user.follow(user):
-        notification = Notification(
-            user_id=user.id,
-            actor_id=current_user.id,
-            type='new_follower',
-            target_type='user',
-            target_id=current_user.id
-        )
-        db.session.add(notification)
-        activity = Activity(
-            user_id=current_user.id,
-            type='started_following',
-            target_type='user',
-            target_id=user.id
-        )
-        db.session.add(activity)
-        db.session.commit()
-        return jsonify(status='success', message=f"You are now following {user.full_name or ('@' + user.username)}.")
-    else:
+
+    display_name = user.full_name or ('@' + user.username)
+    follower_id = current_user.id # Read before the commit expires it
+    followed, follower_count = current_user.set_following(user, True)
+    if not followed:
         db.session.rollback()
-        return jsonify(status='error', message=f"Could not follow {user.full_name or ('@' + user.username)}. An unexpected error occurred."), 500
+        return jsonify(status='error', message=f"You are already following {display_name}."), 400
+
+    notify(user.id, 'new_follower', [follower_id], target_type='user', target_id=follower_id)
+    activity = Activity(
+        user_id=follower_id,
+        type='started_following',
+        target_type='user',
+        target_id=user_id
+    )
+    db.session.add(activity)
+    db.session.commit()
+    enqueue('feed.backfill_home_timeline', user_id=follower_id, followed_id=user_id)
+    return jsonify(status='success', message=f"You are now following {display_name}.", follower_count=follower_count)
 
 @profile_bp.route('/<int:user_id>/unfollow', methods=['POST'])
 @login_required
@@ -193,15 +195,16 @@ def unfollow_user(user_id):
     user = User.query.get_or_404(user_id)
     if user == current_user:
         return jsonify(status='error', message='You cannot perform this action on yourself.'), 400
-    if not current_user.is_following(user):
-        return jsonify(status='error', message=f"You are not currently following {user.full_name or ('@' + user.username)}."), 400
 
-    if current_user.unfollow(user):
-        db.session.commit()
-        return jsonify(status='success', message=f"You have unfollowed {user.full_name or ('@' + user.username)}.")
-    else:
+    display_name = user.full_name or ('@' + user.username)
+    unfollowed, follower_count = current_user.set_following(user, False)
+    if not unfollowed:
         db.session.rollback()
-        return jsonify(status='error', message=f"Could not unfollow {user.full_name or ('@' + user.username)}. An unexpected error occurred."), 500
+        return jsonify(status='error', message=f"You are not currently following {display_name}."), 400
+
+    purge_home_timeline(current_user.id, user.id)
+    db.session.commit()
+    return jsonify(status='success', message=f"You have unfollowed {display_name}.", follower_count=follower_count)
 
 @profile_bp.route('/<int:user_id>/followers', methods=['GET'])
 @login_required
@@ -213,7 +216,7 @@ def followers_list(user_id):
     per_page = current_app.config.get('USERS_PER_PAGE', 15)
     followers_query = user.followers.order_by(User.full_name.asc())
     pagination = followers_query.paginate(page=page, per_page=per_page, error_out=False)
-    users_list = [serialize_user_profile(u) for u in pagination.items]
+    users_list = serialize_user_profiles(pagination.items, viewer=current_user)
     return jsonify(users=users_list, pagination={
         'page': pagination.page,
         'per_page': pagination.per_page,
@@ -231,7 +234,7 @@ def following_list(user_id):
     per_page = current_app.config.get('USERS_PER_PAGE', 15)
     following_query = user.followed.order_by(User.full_name.asc())
     pagination = following_query.paginate(page=page, per_page=per_page, error_out=False)
-    users_list = [serialize_user_profile(u) for u in pagination.items]
+    users_list = serialize_user_profiles(pagination.items, viewer=current_user)
     return jsonify(users=users_list, pagination={
         'page': pagination.page,
         'per_page': pagination.per_page,
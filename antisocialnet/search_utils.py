@@ -0,0 +1,361 @@
+"""
+Full-text search over published posts and users.
+
+Searching with `ilike('%term%')` scans every row and can't rank, so posts and users are
+kept in a dedicated full-text index instead, chosen by database dialect:
+
+- SQLite: FTS5 virtual tables (`post_search`, `user_search`) keyed by rowid = post/user
+  id, ranked with bm25() and highlighted with snippet().
+- PostgreSQL: `post_search`/`user_search` tables holding a weighted tsvector behind a
+  GIN index, ranked with ts_rank_cd() and highlighted with ts_headline().
+
+The index is maintained by mapper hooks on `Post` and `User` inside the same flush as
+the change, so it's never ahead of or behind a committed transaction. A query costs one
+inverted-index lookup proportional to the number of matches, not to the table size.
+
+Results are ordered by (score DESC, id DESC), where a higher score is a better match on
+every backend, and paginated with a cursor on that pair.
+"""
+import re
+from abc import ABC, abstractmethod
+from markupsafe import Markup, escape
+from sqlalchemy import text
+
+from . import db
+from .models import Post, User
+
+# Snippets are produced with control-character markers, then HTML-escaped, then the
+# markers are swapped for <mark> tags, so indexed text can never inject markup.
+_HIGHLIGHT_START = '\x02'
+_HIGHLIGHT_END = '\x03'
+SNIPPET_TOKENS = 16
+TITLE_WEIGHT = 5.0 # Relative weight of a post's title vs. its content
+FULL_NAME_WEIGHT = 2.0 # Relative weight of a user's full name vs. their username
+
+_TERM_REGEX = re.compile(r'\w+', re.UNICODE)
+
+def search_terms(query):
+    """Splits a free-text query into the word terms the backends match on."""
+    return _TERM_REGEX.findall(query or '')
+
+def highlight_snippet(snippet):
+    """Escapes a backend snippet and turns its highlight markers into <mark> tags."""
+    if not snippet:
+        return Markup('')
+    escaped = str(escape(snippet))
+    return Markup(escaped.replace(_HIGHLIGHT_START, '<mark>').replace(_HIGHLIGHT_END, '</mark>'))
+
+def _keyset(score_sql, id_sql):
+    return f"({score_sql} < :cursor_score OR ({score_sql} = :cursor_score AND {id_sql} < :cursor_id))"
+
+class SearchBackend(ABC):
+    """
+    Interface of a full-text search backend. Index methods run on the connection they're
+    given (usually a flush's); search methods return rows with `id` and `score` (higher
+    is better) attributes, plus `snippet` for posts.
+    """
+    name = None
+
+    @abstractmethod
+    def create_index(self, connection):
+        pass
+
+    @abstractmethod
+    def drop_index(self, connection):
+        pass
+
+    @abstractmethod
+    def index_post(self, connection, post_id, title, content):
+        pass
+
+    @abstractmethod
+    def unindex_post(self, connection, post_id):
+        pass
+
+    @abstractmethod
+    def index_user(self, connection, user_id, username, full_name):
+        pass
+
+    @abstractmethod
+    def unindex_user(self, connection, user_id):
+        pass
+
+    @abstractmethod
+    def search_posts(self, terms, limit, cursor=None):
+        pass
+
+    @abstractmethod
+    def search_users(self, terms, limit, cursor=None, exclude_user_id=None):
+        pass
+
+    def _execute_search(self, sql, params, cursor, keyset_sql):
+        if cursor:
+            params = dict(params, cursor_score=cursor[0], cursor_id=cursor[1])
+        return db.session.execute(text(sql.format(keyset=f"AND {keyset_sql}" if cursor else '')), params).all()
+
+class SqliteFtsSearchBackend(SearchBackend):
+    """FTS5 virtual tables ranked with bm25()."""
+    name = 'sqlite'
+
+    def create_index(self, connection):
+        connection.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS post_search USING fts5("
+            "title, content, tokenize='porter unicode61 remove_diacritics 2', prefix='2 3')"
+        ))
+        connection.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS user_search USING fts5("
+            "username, full_name, tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+        ))
+
+    def drop_index(self, connection):
+        connection.execute(text("DROP TABLE IF EXISTS post_search"))
+        connection.execute(text("DROP TABLE IF EXISTS user_search"))
+
+    def index_post(self, connection, post_id, title, content):
+        self.unindex_post(connection, post_id)
+        connection.execute(
+            text("INSERT INTO post_search (rowid, title, content) VALUES (:id, :title, :content)"),
+            {'id': post_id, 'title': title or '', 'content': content or ''}
+        )
+
+    def unindex_post(self, connection, post_id):
+        connection.execute(text("DELETE FROM post_search WHERE rowid = :id"), {'id': post_id})
+
+    def index_user(self, connection, user_id, username, full_name):
+        self.unindex_user(connection, user_id)
+        connection.execute(
+            text("INSERT INTO user_search (rowid, username, full_name) VALUES (:id, :username, :full_name)"),
+            {'id': user_id, 'username': username or '', 'full_name': full_name or ''}
+        )
+
+    def unindex_user(self, connection, user_id):
+        connection.execute(text("DELETE FROM user_search WHERE rowid = :id"), {'id': user_id})
+
+    @staticmethod
+    def _match_query(terms):
+        # Every term is quoted so FTS5 operators in user input are matched literally; the
+        # last one is a prefix so results show up while the user is still typing.
+        quoted = [f'"{term}"' for term in terms]
+        quoted[-1] += '*'
+        return ' '.join(quoted)
+
+    def search_posts(self, terms, limit, cursor=None):
+        score = f"-bm25(post_search, {TITLE_WEIGHT}, 1.0)"
+        sql = (
+            f"SELECT rowid AS id, {score} AS score, "
+            f"snippet(post_search, 1, :start, :end, '…', :tokens) AS snippet "
+            f"FROM post_search WHERE post_search MATCH :query {{keyset}} "
+            f"ORDER BY score DESC, rowid DESC LIMIT :limit"
+        )
+        params = {
+            'query': self._match_query(terms), 'limit': limit, 'tokens': SNIPPET_TOKENS,
+            'start': _HIGHLIGHT_START, 'end': _HIGHLIGHT_END
+        }
+        return self._execute_search(sql, params, cursor, _keyset(score, 'rowid'))
+
+    def search_users(self, terms, limit, cursor=None, exclude_user_id=None):
+        score = f"-bm25(user_search, 1.0, {FULL_NAME_WEIGHT})"
+        sql = (
+            f"SELECT rowid AS id, {score} AS score FROM user_search "
+            f"WHERE user_search MATCH :query AND rowid != :exclude_user_id {{keyset}} "
+            f"ORDER BY score DESC, rowid DESC LIMIT :limit"
+        )
+        params = {'query': self._match_query(terms), 'limit': limit, 'exclude_user_id': exclude_user_id or 0}
+        return self._execute_search(sql, params, cursor, _keyset(score, 'rowid'))
+
+class PostgresSearchBackend(SearchBackend):
+    """Weighted tsvector columns behind GIN indexes, ranked with ts_rank_cd()."""
+    name = 'postgresql'
+    POST_CONFIG = 'english'
+    USER_CONFIG = 'simple' # Names and usernames shouldn't be stemmed
+
+    def create_index(self, connection):
+        connection.execute(text(
+            "CREATE TABLE IF NOT EXISTS post_search (post_id INTEGER PRIMARY KEY, document TSVECTOR NOT NULL)"
+        ))
+        connection.execute(text("CREATE INDEX IF NOT EXISTS ix_post_search_document ON post_search USING GIN (document)"))
+        connection.execute(text(
+            "CREATE TABLE IF NOT EXISTS user_search (user_id INTEGER PRIMARY KEY, document TSVECTOR NOT NULL)"
+        ))
+        connection.execute(text("CREATE INDEX IF NOT EXISTS ix_user_search_document ON user_search USING GIN (document)"))
+
+    def drop_index(self, connection):
+        connection.execute(text("DROP TABLE IF EXISTS post_search"))
+        connection.execute(text("DROP TABLE IF EXISTS user_search"))
+
+    def index_post(self, connection, post_id, title, content):
+        connection.execute(text(
+            "INSERT INTO post_search (post_id, document) VALUES (:id, "
+            "setweight(to_tsvector(CAST(:config AS regconfig), :title), 'A') || "
+            "setweight(to_tsvector(CAST(:config AS regconfig), :content), 'B')) "
+            "ON CONFLICT (post_id) DO UPDATE SET document = EXCLUDED.document"
+        ), {'id': post_id, 'config': self.POST_CONFIG, 'title': title or '', 'content': content or ''})
+
+    def unindex_post(self, connection, post_id):
+        connection.execute(text("DELETE FROM post_search WHERE post_id = :id"), {'id': post_id})
+
+    def index_user(self, connection, user_id, username, full_name):
+        connection.execute(text(
+            "INSERT INTO user_search (user_id, document) VALUES (:id, "
+            "setweight(to_tsvector(CAST(:config AS regconfig), :full_name), 'A') || "
+            "setweight(to_tsvector(CAST(:config AS regconfig), :username), 'B')) "
+            "ON CONFLICT (user_id) DO UPDATE SET document = EXCLUDED.document"
+        ), {'id': user_id, 'config': self.USER_CONFIG, 'username': username or '', 'full_name': full_name or ''})
+
+    def unindex_user(self, connection, user_id):
+        connection.execute(text("DELETE FROM user_search WHERE user_id = :id"), {'id': user_id})
+
+    @staticmethod
+    def _tsquery(terms):
+        # Terms are \w+ only, so they can't carry tsquery operators; the last is a prefix.
+        return ' & '.join(terms) + ':*'
+
+    def search_posts(self, terms, limit, cursor=None):
+        score = "ts_rank_cd(s.document, q)"
+        sql = (
+            f"SELECT s.post_id AS id, {score} AS score, "
+            f"ts_headline(CAST(:config AS regconfig), p.content, q, :headline_options) AS snippet "
+            f"FROM post_search s JOIN post p ON p.id = s.post_id, "
+            f"to_tsquery(CAST(:config AS regconfig), :query) q "
+            f"WHERE s.document @@ q {{keyset}} "
+            f"ORDER BY score DESC, s.post_id DESC LIMIT :limit"
+        )
+        params = {
+            'config': self.POST_CONFIG, 'query': self._tsquery(terms), 'limit': limit,
+            'headline_options': (
+                f'StartSel="{_HIGHLIGHT_START}", StopSel="{_HIGHLIGHT_END}", '
+                f'MaxWords={SNIPPET_TOKENS}, MinWords={SNIPPET_TOKENS // 2}, MaxFragments=1'
+            )
+        }
+        return self._execute_search(sql, params, cursor, _keyset(score, 's.post_id'))
+
+    def search_users(self, terms, limit, cursor=None, exclude_user_id=None):
+        score = "ts_rank_cd(s.document, q)"
+        sql = (
+            f"SELECT s.user_id AS id, {score} AS score "
+            f"FROM user_search s, to_tsquery(CAST(:config AS regconfig), :query) q "
+            f"WHERE s.document @@ q AND s.user_id != :exclude_user_id {{keyset}} "
+            f"ORDER BY score DESC, s.user_id DESC LIMIT :limit"
+        )
+        params = {
+            'config': self.USER_CONFIG, 'query': self._tsquery(terms), 'limit': limit,
+            'exclude_user_id': exclude_user_id or 0
+        }
+        return self._execute_search(sql, params, cursor, _keyset(score, 's.user_id'))
+
+_BACKENDS = {backend.name: backend for backend in (SqliteFtsSearchBackend(), PostgresSearchBackend())}
+
+def get_search_backend(bind=None):
+    """
+    Returns the search backend for the dialect of `bind` (a connection or engine,
+    defaulting to the app's engine).
+
+    Raises:
+        RuntimeError: If the database dialect has no full-text search backend.
+    """
+    dialect_name = (bind if bind is not None else db.engine).dialect.name
+    try:
+        return _BACKENDS[dialect_name]
+    except KeyError:
+        raise RuntimeError(f"Full-text search isn't supported on '{dialect_name}' databases.") from None
+
+def search_posts(query, limit, cursor=None):
+    """
+    Searches published posts.
+
+    Args:
+        query (str): Free-text query; every word must match, the last one as a prefix.
+        limit (int): Maximum number of results.
+        cursor (tuple, optional): (score, id) of the last result of the previous page.
+
+    Returns:
+        list: Rows with `id`, `score` and `snippet` (see `highlight_snippet`), best first.
+    """
+    terms = search_terms(query)
+    return get_search_backend().search_posts(terms, limit, cursor) if terms else []
+
+def search_users(query, limit, cursor=None, exclude_user_id=None):
+    """Searches users by username and full name. See `search_posts`; rows have no snippet."""
+    terms = search_terms(query)
+    return get_search_backend().search_users(terms, limit, cursor, exclude_user_id) if terms else []
+
+def rebuild_search_index(batch_size=1000):
+    """
+    Re-indexes every published post and every user, e.g. after restoring data. Runs in
+    batches of `batch_size` rows, each committed on its own.
+
+    Returns:
+        tuple: (posts indexed, users indexed)
+    """
+    backend = get_search_backend()
+    connection = db.session.connection()
+    backend.drop_index(connection)
+    backend.create_index(connection)
+    db.session.commit()
+
+    counts = []
+    for model, columns, index_row in (
+        (Post, (Post.id, Post.title, Post.content), backend.index_post),
+        (User, (User.id, User.username, User.full_name), backend.index_user),
+    ):
+        query = db.session.query(*columns)
+        if model is Post:
+            query = query.filter(Post.is_published == True) # noqa E712
+        indexed = 0
+        last_id = 0
+        while True:
+            rows = query.filter(model.id > last_id).order_by(model.id).limit(batch_size).all()
+            if not rows:
+                break
+            connection = db.session.connection()
+            for row in rows:
+                index_row(connection, *row)
+            db.session.commit()
+            indexed += len(rows)
+            last_id = rows[-1][0]
+        counts.append(indexed)
+    return tuple(counts)
+
+@db.event.listens_for(db.metadata, 'after_create')
+def on_metadata_created(target, connection, **kw):
+    # `db.create_all()` (tests, setup_db.py); migrated databases get the index from Alembic.
+    get_search_backend(connection).create_index(connection)
+
+@db.event.listens_for(db.metadata, 'before_drop')
+def on_metadata_dropping(target, connection, **kw):
+    get_search_backend(connection).drop_index(connection)
+
+def _any_changed(target, *attribute_names):
+    attrs = db.inspect(target).attrs
+    return any(attrs[name].history.has_changes() for name in attribute_names)
+
+@db.event.listens_for(Post, 'after_insert')
+def on_post_inserted(mapper, connection, target):
+    if target.is_published:
+        get_search_backend(connection).index_post(connection, target.id, target.title, target.content)
+
+@db.event.listens_for(Post, 'after_update')
+def on_post_updated(mapper, connection, target):
+    backend = get_search_backend(connection)
+    if not target.is_published:
+        if _any_changed(target, 'is_published'):
+            backend.unindex_post(connection, target.id)
+    elif _any_changed(target, 'title', 'content', 'is_published'):
+        backend.index_post(connection, target.id, target.title, target.content)
+
+@db.event.listens_for(Post, 'after_delete')
+def on_post_deleted(mapper, connection, target):
+    get_search_backend(connection).unindex_post(connection, target.id)
+
+@db.event.listens_for(User, 'after_insert')
+def on_user_inserted(mapper, connection, target):
+    get_search_backend(connection).index_user(connection, target.id, target.username, target.full_name)
+
+@db.event.listens_for(User, 'after_update')
+def on_user_updated(mapper, connection, target):
+    if _any_changed(target, 'username', 'full_name'):
+        get_search_backend(connection).index_user(connection, target.id, target.username, target.full_name)
+
+@db.event.listens_for(User, 'after_delete')
+def on_user_deleted(mapper, connection, target):
+    get_search_backend(connection).unindex_user(connection, target.id)
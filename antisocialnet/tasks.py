@@ -0,0 +1,95 @@
+"""
+Deferred work for request handlers.
+
+Tasks are plain functions registered under a name with the `@task` decorator and
+scheduled with `enqueue(name, **kwargs)`. Keyword arguments must be simple values
+(ids, strings) since tasks run outside the request, with their own app context and
+database session. Call `enqueue` after committing whatever the task needs to read.
+
+Where a task runs depends on TASK_BACKEND:
+
+* 'thread' (the default): an in-process thread pool. Nothing to deploy, but queued
+  work is lost if the process exits and a failure is only logged.
+* 'database': a row in the `task_job` table, run by `flask worker` processes (see
+  `worker`). Jobs survive restarts, run in priority order, are retried with backoff
+  and end up dead-lettered after their last attempt.
+
+Tasks registered with `local=True` work on this process's memory (e.g. rebuilding an
+in-process index), so they always use the thread pool. Since a job can run again after
+a worker dies mid-run, tasks should be safe to repeat.
+
+When `TASKS_RUN_INLINE` is set (as in `TestConfig`), tasks run synchronously in the
+calling thread, which keeps tests deterministic.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+
+_registry = {}
+_options = {}
+_executor_lock = threading.Lock()
+
+def task(name, priority=0, max_attempts=None, local=False):
+    """
+    Registers the decorated function as a task runnable by `enqueue(name, ...)`.
+
+    Args:
+        name (str): The task's name.
+        priority (int): Jobs with a higher priority are run first by database workers.
+        max_attempts (int, optional): Runs before a failing job is dead-lettered.
+                                      Defaults to TASK_MAX_ATTEMPTS.
+        local (bool): The task must run in the process that enqueued it.
+    """
+    def decorator(func):
+        _registry[name] = func
+        _options[name] = {'priority': priority, 'max_attempts': max_attempts, 'local': local}
+        return func
+    return decorator
+
+def get_task(name):
+    """
+    Returns the function registered as `name`.
+
+    Raises:
+        KeyError: If no task is registered under `name`.
+    """
+    if name not in _registry:
+        raise KeyError(f"Unknown task '{name}'.")
+    return _registry[name]
+
+def enqueue(name, **kwargs):
+    """
+    Schedules the task registered as `name` to run with the given keyword arguments.
+
+    Raises:
+        KeyError: If no task is registered under `name`.
+    """
+    func = get_task(name)
+    app = current_app._get_current_object()
+    if app.config.get('TASKS_RUN_INLINE', False):
+        func(**kwargs)
+        return
+    options = _options[name]
+    if app.config.get('TASK_BACKEND', 'thread') == 'database' and not options['local']:
+        from .worker import enqueue_job # Local import to avoid circular dependency
+        enqueue_job(name, kwargs, priority=options['priority'], max_attempts=options['max_attempts'])
+        return
+    _get_executor(app).submit(_run_task, app, name, kwargs)
+
+def _get_executor(app):
+    with _executor_lock:
+        executor = app.extensions.get('tasks_executor')
+        if executor is None:
+            executor = ThreadPoolExecutor(
+                max_workers=app.config.get('TASK_WORKER_THREADS', 4),
+                thread_name_prefix='antisocialnet-task'
+            )
+            app.extensions['tasks_executor'] = executor
+        return executor
+
+def _run_task(app, name, kwargs):
+    with app.app_context():
+        try:
+            _registry[name](**kwargs)
+        except Exception as e:
+            app.logger.error(f"Task '{name}' failed with arguments {kwargs}: {e}", exc_info=True)
@@ -0,0 +1,54 @@
+import pytest
+from flask import g
+
+from antisocialnet import create_app, db
+from antisocialnet.like_filter import like_filter_cache
+from antisocialnet.mention_utils import mention_index
+from antisocialnet.models import User
+
+@pytest.fixture
+def app(tmp_path):
+    # A database file of its own per test: the like buffer, job queue and notification
+    # code open connections besides the session's, which an in-memory database can't share.
+    app = create_app('testing', yaml_config_override={
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'test.db'}",
+        'NOTIFICATION_ARCHIVE_DIR': str(tmp_path / 'notification_archive'),
+        # Per-process caches outlive each test's database; don't let them answer from it.
+        'FANOUT_THRESHOLD_CACHE_SECONDS': 0,
+        'LATEST_BROADCAST_TTL_SECONDS': 0,
+    })
+
+    @app.before_request
+    def forget_cached_user():
+        # The test's app context outlives requests, and flask-login caches the user in g.
+        g.pop('_login_user', None)
+
+    with app.app_context():
+        db.create_all()
+        mention_index.invalidate()
+        like_filter_cache.invalidate()
+        yield app
+        db.session.remove()
+        db.engine.dispose()
+
+@pytest.fixture
+def make_user(app):
+    def make_user(full_name, **kwargs):
+        user = User(
+            username=f"{full_name.lower().replace(' ', '.')}@example.com", full_name=full_name,
+            is_active=True, is_approved=True, **kwargs
+        )
+        user.set_password('password')
+        db.session.add(user)
+        db.session.commit()
+        return user
+    return make_user
+
+@pytest.fixture
+def login(app):
+    def login(user):
+        client = app.test_client()
+        response = client.post('/api/v1/auth/login', json={'username': user.username, 'password': 'password'})
+        assert response.status_code == 200, response.get_json()
+        return client
+    return login
@@ -0,0 +1,82 @@
+from antisocialnet import db
+from antisocialnet.feed_utils import home_timeline_rows
+from antisocialnet.models import Post, HomeTimeline
+
+# TestConfig runs tasks inline, so the fan-out and backfill queued by these requests
+# have finished by the time the response is returned.
+
+def make_post(author, title):
+    post = Post(title=title, content=f'{title} body', user_id=author.id, is_published=True)
+    db.session.add(post)
+    db.session.commit()
+    return post
+
+def timeline_post_ids(user):
+    return [row.item_id for row in home_timeline_rows(user, 50) if row.item_type == 'post']
+
+def test_new_post_is_fanned_out_to_followers(make_user, login):
+    author, follower, stranger = make_user('Ann Author'), make_user('Fay Follower'), make_user('Sam Stranger')
+    follower.set_following(author, True)
+    db.session.commit()
+
+    response = login(author).post('/api/v1/posts/', json={'title': 'Hello', 'content': 'First post'})
+    assert response.status_code == 201
+    post_id = response.get_json()['data']['post_id']
+
+    assert timeline_post_ids(follower) == [post_id]
+    assert timeline_post_ids(stranger) == []
+    assert HomeTimeline.query.filter_by(user_id=follower.id, author_id=author.id).count() == 1
+
+def test_high_follower_author_is_merged_at_read_time(app, make_user, login):
+    app.config['FANOUT_FOLLOWER_THRESHOLD'] = 1
+    author, first, second = make_user('Pop Star'), make_user('Fan One'), make_user('Fan Two')
+    first.set_following(author, True)
+    second.set_following(author, True)
+    db.session.commit()
+
+    response = login(author).post('/api/v1/posts/', json={'title': 'Tour', 'content': 'Dates announced'})
+    post_id = response.get_json()['data']['post_id']
+
+    assert HomeTimeline.query.filter_by(author_id=author.id).count() == 0 # Not pushed
+    assert timeline_post_ids(first) == [post_id]
+    assert timeline_post_ids(second) == [post_id]
+
+def test_follow_backfills_recent_posts(app, make_user, login):
+    app.config['HOME_TIMELINE_BACKFILL_SIZE'] = 2
+    author, follower = make_user('Ann Author'), make_user('Fay Follower')
+    post_ids = [make_post(author, f'Post {index}').id for index in range(3)]
+
+    response = login(follower).post(f'/api/v1/profile/{author.id}/follow')
+    assert response.status_code == 200
+
+    assert timeline_post_ids(follower) == post_ids[:0:-1] # The two newest, newest first
+
+def test_unfollow_purges_the_authors_items(make_user, login):
+    author, other_author, follower = make_user('Ann Author'), make_user('Otto Other'), make_user('Fay Follower')
+    make_post(author, 'Mine')
+    other_post = make_post(other_author, 'Theirs')
+    client = login(follower)
+    client.post(f'/api/v1/profile/{author.id}/follow')
+    client.post(f'/api/v1/profile/{other_author.id}/follow')
+    assert len(timeline_post_ids(follower)) == 2
+
+    response = client.post(f'/api/v1/profile/{author.id}/unfollow')
+    assert response.status_code == 200
+
+    assert timeline_post_ids(follower) == [other_post.id]
+    assert HomeTimeline.query.filter_by(user_id=follower.id, author_id=author.id).count() == 0
+
+def test_following_feed_endpoint_pages_the_timeline(make_user, login):
+    author, follower = make_user('Ann Author'), make_user('Fay Follower')
+    post_ids = [make_post(author, f'Post {index}').id for index in range(3)]
+    client = login(follower)
+    client.post(f'/api/v1/profile/{author.id}/follow')
+
+    first_page = client.get('/api/v1/feed/following?per_page=2').get_json()
+    assert [item['data']['post_id'] for item in first_page['items']] == post_ids[:0:-1]
+    assert first_page['pagination']['has_next']
+    second_page = client.get(
+        f"/api/v1/feed/following?per_page=2&cursor={first_page['pagination']['next_cursor']}"
+    ).get_json()
+    assert [item['data']['post_id'] for item in second_page['items']] == post_ids[:1]
+    assert not second_page['pagination']['has_next']
@@ -0,0 +1,113 @@
+import pytest
+from flask import g
+from sqlalchemy import update
+
+from antisocialnet import db
+from antisocialnet import like_buffer as like_buffer_module
+from antisocialnet.like_buffer import LikeBuffer
+from antisocialnet.models import User, Post, Comment, Like, notify, reconcile_counters, write_like_batch
+
+@pytest.fixture
+def post(make_user):
+    author = make_user('Ann Author')
+    post = Post(title='Hello', content='First post', user_id=author.id, is_published=True)
+    db.session.add(post)
+    db.session.commit()
+    return post
+
+def like_rows(target_type, target_id):
+    return Like.query.filter_by(target_type=target_type, target_id=target_id).count()
+
+def test_write_like_batch_counts_only_rows_that_changed(make_user, post):
+    first, second = make_user('Fay First'), make_user('Sid Second')
+    comment = Comment(text='Nice', user_id=first.id, target_type='post', target_id=post.id)
+    db.session.add(comment)
+    db.session.commit()
+
+    inserted = []
+    counts = write_like_batch([(first.id, 'post', post.id)], [], inserted=inserted)
+    db.session.commit()
+    assert counts == {('post', post.id): 1}
+    assert inserted == [(first.id, 'post', post.id)]
+
+    # A repeated like and an unlike of something never liked change nothing.
+    inserted = []
+    counts = write_like_batch(
+        [(first.id, 'post', post.id), (second.id, 'post', post.id), (second.id, 'comment', comment.id)],
+        [(first.id, 'comment', comment.id)],
+        inserted=inserted
+    )
+    db.session.commit()
+    assert counts == {('post', post.id): 2, ('comment', comment.id): 1}
+    assert sorted(inserted) == [(second.id, 'comment', comment.id), (second.id, 'post', post.id)]
+
+    counts = write_like_batch([], [(first.id, 'post', post.id), (second.id, 'post', post.id)])
+    db.session.commit()
+    assert counts == {('post', post.id): 0}
+    db.session.expire_all()
+    assert (post.like_count, like_rows('post', post.id)) == (0, 0)
+    assert (comment.like_count, like_rows('comment', comment.id)) == (1, 1)
+
+def test_like_buffer_requeues_intents_when_a_flush_fails(monkeypatch, make_user, post):
+    fan = make_user('Fay Fan')
+    buffer = LikeBuffer()
+    def unavailable(*args, **kwargs):
+        raise RuntimeError('database unavailable')
+    monkeypatch.setattr(like_buffer_module, 'write_like_batch', unavailable)
+
+    # TestConfig flushes on every record; these flushes fail.
+    assert buffer.record(fan.id, 'post', post.id, True) == 1
+    assert buffer.record(fan.id, 'post', post.id, False) == 0
+    assert buffer.record(fan.id, 'post', post.id, True) == 1
+    stats = buffer.stats()
+    assert stats['flush_failures'] == 3
+    assert (stats['queue_depth'], stats['in_flight'], stats['flushes']) == (1, 0, 0)
+    assert buffer.pending_state(fan.id, 'post', post.id) is True
+    assert like_rows('post', post.id) == 0
+
+    monkeypatch.undo()
+    assert buffer.flush() == 1
+    db.session.expire_all()
+    assert (post.like_count, like_rows('post', post.id)) == (1, 1)
+    assert buffer.pending_state(fan.id, 'post', post.id) is None
+    stats = buffer.stats()
+    assert (stats['queue_depth'], stats['flushes'], stats['rows_flushed']) == (0, 1, 1)
+    assert buffer.flush() == 0
+
+def test_has_liked_item_sees_likes_made_elsewhere(make_user, post):
+    fan = make_user('Fay Fan')
+    assert not fan.has_liked_item('post', post.id) # Builds the user's Bloom filter
+
+    write_like_batch([(fan.id, 'post', post.id)], [])
+    db.session.commit()
+    g.pop('_like_filter_synced_users', None) # As on the next request
+    assert fan.has_liked_item('post', post.id)
+
+def test_reconcile_counters_finds_no_drift_after_normal_use(app, make_user, login, post):
+    app.config['LIKE_BUFFER_ENABLED'] = True
+    fan, other = make_user('Fay Fan'), make_user('Otto Other')
+    author = db.session.get(User, post.user_id)
+    client = login(fan)
+    assert client.post(f'/api/v1/item/post/{post.id}/like', json={'action': 'like'}).status_code == 200
+    assert client.post(f'/api/v1/profile/{author.id}/follow').status_code == 200
+    app.config['LIKE_BUFFER_ENABLED'] = False
+    comment = Comment(text='Nice', user_id=other.id, target_type='post', target_id=post.id)
+    db.session.add(comment)
+    db.session.commit()
+    other_client = login(other)
+    assert other_client.post(f'/api/v1/item/post/{post.id}/like', json={'action': 'like'}).status_code == 200
+    assert other_client.post(f'/api/v1/item/comment/{comment.id}/like', json={'action': 'like'}).status_code == 200
+    assert other_client.post(f'/api/v1/item/comment/{comment.id}/like', json={'action': 'unlike'}).status_code == 200
+    notify(fan.id, 'new_comment', [other.id], target_type='post', target_id=post.id)
+    db.session.commit()
+
+    drift = reconcile_counters(fix=False)
+    assert drift and set(drift.values()) == {0}, drift
+
+    db.session.execute(update(Post).where(Post.id == post.id).values(like_count=7, comment_count=0))
+    db.session.commit()
+    drift = reconcile_counters()
+    assert (drift['post.like_count'], drift['post.comment_count']) == (1, 1)
+    db.session.expire_all()
+    assert (post.like_count, post.comment_count) == (2, 1)
+    assert set(reconcile_counters(fix=False).values()) == {0}
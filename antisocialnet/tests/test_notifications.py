@@ -0,0 +1,106 @@
+import time
+from datetime import datetime, timezone
+
+from antisocialnet import db
+from antisocialnet.models import Notification, notify
+from antisocialnet.notification_stream import NotificationFeed
+
+def notifications_of(user):
+    db.session.expire_all()
+    return Notification.query.filter_by(user_id=user.id).order_by(Notification.id).all()
+
+def test_notify_coalesces_events_on_the_same_target(make_user):
+    author, first, second, third = (make_user(name) for name in ('Ann Author', 'Fay First', 'Sid Second', 'Tom Third'))
+
+    liked = notify(author.id, 'new_like', [first.id], target_type='post', target_id=1)
+    db.session.commit()
+    assert notify(author.id, 'new_like', [second.id, author.id], target_type='post', target_id=1) is liked
+    db.session.commit()
+    notify(author.id, 'new_like', [first.id], target_type='post', target_id=1) # Liked again after an unlike
+    db.session.commit()
+    notify(author.id, 'new_like', [third.id], target_type='post', target_id=2)
+    db.session.commit()
+
+    rows = notifications_of(author)
+    assert [(n.target_id, n.actor_count) for n in rows] == [(1, 2), (2, 1)]
+    assert (rows[0].actor_id, rows[0].recent_actor_id_list) == (first.id, [first.id, second.id])
+
+def test_notify_coalesces_followers_across_targets(make_user):
+    author, first, second = make_user('Ann Author'), make_user('Fay First'), make_user('Sid Second')
+
+    notify(author.id, 'new_follower', [first.id], target_type='user', target_id=first.id)
+    db.session.commit()
+    notify(author.id, 'new_follower', [second.id], target_type='user', target_id=second.id)
+    db.session.commit()
+
+    [row] = notifications_of(author)
+    assert (row.actor_count, row.target_id) == (2, second.id)
+
+def test_notify_starts_a_new_group_once_read_or_outside_the_window(app, make_user):
+    author, first, second, third = (make_user(name) for name in ('Ann Author', 'Fay First', 'Sid Second', 'Tom Third'))
+
+    notify(author.id, 'new_comment', [first.id], target_type='post', target_id=1).is_read = True
+    db.session.commit()
+    notify(author.id, 'new_comment', [second.id], target_type='post', target_id=1)
+    db.session.commit()
+    app.config['NOTIFICATION_COALESCE_WINDOW_SECONDS'] = 0
+    notify(author.id, 'new_comment', [third.id], target_type='post', target_id=1)
+    db.session.commit()
+    assert notify(author.id, 'new_comment', [author.id], target_type='post', target_id=1) is None
+
+    assert [n.actor_id for n in notifications_of(author)] == [first.id, second.id, third.id]
+
+# NotificationFeed.load() closes the session, so these tests hold on to ids, not users.
+
+def test_notification_feed_resumes_from_any_event_id(make_user):
+    author, fan = (make_user(name).id for name in ('Ann Author', 'Fay Fan'))
+    notify(author, 'mention_in_comment', [fan], target_type='post', target_id=1)
+    db.session.commit()
+
+    feed = NotificationFeed(author)
+    notifications, unread = feed.load()
+    assert (notifications, unread) == ([], {'mention_in_comment': 1}) # A new feed starts from now
+    assert not feed.resumed
+
+    mentions = [notify(author, 'mention_in_comment', [fan], target_type='post', target_id=target_id)
+                for target_id in (2, 3, 4)]
+    db.session.commit()
+    ids = [mention.id for mention in mentions]
+    time.sleep(0.01) # Past the creation times, at the cursor's millisecond precision
+    notifications, unread = feed.load()
+    assert [n['id'] for n in notifications] == ids
+    assert unread == {'mention_in_comment': 4}
+    event_ids, cursor = feed.event_ids, feed.cursor
+    assert len(event_ids) == 3 and event_ids[-1] == cursor
+    assert feed.load() == ([], None) # Nothing new, and the counts haven't changed
+
+    # A client that only got the first of the three picks up the rest.
+    resumed = NotificationFeed(author, event_ids[0])
+    assert resumed.resumed
+    assert [n['id'] for n in resumed.load()[0]] == ids[1:]
+    assert [n['id'] for n in NotificationFeed(author, cursor).load()[0]] == []
+
+def test_notification_feed_resends_updated_groups(make_user):
+    author, first, second = (make_user(name).id for name in ('Ann Author', 'Fay First', 'Sid Second'))
+    feed = NotificationFeed(author)
+    feed.load()
+    group = notify(author, 'new_like', [first], target_type='post', target_id=1)
+    db.session.commit()
+    group_id = group.id
+    assert [n['actor_count'] for n in feed.load()[0]] == [1]
+
+    notify(author, 'new_like', [second], target_type='post', target_id=1)
+    db.session.commit()
+    notifications, unread = feed.load()
+    assert [(n['id'], n['actor_count']) for n in notifications] == [(group_id, 2)]
+    assert unread is None # Still one unread like notification
+    assert feed.load() == ([], None)
+
+def test_notification_feed_cursor_round_trip(app):
+    loaded_at = datetime(2026, 1, 2, 3, 4, 5, 678000, timezone.utc)
+    cursor = NotificationFeed.format_cursor(12, 3, loaded_at)
+    assert NotificationFeed.parse_cursor(cursor) == (12, 3, loaded_at)
+    for invalid in (None, '', '12-3', 'a-b-c', '1-2-3-4'):
+        assert NotificationFeed.parse_cursor(invalid) == (None, None, None)
+    feed = NotificationFeed(1, 'junk')
+    assert not feed.resumed and feed.notification_id is None
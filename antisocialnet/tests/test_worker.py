@@ -0,0 +1,103 @@
+from collections import Counter
+from datetime import datetime, timezone, timedelta
+
+import pytest
+from sqlalchemy import update
+
+from antisocialnet import db
+from antisocialnet.models import TaskJob
+from antisocialnet.tasks import task
+from antisocialnet.worker import enqueue_job, claim_job, run_job
+
+runs = Counter()
+
+@task('tests.flaky')
+def flaky(token, failures):
+    """Fails its first `failures` runs for `token`."""
+    runs[token] += 1
+    if runs[token] <= failures:
+        raise RuntimeError(f'run {runs[token]} of {token} failed')
+
+@pytest.fixture(autouse=True)
+def reset_runs():
+    runs.clear()
+
+def utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None) # As SQLite returns them
+
+def job_row(job_id):
+    db.session.expire_all()
+    return db.session.get(TaskJob, job_id)
+
+def make_runnable(job_id, **values):
+    with db.engine.begin() as connection:
+        connection.execute(update(TaskJob).where(TaskJob.id == job_id).values(**values))
+
+def test_failed_job_is_retried_with_backoff_until_dead_lettered(app):
+    job_id = enqueue_job('tests.flaky', {'token': 'a', 'failures': 5}, max_attempts=2)
+
+    job = claim_job('worker-1')
+    assert (job.id, job.attempts, job.max_attempts) == (job_id, 1, 2)
+    assert claim_job('worker-2') is None # Leased to worker-1
+    assert not run_job(job, 'worker-1')
+    row = job_row(job_id)
+    assert (row.status, row.attempts, row.leased_by) == (TaskJob.STATUS_QUEUED, 1, None)
+    assert row.last_error == 'RuntimeError: run 1 of a failed'
+    backoff = app.config['TASK_RETRY_BACKOFF_SECONDS']
+    assert utcnow() + timedelta(seconds=backoff * 0.7) < row.run_at < utcnow() + timedelta(seconds=backoff * 1.3)
+    assert claim_job('worker-1') is None # Still backing off
+
+    make_runnable(job_id, run_at=utcnow() - timedelta(seconds=1))
+    job = claim_job('worker-2')
+    assert job.attempts == 2
+    assert not run_job(job, 'worker-2')
+    row = job_row(job_id)
+    assert (row.status, row.attempts, row.last_error) == (TaskJob.STATUS_DEAD, 2, 'RuntimeError: run 2 of a failed')
+    make_runnable(job_id, run_at=utcnow() - timedelta(seconds=1))
+    assert claim_job('worker-1') is None # Dead jobs stay put
+    assert runs['a'] == 2
+
+def test_job_that_succeeds_on_retry_is_deleted(app):
+    job_id = enqueue_job('tests.flaky', {'token': 'b', 'failures': 1}, max_attempts=3)
+    assert not run_job(claim_job('worker-1'), 'worker-1')
+    make_runnable(job_id, run_at=utcnow() - timedelta(seconds=1))
+
+    assert run_job(claim_job('worker-1'), 'worker-1')
+    assert job_row(job_id) is None
+    assert runs['b'] == 2
+
+def test_expired_lease_is_run_again_then_dead_lettered(app):
+    job_id = enqueue_job('tests.flaky', {'token': 'c', 'failures': 0}, max_attempts=2)
+    assert claim_job('worker-1').attempts == 1
+
+    # worker-1 died: once its lease runs out the job is claimed again...
+    make_runnable(job_id, leased_until=utcnow() - timedelta(seconds=1))
+    job = claim_job('worker-2')
+    assert (job.id, job.attempts) == (job_id, 2)
+    assert job_row(job_id).leased_by == 'worker-2'
+
+    # ...but not after its last attempt.
+    make_runnable(job_id, leased_until=utcnow() - timedelta(seconds=1))
+    assert claim_job('worker-3') is None
+    row = job_row(job_id)
+    assert (row.status, row.leased_by) == (TaskJob.STATUS_DEAD, None)
+    assert row.last_error.startswith('Lease expired')
+    assert runs['c'] == 0
+
+def test_a_stale_worker_cannot_finish_a_reclaimed_job(app):
+    job_id = enqueue_job('tests.flaky', {'token': 'd', 'failures': 0}, max_attempts=3)
+    stale_job = claim_job('worker-1')
+    make_runnable(job_id, leased_until=utcnow() - timedelta(seconds=1))
+    claim_job('worker-2')
+
+    assert run_job(stale_job, 'worker-1')
+    row = job_row(job_id)
+    assert (row.status, row.leased_by) == (TaskJob.STATUS_RUNNING, 'worker-2')
+
+def test_jobs_are_claimed_by_priority_then_age(app):
+    low = enqueue_job('tests.flaky', {'token': 'low', 'failures': 0})
+    high = enqueue_job('tests.flaky', {'token': 'high', 'failures': 0}, priority=5)
+    later_low = enqueue_job('tests.flaky', {'token': 'later', 'failures': 0})
+
+    assert [claim_job('worker-1').id for _ in range(3)] == [high, low, later_low]
+    assert claim_job('worker-1') is None
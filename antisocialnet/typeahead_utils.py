@@ -0,0 +1,288 @@
+"""
+Prefix typeahead for users and tags, answered from process memory.
+
+Each kind of item lives in a `PrefixIndex`: a sorted array of (normalized key, item id)
+pairs searched with bisect, plus each item's label and weight (follower count for users,
+number of tagged posts for tags). A lookup finds the first key >= the prefix and walks
+forward while keys still start with it, keeping the top k items by weight, so it never
+touches the database.
+
+The index is built once per process and then updated incrementally: changes to users,
+tags, follows and post tags are collected per session during the flush and applied when
+the transaction commits (and discarded on rollback). Other processes' changes are picked
+up by a full rebuild in the background every TYPEAHEAD_INDEX_TTL_SECONDS; the previous
+index keeps answering while it runs.
+"""
+import bisect
+import heapq
+import threading
+import time
+import unicodedata
+from flask import current_app
+from sqlalchemy import select, func
+from sqlalchemy.orm import Session
+
+from . import db
+from .models import User, Tag, Post, FollowerLink, post_tags
+from .tasks import task, enqueue
+
+def normalize_typeahead_text(value):
+    """Lowercases, strips accents and collapses whitespace, so 'Zoë  Ann' matches 'zoe a'."""
+    decomposed = unicodedata.normalize('NFKD', value or '')
+    without_accents = ''.join(char for char in decomposed if not unicodedata.combining(char))
+    return ' '.join(without_accents.lower().split())
+
+class PrefixIndex:
+    """
+    Sorted (key, item id) array with per-item labels, payloads and weights. Every word
+    of a label starts a key, so 'lee' finds 'Ann Lee' as well as 'ann l' does.
+    Not thread-safe on its own; `TypeaheadIndex` serializes access.
+    """
+
+    def __init__(self):
+        self._entries = [] # sorted list of (normalized key, item id)
+        self._items = {} # item id -> [payload, weight, keys]
+        self._short_prefix_cache = {} # (prefix, limit) -> payloads, for the most expensive lookups
+
+    def __len__(self):
+        return len(self._items)
+
+    @staticmethod
+    def _keys_for(label):
+        words = normalize_typeahead_text(label).split(' ')
+        return {' '.join(words[position:]) for position in range(len(words)) if words[position]}
+
+    def load(self, items):
+        """Bulk-loads (item id, label, payload, weight) tuples into an empty index."""
+        for item_id, label, payload, weight in items:
+            keys = self._keys_for(label)
+            self._items[item_id] = [payload, weight, keys]
+            self._entries.extend((key, item_id) for key in keys)
+        self._entries.sort()
+
+    def put(self, item_id, label, payload, weight=None):
+        """Adds or replaces an item. Its weight is kept if `weight` is None."""
+        previous = self._items.get(item_id)
+        if weight is None:
+            weight = previous[1] if previous else 0
+        keys = self._keys_for(label)
+        if previous:
+            for key in previous[2] - keys:
+                self._remove_entry(key, item_id)
+            new_keys = keys - previous[2]
+        else:
+            new_keys = keys
+        for key in new_keys:
+            bisect.insort(self._entries, (key, item_id))
+        self._items[item_id] = [payload, weight, keys]
+        self._short_prefix_cache.clear()
+
+    def remove(self, item_id):
+        previous = self._items.pop(item_id, None)
+        if previous:
+            for key in previous[2]:
+                self._remove_entry(key, item_id)
+            self._short_prefix_cache.clear()
+
+    def adjust_weight(self, item_id, delta):
+        item = self._items.get(item_id)
+        if item:
+            item[1] = max(0, item[1] + delta)
+            self._short_prefix_cache.clear()
+
+    def _remove_entry(self, key, item_id):
+        position = bisect.bisect_left(self._entries, (key, item_id))
+        if position < len(self._entries) and self._entries[position] == (key, item_id):
+            del self._entries[position]
+
+    def top(self, prefix, limit, max_scan):
+        """
+        Returns the payloads of up to `limit` items with a key starting with `prefix`,
+        heaviest first. At most `max_scan` keys are examined, which bounds very short
+        prefixes on large indexes at the cost of exact ranking for them. Results for one-
+        and two-character prefixes are cached until the index next changes.
+        """
+        cache_key = (prefix, limit)
+        if len(prefix) <= 2 and cache_key in self._short_prefix_cache:
+            return self._short_prefix_cache[cache_key]
+        candidates = {}
+        position = bisect.bisect_left(self._entries, (prefix,))
+        for key, item_id in self._entries[position:position + max_scan]:
+            if not key.startswith(prefix):
+                break
+            candidates[item_id] = self._items[item_id]
+        best = heapq.nsmallest(
+            limit, candidates.items(), key=lambda entry: (-entry[1][1], entry[1][0]['label'], entry[0])
+        )
+        results = [item[0] for _, item in best]
+        if len(prefix) <= 2:
+            self._short_prefix_cache[cache_key] = results
+        return results
+
+def _user_payload(user_id, full_name, profile_photo_url):
+    return {'type': 'user', 'id': user_id, 'label': full_name, 'profile_photo_url': profile_photo_url}
+
+def _tag_payload(tag_id, name, slug):
+    return {'type': 'tag', 'id': tag_id, 'label': name, 'slug': slug}
+
+class TypeaheadIndex:
+    """Process-local user and tag prefix indexes with commit-time incremental updates."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock() # Held during the first build, so only one request does it
+        self._users = None
+        self._tags = None
+        self._expires_at = 0.0
+        self._rebuild_scheduled = False
+
+    def lookup(self, prefix, kinds=('user', 'tag'), limit=8):
+        """
+        Finds users and/or tags whose name (or any word of it) starts with `prefix`.
+
+        Returns:
+            dict: Maps each requested kind to a list of payload dicts, best first.
+        """
+        prefix = normalize_typeahead_text(prefix)
+        if self._users is None:
+            with self._build_lock:
+                if self._users is None:
+                    self.rebuild() # First use in this process.
+        elif self._expires_at <= time.monotonic():
+            self._schedule_rebuild()
+        if not prefix:
+            return {kind: [] for kind in kinds}
+        max_scan = current_app.config.get('TYPEAHEAD_MAX_SCAN', 5000)
+        with self._lock:
+            indexes = {'user': self._users, 'tag': self._tags}
+            return {kind: indexes[kind].top(prefix, limit, max_scan) for kind in kinds}
+
+    def _schedule_rebuild(self):
+        with self._lock:
+            if self._rebuild_scheduled:
+                return
+            self._rebuild_scheduled = True
+        try:
+            enqueue('typeahead.rebuild')
+        except Exception:
+            with self._lock:
+                self._rebuild_scheduled = False
+            raise
+
+    def run_scheduled_rebuild(self):
+        """Runs the rebuild queued by `_schedule_rebuild`; the next can be scheduled once it ends, even if it failed."""
+        try:
+            return self.rebuild()
+        finally:
+            with self._lock:
+                self._rebuild_scheduled = False
+
+    def rebuild(self):
+        """Rebuilds both indexes from the database and swaps them in."""
+        users = PrefixIndex()
+        user_rows = db.session.execute(
+            select(User.id, User.full_name, User.profile_photo_url, User.follower_count)
+            .where(User.is_active == True, User.is_approved == True) # noqa E712
+        )
+        users.load(
+            (user_id, full_name, _user_payload(user_id, full_name, profile_photo_url), follower_count)
+            for user_id, full_name, profile_photo_url, follower_count in user_rows
+        )
+
+        tags = PrefixIndex()
+        tag_rows = db.session.execute(
+            select(Tag.id, Tag.name, Tag.slug, func.count(post_tags.c.post_id))
+            .outerjoin(post_tags, post_tags.c.tag_id == Tag.id)
+            .group_by(Tag.id, Tag.name, Tag.slug)
+        )
+        tags.load(
+            (tag_id, name, _tag_payload(tag_id, name, slug), usage_count)
+            for tag_id, name, slug, usage_count in tag_rows
+        )
+
+        with self._lock:
+            self._users, self._tags = users, tags
+            self._expires_at = time.monotonic() + current_app.config.get('TYPEAHEAD_INDEX_TTL_SECONDS', 600)
+        return len(users), len(tags)
+
+    def apply(self, changes):
+        """Applies committed changes collected by the session hooks below."""
+        with self._lock:
+            if self._users is None:
+                return # Not built yet; the first build reads the committed state.
+            indexes = {'user': self._users, 'tag': self._tags}
+            for operation, kind, item_id, *args in changes:
+                index = indexes[kind]
+                if operation == 'put':
+                    index.put(item_id, *args)
+                elif operation == 'remove':
+                    index.remove(item_id)
+                else:
+                    index.adjust_weight(item_id, *args)
+
+typeahead_index = TypeaheadIndex()
+
+@task('typeahead.rebuild', local=True) # Rebuilds this process's index
+def rebuild_typeahead_index():
+    users_indexed, tags_indexed = typeahead_index.run_scheduled_rebuild()
+    current_app.logger.info(f"Rebuilt typeahead index with {users_indexed} user(s) and {tags_indexed} tag(s).")
+
+# Changes are collected per session during the flush and applied only once the
+# transaction commits, so the index never shows uncommitted (or rolled back) data.
+_PENDING_KEY = 'typeahead_pending_changes'
+
+def _pending_changes(session):
+    return session.info.setdefault(_PENDING_KEY, [])
+
+@db.event.listens_for(Session, 'after_flush')
+def on_session_flushed(session, flush_context):
+    changes = []
+    for obj in session.new | session.dirty:
+        if isinstance(obj, User):
+            if obj.is_active and obj.is_approved:
+                payload = _user_payload(obj.id, obj.full_name, obj.profile_photo_url)
+                changes.append(('put', 'user', obj.id, obj.full_name, payload))
+            else:
+                changes.append(('remove', 'user', obj.id))
+        elif isinstance(obj, Tag):
+            changes.append(('put', 'tag', obj.id, obj.name, _tag_payload(obj.id, obj.name, obj.slug)))
+        elif isinstance(obj, Post):
+            history = db.inspect(obj).attrs.tags.history
+            changes.extend(('adjust', 'tag', tag.id, 1) for tag in history.added)
+            changes.extend(('adjust', 'tag', tag.id, -1) for tag in history.deleted)
+    for obj in session.deleted:
+        if isinstance(obj, User):
+            changes.append(('remove', 'user', obj.id))
+        elif isinstance(obj, Tag):
+            changes.append(('remove', 'tag', obj.id))
+        elif isinstance(obj, Post):
+            # Only if the tags were loaded; otherwise the next rebuild corrects the counts.
+            changes.extend(('adjust', 'tag', tag.id, -1) for tag in db.inspect(obj).dict.get('tags', ()))
+    if changes:
+        _pending_changes(session).extend(changes)
+
+def note_follower_count_change(session, user_id, delta):
+    """Records a follower count change made without the ORM (see `User.set_following`)."""
+    _pending_changes(session).append(('adjust', 'user', user_id, delta))
+
+@db.event.listens_for(FollowerLink, 'after_insert')
+def on_follow_added(mapper, connection, target):
+    session = db.inspect(target).session
+    if session is not None:
+        note_follower_count_change(session, target.followed_id, 1)
+
+@db.event.listens_for(FollowerLink, 'after_delete')
+def on_follow_removed(mapper, connection, target):
+    session = db.inspect(target).session
+    if session is not None:
+        note_follower_count_change(session, target.followed_id, -1)
+
+@db.event.listens_for(Session, 'after_commit')
+def on_session_committed(session):
+    changes = session.info.pop(_PENDING_KEY, None)
+    if changes:
+        typeahead_index.apply(changes)
+
+@db.event.listens_for(Session, 'after_rollback')
+def on_session_rolled_back(session):
+    session.info.pop(_PENDING_KEY, None)
@@ -1,11 +1,10 @@
 # Utility functions for the application can be placed here.
 import re
+import html as html_lib
 import unicodedata
 from datetime import datetime
 from flask import url_for
 from markupsafe import Markup, escape
-import bleach
-import markdown as md_lib # Use md_lib to avoid conflict with template filter name
 
 def get_avatar_url(user):
     if user.profile_photo_url:
@@ -68,19 +67,69 @@ def human_readable_date(dt, show_time=True):
     else:
         return dt.strftime("%b %d, %Y")
 
-def linkify_mentions(text):
+def scan_mentions_util(text, connection=None):
+    """
+    Finds every @FullName mention in a text, whether or not it resolves to a user.
+
+    All names are resolved in one pass against the in-memory mention index (see
+    `mention_utils`), so this usually runs no queries.
+
+    Args:
+        text (str): The Markdown source to scan.
+        connection (Connection, optional): Connection to use if a query is needed, e.g.
+                                           when called from inside a flush.
+
+    Returns:
+        list[tuple[str, int | None, int, int]]: (name, user_id, span_start, span_end)
+            for each mention, where `name` is the mentioned name space-normalized and
+            lowercased, `user_id` is None unless exactly one user has that name, and the
+            span covers "@Full Name" in `text`.
+    """
+    if not text:
+        return []
+    matches = list(re.finditer(MENTION_REGEX, str(text)))
+    if not matches:
+        return []
+
+    from .mention_utils import resolve_mentions # Local import to avoid circular dependency at module level
+    resolved = resolve_mentions([match.group(1) for match in matches], connection=connection)
+
+    mentions = []
+    for match in matches:
+        name = ' '.join(match.group(1).split()).lower()
+        user_ids = resolved.get(name, ())
+        mentions.append((name, user_ids[0] if len(user_ids) == 1 else None, match.start(), match.end()))
+    return mentions
+
+def find_mentions_util(text, connection=None):
+    """
+    Finds the @FullName mentions in a text that resolve to exactly one user.
+
+    Returns:
+        list[tuple[int, int, int]]: (user_id, span_start, span_end) for each resolvable
+                                    mention, where the span covers "@Full Name" in `text`.
+                                    See `scan_mentions_util`.
+    """
+    return [
+        (user_id, span_start, span_end)
+        for _, user_id, span_start, span_end in scan_mentions_util(text, connection=connection)
+        if user_id is not None
+    ]
+
+def linkify_mentions(text, mentions=None):
     """
     Converts @FullName mentions in a given text into Markdown links
-    pointing to user profiles.
+    pointing to user profiles (e.g., "[@John Doe](/profile/user_id)").
 
-    It uses a regular expression to find mentions (e.g., "@John Doe") and
-    queries the database for users with a matching full name (case-insensitive).
-    If a unique user is found, the mention is replaced with a Markdown link
-    to their profile (e.g., "[@John Doe](/profile/user_id)").
-    If no user or multiple users are found for a mention, it remains plain text.
+    When `mentions` is given (spans recorded at write time, as stored in the resolved
+    `content_mention` rows), the links are spliced in without touching the database.
+    Otherwise the mentions are found with `find_mentions_util`. Mentions that match no
+    user or several users remain plain text, which prevents linking to the wrong
+    profile or to dead links.
 
     Args:
         text (str): The input text possibly containing @FullName mentions.
+        mentions (list, optional): (user_id, span_start, span_end) tuples for `text`.
 
     Returns:
         str: The text with @FullName mentions converted to Markdown profile links where possible.
@@ -89,45 +138,17 @@ def linkify_mentions(text):
     if text is None:
         return ''
     text = str(text)
-
-    from .models import User # Local import to avoid circular dependency at module level
-    from . import db # Assuming db is SQLAlchemy instance from __init__
-    from sqlalchemy import func # For func.lower
-
-    # Regex to find @Full Name patterns (alphanumeric, underscore, apostrophe, spaces)
-    # This must match the one in extract_mentions
-    mention_regex = r'@([A-Za-z0-9_\']+(?:\s[A-Za-z0-9_\']+)*)' # Regex for @FullName
-
-    def replace_mention(match):
-        full_name_mention = ' '.join(match.group(1).split()) # Normalize spaces in extracted name
-
-        # Query for the user by full_name (case-insensitive)
-        # This is a simplified approach. For production, consider performance implications of func.lower()
-        # and how to handle multiple users with the same full_name.
-        users_found = User.query.filter(func.lower(User.full_name) == func.lower(full_name_mention)).all()
-
-        if len(users_found) == 1:
-            user = users_found[0]
-            # TODO: AGENTS.md specifies profile URLs should use user.handle.
-            # This requires adding a 'handle' field to the User model.
-            # For now, linking by user.id.
-            return f'[@{full_name_mention}](/profile/{user.id})' # Generates a markdown link
-        else:
-            # If no user or multiple users found, don't linkify, return original mention text
-            # This prevents linking to wrong profile or dead links.
-            # UI could potentially offer disambiguation if multiple users are found.
-            # For now, just return the text.
-            current_app.logger.info(f"Mention '@{full_name_mention}' not linked: {len(users_found)} users found.")
-            return f'@{full_name_mention}' # Return as plain text
-
-    # Need access to current_app for logging inside replace_mention,
-    # which is tricky as this util might be called outside app context by Jinja filter.
-    # A better way is to pass current_app or its logger if needed, or handle logging outside.
-    # For now, assuming this function is called within an app context (e.g., by the template filter).
-    from flask import current_app
-
-    linked_text = re.sub(mention_regex, replace_mention, text)
-    return linked_text
+    if mentions is None:
+        mentions = find_mentions_util(text)
+
+    pieces, position = [], 0
+    for user_id, span_start, span_end in sorted(mentions, key=lambda mention: mention[1]):
+        full_name_mention = ' '.join(text[span_start + 1:span_end].split()) # Normalize spaces in the name
+        pieces.append(text[position:span_start])
+        pieces.append(f'[@{full_name_mention}](/profile/{user_id})')
+        position = span_end
+    pieces.append(text[position:])
+    return ''.join(pieces)
 
 def markdown_to_html_and_sanitize_util(text):
     """
@@ -136,6 +157,9 @@ def markdown_to_html_and_sanitize_util(text):
     if text is None:
         return ''
     text = str(text)
+    # Imported here so that importing the package (setup scripts, migrations) doesn't load them
+    import bleach
+    import markdown as md_lib # Use md_lib to avoid conflict with template filter name
 
     # Convert markdown to HTML
     # Using extensions like 'fenced_code' for code blocks, 'tables' for tables
@@ -156,6 +180,35 @@ def markdown_to_html_and_sanitize_util(text):
     return Markup(sanitized_html)
 
 
+# Bump whenever render_content_util's output changes (extensions, the allowed
+# tags/attributes below, mention links, ...) or what is recorded in content_mention, so
+# stored HTML and mentions get re-rendered by `flask content rerender`.
+RENDER_VERSION = 3
+EXCERPT_WORDS = 30
+
+def render_content_util(text, mentions=None):
+    """
+    Renders Markdown source to the forms stored alongside it at write time, with
+    @mentions turned into profile links.
+
+    Args:
+        text (str): The Markdown source, e.g. a post's content or a photo caption.
+        mentions (list, optional): Mention spans from `find_mentions_util`. Found on the
+                                   fly when omitted.
+
+    Returns:
+        tuple[str | None, str | None]: The sanitized HTML and a plain-text excerpt of at
+                                       most EXCERPT_WORDS words, or (None, None) if
+                                       `text` is empty.
+    """
+    if not text:
+        return None, None
+    import bleach
+    html_content = str(markdown_to_html_and_sanitize_util(linkify_mentions(text, mentions)))
+    words = html_lib.unescape(bleach.clean(html_content, tags=[], strip=True)).split()
+    excerpt = ' '.join(words[:EXCERPT_WORDS]) + ('...' if len(words) > EXCERPT_WORDS else '')
+    return html_content, excerpt
+
 def init_app(app):
     """Initialize utility functions and filters for the Flask app."""
     app.jinja_env.filters['human_readable_date'] = human_readable_date
@@ -206,6 +259,10 @@ def allowed_file_util(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in current_app.config['ALLOWED_EXTENSIONS']
 
+# Matches @Full Name mentions: words of letters, digits, underscores and apostrophes
+# separated by single spaces. Shared by extract_mentions and linkify_mentions.
+MENTION_REGEX = r'@([A-Za-z0-9_\']+(?:\s[A-Za-z0-9_\']+)*)'
+
 def extract_mentions(text):
     """
     Extracts @FullName mentions from a given text string.
@@ -237,8 +294,7 @@ def extract_mentions(text):
     # To align with test_extract_mentions which expects single-token mentions for "@world and" -> "world"
     # the regex should only capture the first word-like token.
     # Updated regex to match linkify_mentions for full name support:
-    mention_regex = r'@([A-Za-z0-9_\']+(?:\s[A-Za-z0-9_\']+)*)'
-    mentions = re.findall(mention_regex, text)
+    mentions = re.findall(MENTION_REGEX, text)
     # Strip trailing spaces from extracted mentions, just in case regex captures it with lookaheads/behinds (though current one shouldn't)
     # Also, normalize multiple spaces within a name to a single space if the regex were more lenient.
     # For this regex, it should be fine, but good practice if regex changes.
@@ -303,17 +359,18 @@ def update_post_relations_util(post, form_data, current_user_id, is_new_post=Fal
     # This part is highly dependent on how mentions are handled (e.g., in form_data or extracted from content)
     # Let's assume form_data might contain an explicit list of mentioned usernames,
     # or we re-extract from post.content. For now, re-extracting from content.
-    from sqlalchemy import func # For func.lower for case-insensitive query
+    from .mention_utils import resolve_mentions
 
     mentioned_full_names = extract_mentions(post.content) # Now extracts full names
     if mentioned_full_names:
+        resolved = resolve_mentions(mentioned_full_names) # All names in one lookup pass
         for full_name in mentioned_full_names:
-            # Case-insensitive query for full_name. This might return multiple users.
+            # A name may belong to several users.
             # For notifications, we should only notify if we find a *single* unique match.
-            mentioned_users = User.query.filter(func.lower(User.full_name) == func.lower(full_name)).all()
+            mentioned_user_ids = resolved.get(full_name.lower(), ())
 
-            if len(mentioned_users) == 1:
-                mentioned_user = mentioned_users[0]
+            if len(mentioned_user_ids) == 1:
+                mentioned_user = db.session.get(User, mentioned_user_ids[0])
                 if mentioned_user.id != current_user_id: # Don't notify for self-mentions
                     # Check if a notification already exists for this post and user to avoid duplicates
                     existing_notification = Notification.query.filter_by(
@@ -334,8 +391,8 @@ def update_post_relations_util(post, form_data, current_user_id, is_new_post=Fal
                         )
                         db.session.add(notification)
                         current_app.logger.info(f"Mention notification to be created for user '{mentioned_user.full_name}' (ID: {mentioned_user.id}) in post {post.id}")
-            elif len(mentioned_users) > 1:
-                current_app.logger.info(f"Ambiguous mention for '{full_name}' in post {post.id}: {len(mentioned_users)} users found. No notification sent.")
+            elif len(mentioned_user_ids) > 1:
+                current_app.logger.info(f"Ambiguous mention for '{full_name}' in post {post.id}: {len(mentioned_user_ids)} users found. No notification sent.")
             else:
                 current_app.logger.info(f"Mentioned name '{full_name}' in post {post.id} does not correspond to any user. No notification sent.")
 
@@ -348,9 +405,9 @@ def update_post_relations_util(post, form_data, current_user_id, is_new_post=Fal
 # New file upload utility
 import os
 import uuid
-from PIL import Image # Ensure Pillow is installed: pip install Pillow
 from werkzeug.utils import secure_filename
 from flask import current_app, flash
+from .tasks import task
 
 # allowed_file_util is defined earlier in this file.
 
@@ -362,7 +419,8 @@ def save_uploaded_file(
     current_user_id=None,
     crop_coords=None,
     thumbnail_size=None,
-    existing_db_path=None
+    existing_db_path=None,
+    defer_processing=False
 ):
     """
     Handles the validation, processing, and saving of uploaded files, typically images.
@@ -398,6 +456,11 @@ def save_uploaded_file(
         existing_db_path (str, optional): Relative path (from static folder) to an existing file
                                           that should be deleted (e.g., old profile photo).
                                           Defaults to None.
+        defer_processing (bool, optional): Save the upload as is, leaving the cropping and
+                                           resizing to the 'images.process_profile_photo'
+                                           task, which the caller enqueues after committing.
+                                           Workers must share the upload folder.
+                                           Defaults to False.
 
     Returns:
         str | None: The database-storable relative path to the saved file (from static folder)
@@ -454,25 +517,9 @@ def save_uploaded_file(
 
     try:
         file_storage_object.stream.seek(0)
-        if upload_type == "profile_photo" and (crop_coords or thumbnail_size):
-            img = Image.open(file_storage_object.stream)
-            if crop_coords and crop_coords.get('width', 0) > 0 and crop_coords.get('height', 0) > 0:
-                try:
-                    x = int(float(crop_coords['x']))
-                    y = int(float(crop_coords['y']))
-                    w = int(float(crop_coords['width']))
-                    h = int(float(crop_coords['height']))
-                    img = img.crop((x, y, x + w, y + h))
-                except (ValueError, TypeError, KeyError) as e_crop:
-                    current_app.logger.warning(f"Invalid crop coordinates for profile photo: {crop_coords}. Error: {e_crop}")
-                    flash("Invalid crop coordinates provided. Photo processed without custom cropping.", "warning")
-
-            if thumbnail_size:
-                img.thumbnail(thumbnail_size, Image.Resampling.LANCZOS) # Use LANCZOS for better quality
-
-            if ext in ['jpg', 'jpeg'] and img.mode == 'RGBA':
-                img = img.convert('RGB')
-            img.save(save_path_abs)
+        if upload_type == "profile_photo" and (crop_coords or thumbnail_size) and not defer_processing:
+            if not _crop_and_resize_image(file_storage_object.stream, save_path_abs, ext, crop_coords, thumbnail_size):
+                flash("Invalid crop coordinates provided. Photo processed without custom cropping.", "warning")
         else:
             file_storage_object.save(save_path_abs)
 
@@ -508,3 +555,54 @@ def save_uploaded_file(
             except OSError:
                 pass
         return None
+
+def _crop_and_resize_image(source, save_path_abs, ext, crop_coords=None, thumbnail_size=None):
+    """
+    Crops and/or shrinks the image read from `source` (a path or file object) and saves
+    it to `save_path_abs`.
+
+    Returns:
+        bool: False if `crop_coords` were invalid and the image was left uncropped.
+    """
+    from PIL import Image # Ensure Pillow is installed: pip install Pillow
+    cropped = True
+    img = Image.open(source)
+    if crop_coords and crop_coords.get('width', 0) > 0 and crop_coords.get('height', 0) > 0:
+        try:
+            x = int(float(crop_coords['x']))
+            y = int(float(crop_coords['y']))
+            w = int(float(crop_coords['width']))
+            h = int(float(crop_coords['height']))
+            img = img.crop((x, y, x + w, y + h))
+        except (ValueError, TypeError, KeyError) as e_crop:
+            current_app.logger.warning(f"Invalid crop coordinates for profile photo: {crop_coords}. Error: {e_crop}")
+            cropped = False
+
+    if thumbnail_size:
+        img.thumbnail(tuple(thumbnail_size), Image.Resampling.LANCZOS) # Use LANCZOS for better quality
+
+    if ext in ['jpg', 'jpeg'] and img.mode == 'RGBA':
+        img = img.convert('RGB')
+    img.save(save_path_abs, format=Image.registered_extensions().get(f'.{ext}'))
+    return cropped
+
+@task('images.process_profile_photo', priority=10)
+def process_profile_photo(db_path, crop_coords=None, thumbnail_size=None):
+    """
+    Crops and resizes a profile photo that `save_uploaded_file` stored unprocessed
+    (`defer_processing=True`). The result replaces the file atomically, so readers see
+    either the original upload or the finished photo. Runs as the
+    'images.process_profile_photo' task; a photo that was replaced meanwhile is skipped.
+    """
+    path_abs = os.path.join(current_app.static_folder, db_path)
+    if not os.path.exists(path_abs):
+        return False
+    ext = path_abs.rsplit('.', 1)[-1].lower()
+    temp_path_abs = f"{path_abs}.processing"
+    try:
+        _crop_and_resize_image(path_abs, temp_path_abs, ext, crop_coords, thumbnail_size)
+        os.replace(temp_path_abs, path_abs)
+    finally:
+        if os.path.exists(temp_path_abs):
+            os.remove(temp_path_abs)
+    return True
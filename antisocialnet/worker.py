@@ -0,0 +1,278 @@
+"""
+Database-backed job queue and the `flask worker` process that drains it.
+
+With TASK_BACKEND = 'database', `tasks.enqueue` inserts a `TaskJob` row instead of
+running the task in-process, and `flask worker` runs one or more processes, each with
+a pool of threads, that repeatedly lease and run the most urgent runnable job:
+
+* Claiming is one UPDATE over a `SELECT ... FOR UPDATE SKIP LOCKED` subquery, so on
+  PostgreSQL concurrent workers skip each other's rows instead of queueing behind
+  them. SQLite has no row locks (or SKIP LOCKED) but serializes writers, so the same
+  UPDATE claims atomically there. Either way the claim sets a lease
+  (TASK_LEASE_SECONDS), which the worker renews while the job runs; if the worker
+  dies, its job becomes runnable again when the lease runs out, or is dead-lettered
+  if that was its last attempt.
+* Jobs run by priority, then in the order they became runnable.
+* A failing job is retried after an exponential backoff (TASK_RETRY_BACKOFF_SECONDS,
+  doubling per attempt up to TASK_RETRY_BACKOFF_MAX_SECONDS, with jitter). After
+  its last attempt it's kept with status 'dead' (the dead-letter queue), which
+  `flask jobs` lists and requeues.
+
+Queue bookkeeping uses its own short transactions, separate from the task's session.
+No broker is needed: the application database is the queue.
+"""
+import json
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import threading
+from datetime import datetime, timezone, timedelta
+from flask import current_app
+from sqlalchemy import select, func, or_, and_, delete
+
+from . import db
+from .models import TaskJob
+from .tasks import get_task
+
+def _utcnow():
+    return datetime.now(timezone.utc)
+
+def enqueue_job(name, kwargs, priority=0, max_attempts=None, delay_seconds=0):
+    """
+    Queues a run of the task registered as `name`, committed on its own so it's
+    durable even if the caller's transaction rolls back later.
+
+    Returns:
+        int: The id of the new TaskJob.
+    """
+    table = TaskJob.__table__
+    now = _utcnow()
+    with db.engine.begin() as connection:
+        return connection.execute(table.insert().values(
+            name=name,
+            kwargs=json.dumps(kwargs),
+            priority=priority,
+            status=TaskJob.STATUS_QUEUED,
+            attempts=0,
+            max_attempts=max_attempts or current_app.config.get('TASK_MAX_ATTEMPTS', 5),
+            run_at=now + timedelta(seconds=delay_seconds),
+            created_at=now
+        )).inserted_primary_key[0]
+
+def _lease_expired(table, now):
+    return and_(table.c.status == TaskJob.STATUS_RUNNING, table.c.leased_until < now) # Its worker died
+
+def _runnable(table, now):
+    return or_(
+        and_(table.c.status == TaskJob.STATUS_QUEUED, table.c.run_at <= now),
+        and_(_lease_expired(table, now), table.c.attempts < table.c.max_attempts)
+    )
+
+def claim_job(worker_id):
+    """
+    Leases the next runnable job to `worker_id`.
+
+    Returns:
+        Row or None: The job's id, name, kwargs, attempts (including this one) and
+                     max_attempts, or None if nothing is runnable.
+    """
+    table = TaskJob.__table__
+    now = _utcnow()
+    next_job = select(table.c.id).where(_runnable(table, now))\
+        .order_by(table.c.priority.desc(), table.c.run_at, table.c.id)\
+        .limit(1).with_for_update(skip_locked=True)
+    # Runnability is checked again on the row itself, so a job claimed by someone else
+    # between the subquery and the update is left alone.
+    claim = table.update().where(table.c.id.in_(next_job), _runnable(table, now)).values(
+        status=TaskJob.STATUS_RUNNING,
+        attempts=table.c.attempts + 1,
+        leased_until=now + timedelta(seconds=current_app.config.get('TASK_LEASE_SECONDS', 300)),
+        leased_by=worker_id
+    )
+    # A job whose worker died during its last attempt (e.g. the job keeps crashing it)
+    # is dead-lettered rather than run again.
+    bury = table.update().where(_lease_expired(table, now), table.c.attempts >= table.c.max_attempts).values(
+        status=TaskJob.STATUS_DEAD, leased_until=None, leased_by=None,
+        last_error='Lease expired during the last attempt (worker died?)'
+    )
+    columns = (table.c.id, table.c.name, table.c.kwargs, table.c.attempts, table.c.max_attempts)
+    with db.engine.begin() as connection:
+        connection.execute(bury)
+        if connection.dialect.update_returning:
+            return connection.execute(claim.returning(*columns)).first()
+        if not connection.execute(claim).rowcount:
+            return None
+        return connection.execute(select(*columns).where(
+            table.c.leased_by == worker_id, table.c.status == TaskJob.STATUS_RUNNING
+        ).order_by(table.c.leased_until.desc()).limit(1)).first()
+
+def _retry_delay(attempts, config):
+    base = config.get('TASK_RETRY_BACKOFF_SECONDS', 10)
+    cap = config.get('TASK_RETRY_BACKOFF_MAX_SECONDS', 3600)
+    return min(cap, base * 2 ** (attempts - 1)) * random.uniform(0.75, 1.25)
+
+def run_job(job, worker_id):
+    """
+    Runs a claimed job in its own app context and records the outcome: the row is
+    deleted on success, requeued with backoff on failure, or dead-lettered after its
+    last attempt.
+
+    Returns:
+        bool: True if the task succeeded.
+    """
+    table = TaskJob.__table__
+    leased = (table.c.id == job.id) & (table.c.leased_by == worker_id)
+    finished = threading.Event()
+    heartbeat = threading.Thread(
+        target=_renew_lease, args=(current_app._get_current_object(), job.id, worker_id, finished),
+        name=f'antisocialnet-lease-{job.id}', daemon=True
+    )
+    heartbeat.start()
+    try:
+        get_task(job.name)(**json.loads(job.kwargs))
+    except Exception as e:
+        error = e
+    else:
+        error = None
+    finally:
+        finished.set()
+        heartbeat.join()
+
+    if error is not None:
+        db.session.rollback()
+        dead = job.attempts >= job.max_attempts
+        values = {'leased_until': None, 'leased_by': None, 'last_error': f'{type(error).__name__}: {error}'}
+        if dead:
+            values['status'] = TaskJob.STATUS_DEAD
+        else:
+            values['status'] = TaskJob.STATUS_QUEUED
+            values['run_at'] = _utcnow() + timedelta(seconds=_retry_delay(job.attempts, current_app.config))
+        with db.engine.begin() as connection:
+            connection.execute(table.update().where(leased).values(**values))
+        current_app.logger.error(
+            f"Job {job.id} ({job.name}) failed on attempt {job.attempts}/{job.max_attempts}"
+            f"{', dead-lettered' if dead else ', will retry'}: {error}", exc_info=error
+        )
+        return False
+    with db.engine.begin() as connection:
+        connection.execute(delete(table).where(leased))
+    return True
+
+def _renew_lease(app, job_id, worker_id, finished):
+    """Extends a running job's lease every third of TASK_LEASE_SECONDS until `finished` is set."""
+    table = TaskJob.__table__
+    lease_seconds = app.config.get('TASK_LEASE_SECONDS', 300)
+    while not finished.wait(lease_seconds / 3):
+        try:
+            with app.app_context(), db.engine.begin() as connection:
+                connection.execute(table.update().where(
+                    table.c.id == job_id, table.c.leased_by == worker_id
+                ).values(leased_until=_utcnow() + timedelta(seconds=lease_seconds)))
+        except Exception as e: # pragma: no cover - retried at the next beat, well before the lease ends
+            app.logger.warning(f"Could not renew the lease of job {job_id}: {e}")
+
+class Worker:
+    """A pool of threads in this process that claim and run jobs until stopped."""
+
+    def __init__(self, app, threads=4, burst=False):
+        self.app = app
+        self.threads = max(1, threads)
+        self.burst = burst # Exit once no job is runnable instead of polling
+        self._stopping = threading.Event()
+
+    def stop(self, *args):
+        self._stopping.set()
+
+    def run(self):
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self.stop)
+            signal.signal(signal.SIGINT, self.stop)
+        pool = [
+            threading.Thread(target=self._run_thread, name=f'antisocialnet-worker-{index}', daemon=True)
+            for index in range(self.threads)
+        ]
+        for thread in pool:
+            thread.start()
+        for thread in pool:
+            while thread.is_alive():
+                thread.join(timeout=0.5) # Wake up regularly so signals are handled
+        self.app.logger.info(f"Worker {os.getpid()} stopped.")
+
+    def _run_thread(self):
+        worker_id = f'{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}'
+        poll_seconds = self.app.config.get('TASK_WORKER_POLL_SECONDS', 1.0)
+        while not self._stopping.is_set():
+            with self.app.app_context():
+                try:
+                    job = claim_job(worker_id)
+                    if job is not None:
+                        run_job(job, worker_id)
+                except Exception as e: # pragma: no cover - e.g. the database is unreachable
+                    self.app.logger.error(f"Worker {worker_id} error: {e}", exc_info=True)
+                    job = None
+            if job is None:
+                if self.burst:
+                    return
+                self._stopping.wait(poll_seconds)
+
+def _run_forked_worker(app, threads, burst):
+    with app.app_context():
+        db.engine.dispose(close=False) # Don't share the parent's pooled connections
+    Worker(app, threads, burst).run()
+
+def run_workers(app, processes=1, threads=4, burst=False):
+    """
+    Runs `processes` worker processes with `threads` threads each until SIGTERM/SIGINT
+    (or, with `burst`, until the queue is drained). Extra processes are forked, so
+    this needs a POSIX system when `processes` is more than 1.
+    """
+    if processes <= 1:
+        Worker(app, threads, burst).run()
+        return
+    with app.app_context():
+        db.engine.dispose()
+    context = multiprocessing.get_context('fork')
+    children = [
+        context.Process(target=_run_forked_worker, args=(app, threads, burst), name=f'antisocialnet-worker-{index}')
+        for index in range(processes)
+    ]
+    for child in children:
+        child.start()
+
+    def stop_children(*args):
+        for child in children:
+            if child.is_alive():
+                child.terminate() # SIGTERM: each finishes its current jobs
+    signal.signal(signal.SIGTERM, stop_children)
+    signal.signal(signal.SIGINT, stop_children)
+    for child in children:
+        child.join()
+
+def queue_stats():
+    """Returns job counts by status and, for dead jobs, by task name."""
+    table = TaskJob.__table__
+    by_status = dict(db.session.execute(select(table.c.status, func.count()).group_by(table.c.status)).all())
+    dead_by_name = dict(db.session.execute(
+        select(table.c.name, func.count()).where(table.c.status == TaskJob.STATUS_DEAD).group_by(table.c.name)
+    ).all())
+    return {'by_status': by_status, 'dead_by_name': dead_by_name}
+
+def requeue_dead_jobs(job_ids=None):
+    """
+    Gives dead-lettered jobs (all of them, or those in `job_ids`) a fresh set of
+    attempts, runnable now.
+
+    Returns:
+        int: The number of jobs requeued.
+    """
+    table = TaskJob.__table__
+    statement = table.update().where(table.c.status == TaskJob.STATUS_DEAD).values(
+        status=TaskJob.STATUS_QUEUED, attempts=0, run_at=_utcnow()
+    )
+    if job_ids:
+        statement = statement.where(table.c.id.in_(job_ids))
+    requeued = db.session.execute(statement).rowcount
+    db.session.commit()
+    return requeued
@@ -0,0 +1,44 @@
+"""
+Production WSGI entry point:
+
+    gunicorn -c antisocialnet/gunicorn.conf.py
+
+Importing this module builds the app, with FLASK_ENV's config ('production' unless
+set), and warms it up. Under gunicorn with `preload_app` (see gunicorn.conf.py) that
+happens once in the master process, before the workers are forked, so they start with
+the imports, mappers, templates and URL map already in memory.
+
+`gc.freeze()` then moves every object allocated so far into the collector's permanent
+generation. Without it, a worker's first collections would write to the GC headers of
+those objects, copying the pages holding them. Frozen, those pages stay shared with the
+master copy-on-write. The config disables collection in the master until this point,
+so the heap isn't left with freed holes, and re-enables it in each worker.
+
+Importing the `antisocialnet` package itself never builds an app. The Flask CLI, setup
+scripts and tests call `create_app()`, and the ASGI server uses `asgi.create_asgi_app`.
+"""
+import gc
+import os
+
+from jinja2 import TemplateError
+from sqlalchemy.orm import configure_mappers
+
+from . import create_app
+
+def warm_up(app):
+    """Does the one-off work otherwise left to each worker's first requests."""
+    # Imported lazily elsewhere (see utils), but every web worker needs them
+    import bleach # noqa: F401
+    import markdown # noqa: F401
+    from PIL import Image # noqa: F401
+    configure_mappers()
+    app.url_map.update() # Compiles the URL matcher
+    for name in app.jinja_env.list_templates(filter_func=lambda name: name.endswith('.html')):
+        try:
+            app.jinja_env.get_template(name)
+        except TemplateError as e: # Left to fail where it's used, as it would without warm-up
+            app.logger.warning(f"Could not precompile template {name}: {e}")
+
+app = create_app(os.environ.get('FLASK_ENV', 'production'))
+warm_up(app)
+gc.freeze()
@@ -1,4 +1,5 @@
 import logging
+import re
 from logging.config import fileConfig
 
 from flask import current_app
@@ -51,6 +52,22 @@ def get_metadata():
     return target_db.metadata
 
 
+# Tables created by migrations rather than from the models, which autogenerate would
+# otherwise drop: the full-text search tables (with SQLite's FTS5 shadow tables, see
+# antisocialnet/search_utils.py) and the monthly notification partitions on PostgreSQL
+# (see antisocialnet/notification_utils.py).
+UNMANAGED_TABLES = re.compile(
+    r'^(?:(?:post|user)_search(?:_(?:data|idx|content|docsize|config))?'
+    r'|notification_p\d{4}_\d{2}|notification_default)$'
+)
+
+
+def include_object(object, name, type_, reflected, compare_to):
+    if type_ == 'table' and reflected and compare_to is None:
+        return not UNMANAGED_TABLES.match(name)
+    return True
+
+
 def run_migrations_offline():
     """Run migrations in 'offline' mode.
 
@@ -65,7 +82,8 @@ def run_migrations_offline():
     """
     url = config.get_main_option("sqlalchemy.url")
     context.configure(
-        url=url, target_metadata=get_metadata(), literal_binds=True
+        url=url, target_metadata=get_metadata(), literal_binds=True,
+        include_object=include_object
     )
 
     with context.begin_transaction():
@@ -93,6 +111,7 @@ def run_migrations_online():
     conf_args = current_app.extensions['migrate'].configure_args
     if conf_args.get("process_revision_directives") is None:
         conf_args["process_revision_directives"] = process_revision_directives
+    conf_args.setdefault("include_object", include_object)
 
     connectable = get_engine()
 
@@ -0,0 +1,46 @@
+"""Add broadcast notifications and per-user broadcast watermarks
+
+Revision ID: 0a7e5c3b9d24
+Revises: f1d4a7c92b60
+Create Date: 2026-10-17 17:11:52.604218
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0a7e5c3b9d24'
+down_revision = 'f1d4a7c92b60'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('broadcast_notification',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('actor_id', sa.Integer(), nullable=True),
+    sa.Column('type', sa.String(length=50), nullable=False),
+    sa.Column('target_type', sa.String(length=50), nullable=True),
+    sa.Column('target_id', sa.Integer(), nullable=True),
+    sa.Column('timestamp', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['actor_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('broadcast_notification', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_broadcast_notification_timestamp'), ['timestamp'], unique=False)
+
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('broadcast_read_id', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('broadcast_joined_id', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('broadcast_joined_id')
+        batch_op.drop_column('broadcast_read_id')
+
+    with op.batch_alter_table('broadcast_notification', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_broadcast_notification_timestamp'))
+
+    op.drop_table('broadcast_notification')
@@ -0,0 +1,43 @@
+"""Add task_job queue table
+
+Revision ID: 2b8d5f0e6a17
+Revises: 9e1b6d4c2f85
+Create Date: 2026-10-17 19:40:26.731950
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2b8d5f0e6a17'
+down_revision = '9e1b6d4c2f85'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('task_job',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=100), nullable=False),
+    sa.Column('kwargs', sa.Text(), nullable=False),
+    sa.Column('priority', sa.Integer(), nullable=False),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('max_attempts', sa.Integer(), nullable=False),
+    sa.Column('run_at', sa.DateTime(), nullable=False),
+    sa.Column('leased_until', sa.DateTime(), nullable=True),
+    sa.Column('leased_by', sa.String(length=255), nullable=True),
+    sa.Column('last_error', sa.Text(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('task_job', schema=None) as batch_op:
+        batch_op.create_index('ix_task_job_runnable', ['status', 'priority', 'run_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('task_job', schema=None) as batch_op:
+        batch_op.drop_index('ix_task_job_runnable')
+
+    op.drop_table('task_job')
@@ -0,0 +1,50 @@
+"""Add feed_item table for the materialized global feed
+
+Revision ID: 3f9a1c2d7e41
+Revises: bc06e5ba2395
+Create Date: 2026-10-17 09:12:03.512847
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f9a1c2d7e41'
+down_revision = 'bc06e5ba2395'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('feed_item',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('item_type', sa.String(length=20), nullable=False),
+    sa.Column('item_id', sa.Integer(), nullable=False),
+    sa.Column('author_id', sa.Integer(), nullable=False),
+    sa.Column('ts', sa.DateTime(), nullable=False),
+    sa.Column('visibility', sa.String(length=20), nullable=False),
+    sa.ForeignKeyConstraint(['author_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('item_type', 'item_id', name='_feed_item_target_uc')
+    )
+    with op.batch_alter_table('feed_item', schema=None) as batch_op:
+        batch_op.create_index('ix_feed_item_ts_id', [sa.text('ts DESC'), sa.text('id DESC')], unique=False)
+
+    # Populate the table from existing content (same as `flask feed backfill`).
+    op.execute(
+        "INSERT INTO feed_item (item_type, item_id, author_id, ts, visibility) "
+        "SELECT 'post', id, user_id, created_at, "
+        "CASE WHEN is_published THEN 'public' ELSE 'unpublished' END FROM post"
+    )
+    op.execute(
+        "INSERT INTO feed_item (item_type, item_id, author_id, ts, visibility) "
+        "SELECT 'photo', id, user_id, uploaded_at, 'public' FROM user_photo"
+    )
+
+
+def downgrade():
+    with op.batch_alter_table('feed_item', schema=None) as batch_op:
+        batch_op.drop_index('ix_feed_item_ts_id')
+
+    op.drop_table('feed_item')
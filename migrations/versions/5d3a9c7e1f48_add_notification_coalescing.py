@@ -0,0 +1,30 @@
+"""Add notification coalescing columns
+
+Revision ID: 5d3a9c7e1f48
+Revises: 2b8d5f0e6a17
+Create Date: 2026-10-17 21:05:12.418330
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d3a9c7e1f48'
+down_revision = '2b8d5f0e6a17'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('notification', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('actor_count', sa.Integer(), server_default='1', nullable=False))
+        batch_op.add_column(sa.Column('recent_actor_ids', sa.Text(), nullable=True))
+        batch_op.create_index('ix_notification_coalesce', ['user_id', 'type', 'target_type', 'target_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('notification', schema=None) as batch_op:
+        batch_op.drop_index('ix_notification_coalesce')
+        batch_op.drop_column('recent_actor_ids')
+        batch_op.drop_column('actor_count')
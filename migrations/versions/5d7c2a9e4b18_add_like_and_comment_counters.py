@@ -0,0 +1,58 @@
+"""Add denormalized like and comment counters
+
+Revision ID: 5d7c2a9e4b18
+Revises: 8b2e4d6f1a93
+Create Date: 2026-10-17 12:25:03.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d7c2a9e4b18'
+down_revision = '8b2e4d6f1a93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('like_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('comment_count', sa.Integer(), server_default='0', nullable=False))
+
+    with op.batch_alter_table('user_photo', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('like_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('comment_count', sa.Integer(), server_default='0', nullable=False))
+
+    with op.batch_alter_table('comment', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('like_count', sa.Integer(), server_default='0', nullable=False))
+
+    # Seed the counters from existing rows.
+    op.execute("""
+        UPDATE post SET
+            like_count = (SELECT COUNT(*) FROM "like" WHERE "like".target_type = 'post' AND "like".target_id = post.id),
+            comment_count = (SELECT COUNT(*) FROM comment WHERE comment.target_type = 'post' AND comment.target_id = post.id)
+    """)
+    op.execute("""
+        UPDATE user_photo SET
+            like_count = (SELECT COUNT(*) FROM "like" WHERE "like".target_type IN ('photo', 'userphoto') AND "like".target_id = user_photo.id),
+            comment_count = (SELECT COUNT(*) FROM comment WHERE comment.target_type IN ('userphoto', 'photo') AND comment.target_id = user_photo.id)
+    """)
+    op.execute("""
+        UPDATE comment SET
+            like_count = (SELECT COUNT(*) FROM "like" WHERE "like".target_type = 'comment' AND "like".target_id = comment.id)
+    """)
+
+
+def downgrade():
+    with op.batch_alter_table('comment', schema=None) as batch_op:
+        batch_op.drop_column('like_count')
+
+    with op.batch_alter_table('user_photo', schema=None) as batch_op:
+        batch_op.drop_column('comment_count')
+        batch_op.drop_column('like_count')
+
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.drop_column('comment_count')
+        batch_op.drop_column('like_count')
@@ -0,0 +1,42 @@
+"""Record unresolved mentions in content_mention, by name
+
+Revision ID: 6e2d9b4f7a05
+Revises: 8f6c2a4e0b39
+Create Date: 2026-10-18 10:14:36.502918
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6e2d9b4f7a05'
+down_revision = '8f6c2a4e0b39'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('content_mention', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('name', sa.String(length=120), nullable=True))
+        batch_op.alter_column('user_id', existing_type=sa.Integer(), nullable=True)
+
+    # Existing rows are all resolved mentions, so their name is the user's. Unresolved
+    # mentions are recorded by `flask content rerender` (RENDER_VERSION 3).
+    user = sa.table('user', sa.column('id', sa.Integer), sa.column('full_name', sa.String))
+    content_mention = sa.table('content_mention', sa.column('user_id', sa.Integer), sa.column('name', sa.String))
+    op.execute(content_mention.update().values(name=sa.select(sa.func.lower(user.c.full_name)).where(
+        user.c.id == content_mention.c.user_id
+    ).scalar_subquery()))
+
+    with op.batch_alter_table('content_mention', schema=None) as batch_op:
+        batch_op.alter_column('name', existing_type=sa.String(length=120), nullable=False)
+        batch_op.create_index(batch_op.f('ix_content_mention_name'), ['name'], unique=False)
+
+
+def downgrade():
+    op.execute("DELETE FROM content_mention WHERE user_id IS NULL")
+    with op.batch_alter_table('content_mention', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_content_mention_name'))
+        batch_op.alter_column('user_id', existing_type=sa.Integer(), nullable=False)
+        batch_op.drop_column('name')
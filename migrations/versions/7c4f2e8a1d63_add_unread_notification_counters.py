@@ -0,0 +1,49 @@
+"""Add unread notification counters and read watermark
+
+Revision ID: 7c4f2e8a1d63
+Revises: 0a7e5c3b9d24
+Create Date: 2026-10-17 18:02:37.118405
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c4f2e8a1d63'
+down_revision = '0a7e5c3b9d24'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('notification_unread_count',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('type', sa.String(length=50), nullable=False),
+    sa.Column('unread_count', sa.Integer(), nullable=False),
+    sa.Column('read_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('user_id', 'type')
+    )
+
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('notifications_read_id', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('unread_notifications', sa.Integer(), server_default='0', nullable=False))
+
+    # Seed the counters from the existing is_read flags (the watermark starts at 0).
+    op.execute("""
+        UPDATE "user" SET
+            unread_notifications = (SELECT COUNT(*) FROM notification WHERE notification.user_id = "user".id AND NOT notification.is_read)
+    """)
+    op.execute("""
+        INSERT INTO notification_unread_count (user_id, type, unread_count, read_id)
+        SELECT user_id, type, COUNT(*), 0 FROM notification WHERE NOT is_read GROUP BY user_id, type
+    """)
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('unread_notifications')
+        batch_op.drop_column('notifications_read_id')
+
+    op.drop_table('notification_unread_count')
@@ -0,0 +1,48 @@
+"""Add home_timeline table and per-author feed_item index
+
+Revision ID: 8b2e4d6f1a93
+Revises: 3f9a1c2d7e41
+Create Date: 2026-10-17 11:40:27.904615
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b2e4d6f1a93'
+down_revision = '3f9a1c2d7e41'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('home_timeline',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('feed_item_id', sa.Integer(), nullable=False),
+    sa.Column('author_id', sa.Integer(), nullable=False),
+    sa.Column('ts', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['author_id'], ['user.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['feed_item_id'], ['feed_item.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('user_id', 'feed_item_id', name='_home_timeline_user_item_uc')
+    )
+    with op.batch_alter_table('home_timeline', schema=None) as batch_op:
+        batch_op.create_index('ix_home_timeline_user_author', ['user_id', 'author_id'], unique=False)
+        batch_op.create_index('ix_home_timeline_user_ts', ['user_id', sa.text('ts DESC'), sa.text('feed_item_id DESC')], unique=False)
+
+    with op.batch_alter_table('feed_item', schema=None) as batch_op:
+        batch_op.create_index('ix_feed_item_author_ts', ['author_id', sa.text('ts DESC'), sa.text('id DESC')], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('feed_item', schema=None) as batch_op:
+        batch_op.drop_index('ix_feed_item_author_ts')
+
+    with op.batch_alter_table('home_timeline', schema=None) as batch_op:
+        batch_op.drop_index('ix_home_timeline_user_ts')
+        batch_op.drop_index('ix_home_timeline_user_author')
+
+    op.drop_table('home_timeline')
@@ -0,0 +1,90 @@
+"""Add notification (user_id, timestamp) index; partition notification by month on PostgreSQL
+
+Revision ID: 8f6c2a4e0b39
+Revises: 5d3a9c7e1f48
+Create Date: 2026-10-17 22:14:07.905116
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8f6c2a4e0b39'
+down_revision = '5d3a9c7e1f48'
+branch_labels = None
+depends_on = None
+
+
+def _create_notification_indexes():
+    with op.batch_alter_table('notification', schema=None) as batch_op:
+        batch_op.create_index('ix_notification_target', ['target_type', 'target_id'], unique=False)
+        batch_op.create_index('ix_notification_coalesce', ['user_id', 'type', 'target_type', 'target_id'], unique=False)
+
+
+def upgrade():
+    # On PostgreSQL the table becomes RANGE partitioned on "timestamp", one partition per
+    # month named notification_pYYYY_MM (keep in sync with antisocialnet/notification_utils.py),
+    # plus a default partition. The primary key has to include the partition key.
+    # SQLite has no partitioning; there the retention pruner keeps the table small.
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute("DROP INDEX ix_notification_target")
+        op.execute("DROP INDEX ix_notification_coalesce")
+        op.execute("ALTER TABLE notification RENAME TO notification_unpartitioned")
+        op.execute("ALTER TABLE notification_unpartitioned RENAME CONSTRAINT notification_pkey TO notification_unpartitioned_pkey")
+        op.execute(
+            "CREATE TABLE notification (LIKE notification_unpartitioned INCLUDING DEFAULTS) "
+            "PARTITION BY RANGE (\"timestamp\")"
+        )
+        op.execute("ALTER TABLE notification ADD PRIMARY KEY (id, \"timestamp\")")
+        op.execute("ALTER TABLE notification ADD FOREIGN KEY (user_id) REFERENCES \"user\" (id)")
+        op.execute("ALTER TABLE notification ADD FOREIGN KEY (actor_id) REFERENCES \"user\" (id)")
+        op.execute("CREATE TABLE notification_default PARTITION OF notification DEFAULT")
+        # Monthly partitions from the oldest notification through two months ahead.
+        op.execute("""
+            DO $$
+            DECLARE
+                month_start timestamp;
+                this_month timestamp := date_trunc('month', now() AT TIME ZONE 'UTC');
+            BEGIN
+                FOR month_start IN
+                    SELECT generate_series(
+                        LEAST(coalesce(date_trunc('month', (SELECT min("timestamp") FROM notification_unpartitioned)), this_month), this_month),
+                        this_month + interval '2 months',
+                        interval '1 month'
+                    )
+                LOOP
+                    EXECUTE format(
+                        'CREATE TABLE %I PARTITION OF notification FOR VALUES FROM (%L) TO (%L)',
+                        'notification_p' || to_char(month_start, 'YYYY_MM'), month_start, month_start + interval '1 month'
+                    );
+                END LOOP;
+            END $$
+        """)
+        op.execute("INSERT INTO notification SELECT * FROM notification_unpartitioned")
+        op.execute("ALTER SEQUENCE notification_id_seq OWNED BY notification.id")
+        op.execute("DROP TABLE notification_unpartitioned")
+        _create_notification_indexes()
+
+    with op.batch_alter_table('notification', schema=None) as batch_op:
+        # Listing a user's notifications newest first.
+        batch_op.create_index('ix_notification_user_timestamp', ['user_id', sa.text('timestamp DESC'), sa.text('id DESC')], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('notification', schema=None) as batch_op:
+        batch_op.drop_index('ix_notification_user_timestamp')
+
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute("DROP INDEX ix_notification_target")
+        op.execute("DROP INDEX ix_notification_coalesce")
+        op.execute("ALTER TABLE notification RENAME TO notification_partitioned")
+        op.execute("ALTER TABLE notification_partitioned RENAME CONSTRAINT notification_pkey TO notification_partitioned_pkey")
+        op.execute("CREATE TABLE notification (LIKE notification_partitioned INCLUDING DEFAULTS)")
+        op.execute("ALTER TABLE notification ADD PRIMARY KEY (id)")
+        op.execute("ALTER TABLE notification ADD FOREIGN KEY (user_id) REFERENCES \"user\" (id)")
+        op.execute("ALTER TABLE notification ADD FOREIGN KEY (actor_id) REFERENCES \"user\" (id)")
+        op.execute("INSERT INTO notification SELECT * FROM notification_partitioned")
+        op.execute("ALTER SEQUENCE notification_id_seq OWNED BY notification.id")
+        op.execute("DROP TABLE notification_partitioned") # Drops its partitions too
+        _create_notification_indexes()
@@ -0,0 +1,41 @@
+"""Add notification_fan_out jobs
+
+Revision ID: 9e1b6d4c2f85
+Revises: 7c4f2e8a1d63
+Create Date: 2026-10-17 18:51:09.482716
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9e1b6d4c2f85'
+down_revision = '7c4f2e8a1d63'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('notification_fan_out',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('actor_id', sa.Integer(), nullable=False),
+    sa.Column('type', sa.String(length=50), nullable=False),
+    sa.Column('target_type', sa.String(length=50), nullable=True),
+    sa.Column('target_id', sa.Integer(), nullable=True),
+    sa.Column('last_follower_id', sa.Integer(), nullable=False),
+    sa.Column('notified_count', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('completed_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['actor_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('notification_fan_out', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_notification_fan_out_completed_at'), ['completed_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('notification_fan_out', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_notification_fan_out_completed_at'))
+
+    op.drop_table('notification_fan_out')
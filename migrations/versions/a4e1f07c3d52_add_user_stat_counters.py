@@ -0,0 +1,43 @@
+"""Add denormalized user stat counters
+
+Revision ID: a4e1f07c3d52
+Revises: 5d7c2a9e4b18
+Create Date: 2026-10-17 13:02:44.571930
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4e1f07c3d52'
+down_revision = '5d7c2a9e4b18'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('follower_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('following_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('post_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('photo_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.create_index(batch_op.f('ix_user_follower_count'), ['follower_count'], unique=False)
+
+    # Seed the counters from existing rows.
+    op.execute("""
+        UPDATE "user" SET
+            follower_count = (SELECT COUNT(*) FROM follower_link WHERE follower_link.followed_id = "user".id),
+            following_count = (SELECT COUNT(*) FROM follower_link WHERE follower_link.follower_id = "user".id),
+            post_count = (SELECT COUNT(*) FROM post WHERE post.user_id = "user".id AND post.is_published),
+            photo_count = (SELECT COUNT(*) FROM user_photo WHERE user_photo.user_id = "user".id)
+    """)
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_user_follower_count'))
+        batch_op.drop_column('photo_count')
+        batch_op.drop_column('post_count')
+        batch_op.drop_column('following_count')
+        batch_op.drop_column('follower_count')
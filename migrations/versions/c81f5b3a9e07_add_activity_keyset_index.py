@@ -0,0 +1,26 @@
+"""Add activity (timestamp, id) index for cursor pagination
+
+Revision ID: c81f5b3a9e07
+Revises: a4e1f07c3d52
+Create Date: 2026-10-17 13:48:19.336805
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c81f5b3a9e07'
+down_revision = 'a4e1f07c3d52'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('activity', schema=None) as batch_op:
+        batch_op.create_index('ix_activity_timestamp_id', [sa.text('timestamp DESC'), sa.text('id DESC')], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('activity', schema=None) as batch_op:
+        batch_op.drop_index('ix_activity_timestamp_id')
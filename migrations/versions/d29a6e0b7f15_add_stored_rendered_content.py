@@ -0,0 +1,50 @@
+"""Add stored rendered HTML, excerpts and render versions
+
+Revision ID: d29a6e0b7f15
+Revises: c81f5b3a9e07
+Create Date: 2026-10-17 14:31:52.640117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd29a6e0b7f15'
+down_revision = 'c81f5b3a9e07'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Existing rows are left with a NULL render_version; they're rendered on read until
+    # `flask content rerender` fills them in.
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('content_html', sa.Text(), nullable=True))
+        batch_op.add_column(sa.Column('excerpt', sa.Text(), nullable=True))
+        batch_op.add_column(sa.Column('render_version', sa.Integer(), nullable=True))
+
+    with op.batch_alter_table('user_photo', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('caption_html', sa.Text(), nullable=True))
+        batch_op.add_column(sa.Column('excerpt', sa.Text(), nullable=True))
+        batch_op.add_column(sa.Column('render_version', sa.Integer(), nullable=True))
+
+    with op.batch_alter_table('comment', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('excerpt', sa.Text(), nullable=True))
+        batch_op.add_column(sa.Column('render_version', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('comment', schema=None) as batch_op:
+        batch_op.drop_column('render_version')
+        batch_op.drop_column('excerpt')
+
+    with op.batch_alter_table('user_photo', schema=None) as batch_op:
+        batch_op.drop_column('render_version')
+        batch_op.drop_column('excerpt')
+        batch_op.drop_column('caption_html')
+
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.drop_column('render_version')
+        batch_op.drop_column('excerpt')
+        batch_op.drop_column('content_html')
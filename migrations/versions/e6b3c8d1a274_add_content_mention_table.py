@@ -0,0 +1,41 @@
+"""Add content_mention table
+
+Revision ID: e6b3c8d1a274
+Revises: d29a6e0b7f15
+Create Date: 2026-10-17 15:20:08.913562
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e6b3c8d1a274'
+down_revision = 'd29a6e0b7f15'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Rows are filled by `flask content rerender` (RENDER_VERSION 2 adds mention links).
+    op.create_table('content_mention',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('content_type', sa.String(length=50), nullable=False),
+    sa.Column('content_id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('span_start', sa.Integer(), nullable=False),
+    sa.Column('span_end', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('content_mention', schema=None) as batch_op:
+        batch_op.create_index('ix_content_mention_content', ['content_type', 'content_id'], unique=False)
+        batch_op.create_index(batch_op.f('ix_content_mention_user_id'), ['user_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('content_mention', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_content_mention_user_id'))
+        batch_op.drop_index('ix_content_mention_content')
+
+    op.drop_table('content_mention')
@@ -0,0 +1,69 @@
+"""Add full-text search index for posts and users
+
+Revision ID: f1d4a7c92b60
+Revises: e6b3c8d1a274
+Create Date: 2026-10-17 16:02:41.337120
+
+"""
+import logging
+
+from alembic import op
+import sqlalchemy as sa
+
+log = logging.getLogger('alembic.runtime.migration')
+
+
+# revision identifiers, used by Alembic.
+revision = 'f1d4a7c92b60'
+down_revision = 'e6b3c8d1a274'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Not ORM tables: FTS5 virtual tables on SQLite, tsvector + GIN on PostgreSQL. Keep
+    # in sync with the backends in antisocialnet/search_utils.py.
+    bind = op.get_bind()
+    dialect = bind.dialect.name
+    # Older migrated databases have no post.title column even though the model does.
+    has_title = 'title' in {column['name'] for column in sa.inspect(bind).get_columns('post')}
+    title = "coalesce(title, '')" if has_title else "''"
+    if dialect == 'sqlite':
+        op.execute(
+            "CREATE VIRTUAL TABLE post_search USING fts5("
+            "title, content, tokenize='porter unicode61 remove_diacritics 2', prefix='2 3')"
+        )
+        op.execute(
+            "CREATE VIRTUAL TABLE user_search USING fts5("
+            "username, full_name, tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+        )
+        op.execute(
+            "INSERT INTO post_search (rowid, title, content) "
+            f"SELECT id, {title}, coalesce(content, '') FROM post WHERE is_published"
+        )
+        op.execute(
+            "INSERT INTO user_search (rowid, username, full_name) "
+            "SELECT id, coalesce(username, ''), coalesce(full_name, '') FROM \"user\""
+        )
+    elif dialect == 'postgresql':
+        op.execute("CREATE TABLE post_search (post_id INTEGER PRIMARY KEY, document TSVECTOR NOT NULL)")
+        op.execute("CREATE TABLE user_search (user_id INTEGER PRIMARY KEY, document TSVECTOR NOT NULL)")
+        op.execute(
+            "INSERT INTO post_search (post_id, document) "
+            f"SELECT id, setweight(to_tsvector('english', {title}), 'A') || "
+            "setweight(to_tsvector('english', coalesce(content, '')), 'B') FROM post WHERE is_published"
+        )
+        op.execute(
+            "INSERT INTO user_search (user_id, document) "
+            "SELECT id, setweight(to_tsvector('simple', coalesce(full_name, '')), 'A') || "
+            "setweight(to_tsvector('simple', coalesce(username, '')), 'B') FROM \"user\""
+        )
+        op.execute("CREATE INDEX ix_post_search_document ON post_search USING GIN (document)")
+        op.execute("CREATE INDEX ix_user_search_document ON user_search USING GIN (document)")
+    else:
+        log.warning(f"Full-text search isn't supported on '{dialect}' databases; skipping the search index.")
+
+
+def downgrade():
+    op.execute("DROP TABLE IF EXISTS user_search")
+    op.execute("DROP TABLE IF EXISTS post_search")